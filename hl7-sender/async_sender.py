@@ -0,0 +1,247 @@
+"""
+Concurrent HL7 MLLP Sender (asyncio)
+
+Spreads a list of HL7 messages across N concurrent MLLP sessions. Each session keeps
+its own persistent connection with a pipelined window of unacknowledged messages, so
+a single process can keep a multi-core receiver fully loaded.
+"""
+import time
+import asyncio
+
+from send_hl7 import (
+    DEFAULT_ACK_TIMEOUT, DEFAULT_WINDOW, match_ack, report_mllp_result, to_wire_bytes
+)
+from hl7_message import HL7Message
+from mllp_codec import MLLPDecoder, EncodedFrame, encode_frame
+from metrics import METRICS
+from send_log import summary
+
+class AsyncMLLPSession:
+    """A single pipelined MLLP session driven by asyncio streams
+
+    A background task reads ACKs as soon as they arrive, so send-to-ACK timing is
+    accurate even while the session is idle. ``on_result(result, latency)`` is
+    called for every completed message; by default the result is printed.
+    ``tls`` (an ``mllp_tls.TLSClient``) wraps the connection in TLS; asyncio
+    streams cannot offer a saved session, so each connect is a full handshake.
+    """
+
+    def __init__(self, session_id, host, port, timeout=DEFAULT_ACK_TIMEOUT, window=DEFAULT_WINDOW,
+                 on_result=None, tls=None):
+        self.session_id = session_id
+        self.host = host
+        self.port = port
+        self.tls = tls
+        self.timeout = timeout
+        self.window = max(1, window)
+        self.on_result = on_result
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.error = None
+        self.acked = asyncio.Event()
+        self.decoder = MLLPDecoder()
+        # Control ID -> message type for messages awaiting an ACK, in send order
+        self.pending = {}
+        # Control ID -> perf_counter() time the message was sent (or scheduled)
+        self.sent_at = {}
+        self.sent = 0
+        self.accepted = 0
+        self.failed = 0
+        self.elapsed = 0.0
+
+    async def connect(self):
+        """Open the connection and start the ACK reader if not already connected"""
+        if self.writer is None:
+            started = time.perf_counter()
+            try:
+                if self.tls is not None:
+                    connection = asyncio.open_connection(self.host, self.port, ssl=self.tls.context,
+                                                         server_hostname=self.tls.server_name or self.host)
+                else:
+                    connection = asyncio.open_connection(self.host, self.port)
+                self.reader, self.writer = await asyncio.wait_for(connection, self.timeout)
+                if self.tls is not None:
+                    self.tls.check_pin(self.writer.get_extra_info('ssl_object'))
+            except (OSError, asyncio.TimeoutError):
+                METRICS.count('connections', 'failed')
+                if self.writer is not None:
+                    self.writer.close()
+                    self.reader = self.writer = None
+                raise
+            if self.tls is not None:
+                METRICS.count('tls_handshakes', 'full')
+            METRICS.observe('connect', time.perf_counter() - started)
+            METRICS.count('connections', 'opened')
+            self.decoder.reset()
+            self.error = None
+            self.reader_task = asyncio.create_task(self._read_acks())
+
+    async def close(self):
+        """Stop the ACK reader and close the connection"""
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            try:
+                await self.reader_task
+            except asyncio.CancelledError:
+                pass
+            self.reader_task = None
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.reader = self.writer = None
+
+    async def run(self, source):
+        """Pull messages from the shared ``source`` iterator until it is exhausted"""
+        start_time = time.perf_counter()
+        # Messages are drawn from the shared iterator one at a time, so sessions
+        # that get faster ACKs naturally take a larger share of the work
+        for message in source:
+            await self.send(message)
+        await self.finish()
+        self.elapsed = time.perf_counter() - start_time
+
+    async def run_queue(self, queue):
+        """Send ``(message, scheduled_time)`` items from an asyncio queue until ``None`` is received"""
+        start_time = time.perf_counter()
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            await self.send(*item)
+        await self.finish()
+        self.elapsed = time.perf_counter() - start_time
+
+    async def send(self, message, scheduled=None):
+        """Send one message, waiting only while the in-flight window is full
+
+        ``scheduled`` is the perf_counter() time the message was meant to go out;
+        latency is measured from it so that queueing delay is not hidden.
+        """
+        if isinstance(message, EncodedFrame):
+            frame, control_id, message_type = message
+        else:
+            started = time.perf_counter()
+            header = HL7Message(message)
+            control_id = header.control_id or ""
+            message_type = header.message_type or "Unknown"
+            frame = encode_frame(to_wire_bytes(message))
+            METRICS.observe('encode', time.perf_counter() - started)
+        try:
+            await self.connect()
+            if len(self.pending) >= self.window or control_id in self.pending:
+                started = time.perf_counter()
+                while len(self.pending) >= self.window or control_id in self.pending:
+                    await self._wait_for_ack()
+                METRICS.observe('ack_wait', time.perf_counter() - started)
+            started = time.perf_counter()
+            self.writer.write(frame)
+            self.pending[control_id] = message_type
+            self.sent_at[control_id] = scheduled if scheduled is not None else time.perf_counter()
+            self.sent += 1
+            await self.writer.drain()
+            METRICS.observe('send', time.perf_counter() - started)
+            METRICS.count('bytes_sent', 'mllp', len(frame))
+        except (OSError, ConnectionError, asyncio.TimeoutError) as e:
+            if control_id not in self.pending:
+                self._record((control_id, message_type, None, str(e) or type(e).__name__))
+            await self._fail_pending(e)
+
+    async def finish(self):
+        """Wait for every in-flight message to be acknowledged, then close"""
+        started = time.perf_counter()
+        try:
+            while self.pending:
+                await self._wait_for_ack()
+        except (OSError, ConnectionError, asyncio.TimeoutError) as e:
+            await self._fail_pending(e)
+        METRICS.observe('ack_wait', time.perf_counter() - started)
+        await self.close()
+
+    async def _wait_for_ack(self):
+        """Block until the reader records another ACK, or raise its error"""
+        self.acked.clear()
+        if self.error is None:
+            await asyncio.wait_for(self.acked.wait(), self.timeout)
+        if self.error is not None:
+            raise self.error
+
+    async def _read_acks(self):
+        """Background task: record the result of every ACK frame as it arrives"""
+        try:
+            while True:
+                chunk = await self.reader.read(65536)
+                if not chunk:
+                    raise ConnectionError("Connection closed by MLLP server")
+                for frame in self.decoder.feed(chunk):
+                    self._record(match_ack(self.pending, frame))
+                self.acked.set()
+        except (OSError, ConnectionError) as e:
+            self.error = e
+            self.acked.set()
+
+    def _record(self, result):
+        """Update the session counters with one result"""
+        sent_at = self.sent_at.pop(result[0], None)
+        latency = time.perf_counter() - sent_at if sent_at is not None else None
+        if result[2] == "AA":
+            self.accepted += 1
+        else:
+            self.failed += 1
+        if self.on_result is not None:
+            METRICS.count('messages', result[2] or 'failed')
+            self.on_result(result, latency)
+        else:
+            report_mllp_result(result, prefix=f"[session {self.session_id}] ", latency=latency)
+
+    async def _fail_pending(self, error):
+        """Drop the connection and report every in-flight message as failed"""
+        for control_id, message_type in list(self.pending.items()):
+            self._record((control_id, message_type, None, str(error) or type(error).__name__))
+        self.pending.clear()
+        await self.close()
+
+    def throughput(self):
+        """Messages acknowledged per second over the session lifetime"""
+        return (self.accepted + self.failed) / self.elapsed if self.elapsed else 0.0
+
+async def run_sessions(messages, host, port, concurrency, timeout=DEFAULT_ACK_TIMEOUT, window=DEFAULT_WINDOW,
+                       on_result=None, tls=None):
+    """Run ``concurrency`` sessions over the same message iterator and return them"""
+    source = iter(messages)
+    sessions = [AsyncMLLPSession(i + 1, host, port, timeout, window, on_result, tls) for i in range(concurrency)]
+    await asyncio.gather(*(session.run(source) for session in sessions))
+    return sessions
+
+def send_concurrent(messages, host, port, concurrency, timeout=DEFAULT_ACK_TIMEOUT, window=DEFAULT_WINDOW, tls=None):
+    """Send messages across concurrent MLLP sessions and print a throughput summary
+
+    Returns a dict with aggregate counters and per-session statistics.
+    """
+    start_time = time.perf_counter()
+    sessions = asyncio.run(run_sessions(messages, host, port, concurrency, timeout, window, tls=tls))
+    elapsed = time.perf_counter() - start_time
+
+    stats = {
+        'sent': sum(s.sent for s in sessions),
+        'accepted': sum(s.accepted for s in sessions),
+        'failed': sum(s.failed for s in sessions),
+        'total': sum(s.accepted + s.failed for s in sessions),
+        'elapsed': elapsed,
+        'throughput': sum(s.accepted + s.failed for s in sessions) / elapsed if elapsed else 0.0,
+        'sessions': [
+            {'session': s.session_id, 'sent': s.sent, 'accepted': s.accepted, 'failed': s.failed,
+             'elapsed': s.elapsed, 'throughput': s.throughput()}
+            for s in sessions
+        ]
+    }
+
+    summary.info("\nSession throughput (%d sessions, window %d):", concurrency, window)
+    for session in stats['sessions']:
+        summary.info("  Session %d: %d accepted, %d failed, %.1f msgs/sec", session['session'],
+                     session['accepted'], session['failed'], session['throughput'])
+    summary.info("Aggregate: %d messages in %.2fs (%.1f msgs/sec)", stats['total'], elapsed, stats['throughput'])
+    return stats
@@ -0,0 +1,232 @@
+"""
+MLLP Load Test / Benchmark
+
+Drives an MLLP receiver with one of two load models and reports send-to-ACK latency
+percentiles, throughput and acknowledgment counts:
+
+- ``closed``: a fixed number of concurrent sessions, each sending as fast as its
+  in-flight window allows (throughput is set by the receiver)
+- ``open``:   messages are issued at a target arrival rate (constant or Poisson),
+  independent of how fast ACKs come back (latency is set by the receiver)
+
+In open-loop mode latency is measured from each message's scheduled send time, so
+queueing behind a slow receiver shows up in the percentiles instead of being hidden
+(coordinated omission).
+"""
+import json
+import time
+import random
+import asyncio
+import itertools
+from collections import Counter
+
+from async_sender import AsyncMLLPSession
+from corpus import iter_hl7_messages, iter_indexed_frames, has_index
+from send_hl7 import DEFAULT_ACK_TIMEOUT, DEFAULT_WINDOW
+
+BENCH_PERCENTILES = [50.0, 90.0, 99.0, 99.9]
+
+class LatencyHistogram:
+    """HDR-style log-linear histogram of latencies in microseconds
+
+    Values below ``2 ** sub_bucket_bits`` are counted exactly; above that, every
+    power-of-two range is split into ``2 ** (sub_bucket_bits - 1)`` linear buckets,
+    giving a constant relative precision (under 1% with the default of 8 bits)
+    over any range with a fixed, small amount of memory.
+    """
+
+    def __init__(self, sub_bucket_bits=8):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.half_count = 1 << (sub_bucket_bits - 1)
+        self.counts = []
+        self.total = 0
+        self.min = None
+        self.max = 0
+        self.sum = 0
+
+    def _index(self, value):
+        """Bucket index for a non-negative integer value"""
+        shift = value.bit_length() - self.sub_bucket_bits
+        if shift <= 0:
+            return value
+        return shift * self.half_count + (value >> shift)
+
+    def _highest_value(self, index):
+        """Largest value that falls into a bucket"""
+        if index < 2 * self.half_count:
+            return index
+        shift = index // self.half_count - 1
+        mantissa = index - shift * self.half_count
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, seconds):
+        """Record one latency given in seconds"""
+        value = max(0, int(seconds * 1_000_000))
+        index = self._index(value)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+        self.total += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self.min = value if self.min is None else min(self.min, value)
+
+    def percentile(self, percent):
+        """Latency in microseconds at or below which ``percent`` of samples fall"""
+        if not self.total:
+            return 0
+        target = max(1, int(round(self.total * percent / 100.0)))
+        running = 0
+        for index, count in enumerate(self.counts):
+            running += count
+            if running >= target:
+                return min(self._highest_value(index), self.max)
+        return self.max
+
+    def to_dict(self):
+        """Summary in milliseconds, suitable for JSON output"""
+        summary = {
+            'count': self.total,
+            'min': (self.min or 0) / 1000.0,
+            'mean': (self.sum / self.total / 1000.0) if self.total else 0.0,
+            'max': self.max / 1000.0,
+        }
+        for percent in BENCH_PERCENTILES:
+            summary[f"p{percent:g}"] = self.percentile(percent) / 1000.0
+        return summary
+
+def _read_corpus(file_path, fmt):
+    """Messages of a corpus; indexed corpora yield pre-framed messages from the mapped file"""
+    if fmt in ('auto', 'mllp') and has_index(file_path):
+        return iter_indexed_frames(file_path)
+    return iter_hl7_messages(file_path, fmt)
+
+def repeat_messages(file_path, fmt='auto', count=None):
+    """Stream messages from a corpus, re-reading it until ``count`` messages were produced"""
+    if count is None:
+        yield from _read_corpus(file_path, fmt)
+        return
+    produced = 0
+    while produced < count:
+        before = produced
+        for message in _read_corpus(file_path, fmt):
+            yield message
+            produced += 1
+            if produced >= count:
+                return
+        if produced == before:
+            return  # empty corpus
+
+def arrival_intervals(rate, arrival='constant', seed=None):
+    """Yield gaps in seconds between message arrivals for an open-loop run"""
+    if arrival == 'poisson':
+        rng = random.Random(seed)
+        while True:
+            yield rng.expovariate(rate)
+    else:
+        yield from itertools.repeat(1.0 / rate)
+
+class BenchmarkRecorder:
+    """Collects per-message results from every session"""
+
+    def __init__(self):
+        self.histogram = LatencyHistogram()
+        self.ack_codes = Counter()
+
+    def __call__(self, result, latency):
+        ack_code = result[2]
+        self.ack_codes[ack_code if ack_code is not None else 'failed'] += 1
+        if ack_code is not None and latency is not None:
+            self.histogram.record(latency)
+
+async def _closed_loop(messages, sessions):
+    """Every session sends from the shared iterator as fast as its window allows"""
+    source = iter(messages)
+    await asyncio.gather(*(session.run(source) for session in sessions))
+
+async def _open_loop(messages, sessions, rate, arrival, seed):
+    """Issue messages on an arrival schedule, round-robin across sessions"""
+    queues = [asyncio.Queue() for _ in sessions]
+    workers = [asyncio.create_task(session.run_queue(queue)) for session, queue in zip(sessions, queues)]
+    intervals = arrival_intervals(rate, arrival, seed)
+    next_time = time.perf_counter()
+    for i, message in enumerate(messages):
+        delay = next_time - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        queues[i % len(queues)].put_nowait((message, next_time))
+        next_time += next(intervals)
+    for queue in queues:
+        queue.put_nowait(None)
+    await asyncio.gather(*workers)
+
+def run_benchmark(file_path, host, port, mode='closed', concurrency=1, window=DEFAULT_WINDOW,
+                  rate=None, arrival='constant', count=None, timeout=DEFAULT_ACK_TIMEOUT,
+                  fmt='auto', seed=None, output=None):
+    """Run a load test against an MLLP receiver and return the results as a dict
+
+    The results are printed as a summary and written as JSON to ``output`` (or
+    printed as JSON when no output file is given).
+    """
+    if mode == 'open' and not rate:
+        raise ValueError("Open-loop benchmarks need a target --rate")
+
+    recorder = BenchmarkRecorder()
+    sessions = [AsyncMLLPSession(i + 1, host, port, timeout, window, on_result=recorder)
+                for i in range(concurrency)]
+    messages = repeat_messages(file_path, fmt, count)
+
+    start_time = time.perf_counter()
+    if mode == 'open':
+        asyncio.run(_open_loop(messages, sessions, rate, arrival, seed))
+    else:
+        asyncio.run(_closed_loop(messages, sessions))
+    elapsed = time.perf_counter() - start_time
+
+    completed = sum(recorder.ack_codes.values())
+    results = {
+        'mode': mode,
+        'host': host,
+        'port': port,
+        'concurrency': concurrency,
+        'window': window,
+        'target_rate': rate if mode == 'open' else None,
+        'arrival': arrival if mode == 'open' else None,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(time.time() - elapsed)),
+        'messages': completed,
+        'elapsed': elapsed,
+        'throughput': completed / elapsed if elapsed else 0.0,
+        'ack_codes': {code: recorder.ack_codes.get(code, 0) for code in ('AA', 'AE', 'AR', 'failed')},
+        'latency_ms': recorder.histogram.to_dict(),
+        'sessions': [
+            {'session': s.session_id, 'sent': s.sent, 'accepted': s.accepted, 'failed': s.failed,
+             'throughput': s.throughput()}
+            for s in sessions
+        ]
+    }
+    other_codes = {code: n for code, n in recorder.ack_codes.items() if code not in results['ack_codes']}
+    if other_codes:
+        results['ack_codes'].update(other_codes)
+
+    print_benchmark(results)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Benchmark results written to {output}")
+    else:
+        print(json.dumps(results))
+    return results
+
+def print_benchmark(results):
+    """Print a human-readable benchmark summary"""
+    latency = results['latency_ms']
+    if results['mode'] == 'open':
+        load = f"open loop, {results['arrival']} arrivals at {results['target_rate']:g} msgs/sec"
+    else:
+        load = "closed loop"
+    print(f"\nBenchmark ({load}, {results['concurrency']} sessions, window {results['window']})")
+    print(f"  Messages:   {results['messages']} in {results['elapsed']:.2f}s "
+          f"({results['throughput']:.1f} msgs/sec)")
+    print("  ACK codes:  " + ", ".join(f"{code}={n}" for code, n in results['ack_codes'].items()))
+    print(f"  Latency ms: min={latency['min']:.3f} mean={latency['mean']:.3f} max={latency['max']:.3f}")
+    print("              " + " ".join(f"p{p:g}={latency[f'p{p:g}']:.3f}" for p in BENCH_PERCENTILES))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Template Rendering Benchmark
+
+Measures the per-message cost of turning message data into wire-format bytes:
+
+- ``format``:  ``TEMPLATE.format(**data)`` from a merged kwargs dict, then newline
+  rewriting and UTF-8 encoding (the previous path)
+- ``mapping``: ``MessageTemplate.render_mapping(data)``
+- ``tuple``:   ``MessageTemplate.render(values)`` from a fixed-order tuple
+
+and the cost of escaping a report paragraph with ``escape_hl7_text`` versus
+single-pass ``str.translate`` and regex alternatives. Data generation (Faker,
+random) is excluded.
+"""
+import re
+import argparse
+import timeit
+
+from faker import Faker
+
+from sample_data.templates import (
+    ORM_O01_TEMPLATE, ORU_R01_TEMPLATE, ADT_A08_TEMPLATE, ADT_A40_TEMPLATE, ACK_TEMPLATE,
+    ORM_O01, ORU_R01, ADT_A08, ADT_A40, ACK, FREE_TEXT_FIELDS, escape_hl7_text
+)
+
+TEMPLATES = {
+    'ORM^O01': (ORM_O01_TEMPLATE, ORM_O01),
+    'ORU^R01': (ORU_R01_TEMPLATE, ORU_R01),
+    'ADT^A08': (ADT_A08_TEMPLATE, ADT_A08),
+    'ADT^A40': (ADT_A40_TEMPLATE, ADT_A40),
+    'ACK': (ACK_TEMPLATE, ACK),
+}
+
+# Single-pass alternatives to the chained replaces in escape_hl7_text
+ESCAPES = {'\\': '\\E\\', '|': '\\F\\', '^': '\\S\\', '&': '\\T\\', '~': '\\R\\',
+           '\r\n': '\\X0D\\\\X0A\\', '\n': '\\X0D\\\\X0A\\'}
+TRANSLATION = str.maketrans({char: escape for char, escape in ESCAPES.items() if len(char) == 1})
+SPECIAL_CHARS = re.compile(r'\r\n|[\\|^&~\n]')
+
+def translate_escape(text):
+    return text.replace('\r\n', '\n').translate(TRANSLATION)
+
+def regex_escape(text):
+    return SPECIAL_CHARS.sub(lambda match: ESCAPES[match.group()], text)
+
+def format_render(template, data):
+    """Previous rendering path: str.format from a kwargs dict, then convert to wire bytes"""
+    data = dict(data)
+    for field in FREE_TEXT_FIELDS:
+        if field in data:
+            data[field] = escape_hl7_text(data[field])
+    return template.format(**data).strip('\n').replace('\n', '\r').encode('utf-8') + b'\r'
+
+def sample_data(fields, seed=0):
+    """Realistic values for every field of a template"""
+    fake = Faker()
+    fake.seed_instance(seed)
+    data = {field: fake.bothify('??##???') for field in fields}
+    data['datetime'] = '20240101120000'
+    data['patient_name'] = f"{fake.last_name()}^{fake.first_name()}"
+    for field in FREE_TEXT_FIELDS:
+        if field in data:
+            data[field] = fake.paragraph(nb_sentences=3) + " Findings: A & B | C^D."
+    return data
+
+def per_call(function, number, repeat):
+    """Best time per call in microseconds"""
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number * 1e6
+
+def run(number, repeat):
+    print(f"{'template':<10}{'format us':>12}{'mapping us':>12}{'tuple us':>12}{'speedup':>10}")
+    for name, (template, compiled) in TEMPLATES.items():
+        data = sample_data(compiled.fields)
+        values = tuple(data[field] for field in compiled.fields)
+        assert format_render(template, data) == compiled.render(values)
+        legacy = per_call(lambda: format_render(template, data), number, repeat)
+        mapping = per_call(lambda: compiled.render_mapping(data), number, repeat)
+        ordered = per_call(lambda: compiled.render(values), number, repeat)
+        print(f"{name:<10}{legacy:>12.2f}{mapping:>12.2f}{ordered:>12.2f}{legacy / ordered:>9.1f}x")
+
+    text = sample_data(['report_text'])['report_text']
+    print(f"\nEscaping a {len(text)}-character report:")
+    for name, function in (('escape_hl7_text', escape_hl7_text), ('str.translate', translate_escape),
+                           ('re.sub', regex_escape)):
+        assert function(text) == escape_hl7_text(text)
+        print(f"  {name:<16}{per_call(lambda: function(text), number, repeat):>8.2f} us")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark compiled HL7 message templates')
+    parser.add_argument('--number', type=int, default=20000, help='Renders per timing run')
+    parser.add_argument('--repeat', type=int, default=5, help='Timing runs per measurement (the best is reported)')
+    args = parser.parse_args()
+    run(args.number, args.repeat)
+
+if __name__ == "__main__":
+    main()
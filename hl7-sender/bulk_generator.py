@@ -0,0 +1,239 @@
+"""
+Bulk HL7 v2.3 Message Generator
+
+Fast path for generating very large corpora. Faker is only used up front to build
+pools of names and free text; every per-message value (IDs, timestamps, enum choices,
+pool picks) is then drawn for a whole batch at once with NumPy, and messages are
+rendered as wire-format bytes from the compiled templates in ``sample_data/templates.py``.
+
+Given the same seed and base time, a BulkGenerator produces the same corpus.
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+from faker import Faker
+
+from generate_hl7 import modality_procedures, INSTITUTION_NAMES, MESSAGE_TYPES
+from sample_data.templates import (
+    ORM_O01_TEMPLATE, ORU_R01_TEMPLATE, ADT_A08_TEMPLATE, ADT_A40_TEMPLATE, MessageTemplate, escape_hl7_text,
+    SENDING_APPLICATIONS, SENDING_FACILITIES, RECEIVING_APPLICATIONS, RECEIVING_FACILITIES,
+    PATIENT_CLASSES, GENDER_CODES, ORDER_CONTROLS, MODALITY_CODES,
+    REPORT_FORMATS, REPORT_STATUSES, PRIORITIES
+)
+
+DEFAULT_POOL_SIZE = 1000
+DEFAULT_BATCH_SIZE = 10000
+
+# Numeric fields and their fixed prefixes. These columns hold plain integers and the
+# prefix is baked into the compiled template, which avoids building a string per value.
+NUMERIC_FIELDS = {
+    'patient_id': '',
+    'patient_id_new': '',
+    'patient_id_old': '',
+    'admission_id': 'ADM',
+    'radiologist_id': 'RAD',
+    'accession_number': 'ACC.',
+    'sps_id': 'SPS',
+    'rp_id': 'RP',
+    'ss_name': 'SS',
+    'ss_aetitle': 'AETITLE',
+    'sps_location': 'ROOM',
+    'study_instance_uid': '1.2.826.0.1.3680043.',
+    'patient_weight': '',
+    'study_id': 'STD',
+}
+
+# Integer conversions with the prefixes baked in
+CONVERSIONS = {field: prefix.replace('%', '%%') + '%d' for field, prefix in NUMERIC_FIELDS.items()}
+
+# Free-text pools are escaped once when they are built, not per message
+COMPILED_TEMPLATES = {
+    'orm': MessageTemplate(ORM_O01_TEMPLATE, CONVERSIONS, free_text=()),
+    'oru': MessageTemplate(ORU_R01_TEMPLATE, CONVERSIONS, free_text=()),
+    'adt_a08': MessageTemplate(ADT_A08_TEMPLATE, CONVERSIONS, free_text=()),
+    'adt_a40': MessageTemplate(ADT_A40_TEMPLATE, CONVERSIONS, free_text=()),
+}
+
+class BulkGenerator:
+    """Generates batches of HL7 messages with vectorized random draws"""
+
+    def __init__(self, seed=None, pool_size=DEFAULT_POOL_SIZE, base_time=None):
+        self.rng = np.random.default_rng(seed)
+        self.base_time = base_time or datetime.now()
+
+        fake = Faker()
+        fake.seed_instance(seed)
+        self.last_names = self._pool([fake.last_name() for _ in range(pool_size)])
+        self.sentences = self._pool([escape_hl7_text(fake.sentence(nb_words=6)) for _ in range(pool_size)])
+        self.paragraphs = self._pool([escape_hl7_text(fake.paragraph(nb_sentences=3))
+                                      for _ in range(pool_size)])
+
+        # First names are drawn from the pool matching the patient's gender
+        first_names = {
+            'M': [fake.first_name_male() for _ in range(pool_size)],
+            'F': [fake.first_name_female() for _ in range(pool_size)],
+        }
+        neutral = [fake.first_name() for _ in range(pool_size)]
+        self.first_names = self._grouped([first_names.get(g, neutral) for g in GENDER_CODES])
+
+        # Scheduled step / requested procedure descriptions grouped by modality
+        procedures = [modality_procedures(m) for m in MODALITY_CODES]
+        self.sps_descriptions = self._grouped([[p[0] for p in group] for group in procedures])
+        self.rp_descriptions = self._grouped([[p[1] for p in group] for group in procedures])
+
+        # Dates of birth for ages 18-90, indexed by age in days
+        today = np.datetime64(self.base_time.date(), 'D')
+        ages = np.arange(18 * 365, 90 * 365 + 1).astype('timedelta64[D]')
+        self.dobs = self._pool([d.replace('-', '') for d in (today - ages).astype(str).tolist()])
+
+        self._datetime_tables = {}
+
+    @staticmethod
+    def _pool(values):
+        """Store values in an object array for fast fancy indexing"""
+        return np.array(values, dtype=object)
+
+    @classmethod
+    def _grouped(cls, groups):
+        """Flatten groups of options into ``(values, offsets, lengths)``"""
+        lengths = np.array([len(group) for group in groups])
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        return cls._pool([value for group in groups for value in group]), offsets, lengths
+
+    def _choice(self, options, n):
+        """Draw ``n`` values uniformly from a sequence or pool"""
+        pool = options if isinstance(options, np.ndarray) else self._pool(options)
+        return pool[self.rng.integers(0, len(pool), n)].tolist()
+
+    def _grouped_choice(self, grouped, group_index, uniform=None):
+        """Draw one value per row from the group selected by ``group_index``"""
+        values, offsets, lengths = grouped
+        if uniform is None:
+            uniform = self.rng.random(len(group_index))
+        picks = offsets[group_index] + (uniform * lengths[group_index]).astype(np.int64)
+        return values[picks].tolist()
+
+    def _numbers(self, low, high, n):
+        """Draw ``n`` integers in ``[low, high]`` (prefixes are added by the template)"""
+        return self.rng.integers(low, high + 1, n).tolist()
+
+    def _message_ids(self, n):
+        """Draw ``n`` message control IDs (MSG + 8 hex digits)"""
+        return ['MSG%08X' % x for x in self.rng.integers(0, 1 << 32, n, dtype=np.uint64).tolist()]
+
+    def _datetimes(self, past_days, n):
+        """Draw ``n`` timestamps that are a whole number of days before the base time"""
+        table = self._datetime_tables.get(past_days)
+        if table is None:
+            table = self._pool([(self.base_time - timedelta(days=d)).strftime('%Y%m%d%H%M%S')
+                                for d in range(past_days + 1)])
+            self._datetime_tables[past_days] = table
+        return self._choice(table, n)
+
+    def _header_columns(self, n):
+        return {
+            'sending_app': self._choice(SENDING_APPLICATIONS, n),
+            'sending_facility': self._choice(SENDING_FACILITIES, n),
+            'receiving_app': self._choice(RECEIVING_APPLICATIONS, n),
+            'receiving_facility': self._choice(RECEIVING_FACILITIES, n),
+            'datetime': self._datetimes(1, n),
+            'message_id': self._message_ids(n),
+        }
+
+    def _patient_columns(self, n):
+        gender_index = self.rng.integers(0, len(GENDER_CODES), n)
+        first_names = self._grouped_choice(self.first_names, gender_index)
+        last_names = self._choice(self.last_names, n)
+        ages = self.rng.integers(0, len(self.dobs), n)
+        return {
+            'patient_id': self._numbers(100000, 999999, n),
+            'patient_name': [f"{last}^{first}" for last, first in zip(last_names, first_names)],
+            'dob': self.dobs[ages].tolist(),
+            'gender': self._pool(GENDER_CODES)[gender_index].tolist(),
+            'admission_id': self._numbers(100000, 999999, n),
+        }
+
+    def _physician_columns(self, n):
+        return {
+            'referring_physician': self._choice(self.last_names, n),
+            'requesting_physician': self._choice(self.last_names, n),
+            'performing_physician': self._choice(self.last_names, n),
+            'radiologist_id': self._numbers(1000, 9999, n),
+            'radiologist_name': self._choice(self.last_names, n),
+        }
+
+    def _study_columns(self, n):
+        modality_index = self.rng.integers(0, len(MODALITY_CODES), n)
+        uniform = self.rng.random(n)
+        sps_descriptions = self._grouped_choice(self.sps_descriptions, modality_index, uniform)
+        return {
+            'accession_number': self._numbers(100000, 999999, n),
+            'sps_id': self._numbers(10000, 99999, n),
+            'sps_description': sps_descriptions,
+            'rp_id': self._numbers(10000, 99999, n),
+            'rp_description': self._grouped_choice(self.rp_descriptions, modality_index, uniform),
+            'ss_name': self._numbers(100, 999, n),
+            'ss_aetitle': self._numbers(1, 9, n),
+            'sps_location': self._numbers(1, 20, n),
+            'modality': self._pool(MODALITY_CODES)[modality_index].tolist(),
+            'priority': self._choice(PRIORITIES, n),
+            'reason_for_study': self._choice(self.sentences, n),
+            'sps_start_datetime': self._datetimes(7, n),
+            'institution_name': self._choice(INSTITUTION_NAMES, n),
+            'study_instance_uid': self._numbers(1000000, 9999999, n),
+            'patient_weight': self._numbers(50, 120, n),
+            'study_id': self._numbers(10000, 99999, n),
+            'study_description': sps_descriptions,
+        }
+
+    def _report_columns(self, n):
+        return {
+            'report_format': self._choice(REPORT_FORMATS, n),
+            'report_status': self._choice(REPORT_STATUSES, n),
+            'report_date': self._datetimes(5, n),
+            'report_text': self._choice(self.paragraphs, n),
+        }
+
+    def generate(self, msg_type, n):
+        """Generate ``n`` messages of one type (orm, oru, adt_a08, adt_a40)"""
+        columns = self._header_columns(n)
+        if msg_type == 'orm':
+            columns['order_control'] = self._choice(ORDER_CONTROLS, n)
+            columns['patient_class'] = self._choice(PATIENT_CLASSES, n)
+            columns.update(self._patient_columns(n))
+            columns.update(self._physician_columns(n))
+            columns.update(self._study_columns(n))
+        elif msg_type == 'oru':
+            columns['order_control'] = ['RE'] * n  # Results
+            columns['patient_class'] = self._choice(PATIENT_CLASSES, n)
+            columns.update(self._patient_columns(n))
+            columns.update(self._physician_columns(n))
+            columns.update(self._study_columns(n))
+            columns.update(self._report_columns(n))
+        elif msg_type == 'adt_a08':
+            columns.update(self._patient_columns(n))
+        elif msg_type == 'adt_a40':
+            columns['patient_id_new'] = self._numbers(100000, 999999, n)
+            columns['patient_id_old'] = self._numbers(100000, 999999, n)
+        else:
+            raise ValueError(f"Unknown message type: {msg_type}")
+
+        template = COMPILED_TEMPLATES[msg_type]
+        fmt = template.format
+        return [(fmt % row).encode('utf-8') for row in zip(*(columns[field] for field in template.placeholders))]
+
+    def generate_batch(self, message_types, n):
+        """Generate ``n`` messages of each type, interleaved like the standard generator"""
+        batches = [self.generate(msg_type, n) for msg_type in message_types]
+        return [message for group in zip(*batches) for message in group]
+
+def generate_bulk(message_types, count, batch_size=DEFAULT_BATCH_SIZE, seed=None, pool_size=DEFAULT_POOL_SIZE,
+                  base_time=None):
+    """Yield batches of messages until ``count`` messages of each type were generated"""
+    message_types = [t for t in message_types if t in MESSAGE_TYPES]
+    generator = BulkGenerator(seed, pool_size, base_time)
+    remaining = count
+    while remaining > 0:
+        n = min(batch_size, remaining)
+        yield generator.generate_batch(message_types, n)
+        remaining -= n
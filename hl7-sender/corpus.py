@@ -0,0 +1,586 @@
+"""
+Streaming HL7 corpus reader and writers
+
+Reads HL7 messages lazily from a memory-mapped file so that sending can start
+immediately and memory use stays flat regardless of the corpus size. Four on-disk
+layouts are understood, each optionally gzip or zstd compressed:
+
+- ``blank-line``: segments separated by newlines, messages by a blank line
+  (the format written by generate_hl7.py)
+- ``segmented``:  wire format, segments terminated by ``\\r`` and each message
+  starting at its own MSH segment
+- ``mllp``:       messages already wrapped in MLLP frames (``\\x0b...\\x1c\\x0d``)
+- ``batch``:      an HL7 batch file, wire format with the messages wrapped in
+  FHS/BHS headers and BTS/FTS trailers (read as the messages it contains)
+
+Every message is yielded as ``bytes`` in wire format (``\\r``-separated segments,
+no MLLP framing), ready to be framed and sent.
+
+The matching writers stream generated messages (wire-format bytes, as rendered by
+``sample_data.templates``) to disk in any of these layouts, so a corpus can be
+written once in wire or MLLP format and sent without per-message conversion.
+
+An ``indexed`` corpus is an uncompressed MLLP corpus plus a binary index file
+(``<corpus>.idx``) holding the offset, length, message type (MSH-9) and control ID
+(MSH-10) of every frame. It is read like any MLLP corpus, but the sender can also map
+it and push frames straight from the page cache, and select subsets from the index
+without touching the messages.
+"""
+import os
+import gzip
+import functools
+import mmap
+import struct
+from collections import namedtuple
+
+from hl7_message import HL7Message
+from mllp_codec import MLLP_START_BLOCK, MLLP_END_BLOCK, EncodedFrame, encode_frame
+from sample_data.templates import FHS, BHS, BTS, FTS
+
+CORPUS_FORMATS = ['auto', 'blank-line', 'segmented', 'mllp', 'batch']
+COMPRESSIONS = ['none', 'gzip', 'zstd']
+
+# File suffixes and magic numbers of the supported compressions
+COMPRESSION_SUFFIXES = {'.gz': 'gzip', '.zst': 'zstd'}
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Size of the decompressed chunks read from compressed corpora
+READ_CHUNK_SIZE = 1024 * 1024
+
+# How much of the file to inspect when detecting its format
+DETECT_WINDOW = 64 * 1024
+
+# Segments of the HL7 batch protocol envelope
+ENVELOPE_SEGMENTS = (b'FHS|', b'BHS|', b'BTS|', b'FTS|')
+DEFAULT_HL7_BATCH = 100  # messages per BHS/BTS batch in batch files
+
+# Index of an indexed corpus: a header (magic, record count) followed by one
+# fixed-size record per frame (offset, length, MSH-9, MSH-10; text NUL-padded)
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = b'HL7IDX02'  # 01 indexes could hold silently truncated MSH-9/MSH-10
+INDEX_HEADER = struct.Struct('<8sQ')
+INDEX_TYPE_SIZE = 16  # bytes of MSH-9 an index record holds
+INDEX_CONTROL_ID_SIZE = 20  # bytes of MSH-10
+INDEX_RECORD = struct.Struct(f'<QI{INDEX_TYPE_SIZE}s{INDEX_CONTROL_ID_SIZE}s')
+
+def detect_format(data):
+    """Guess the layout of a corpus from its first bytes"""
+    # bytes.lstrip() would also strip <VT>, so only skip ordinary whitespace
+    head = data[:DETECT_WINDOW].lstrip(b' \t\r\n')
+    if head.startswith(MLLP_START_BLOCK):
+        return 'mllp'
+    if head.startswith(ENVELOPE_SEGMENTS):
+        return 'batch'
+    # A bare \r (not part of \r\n) means segments are in wire format
+    if head.count(b'\r') > head.count(b'\r\n'):
+        return 'segmented'
+    return 'blank-line'
+
+def _iter_mllp(data):
+    """Yield the payload of each MLLP frame"""
+    pos = 0
+    while True:
+        start = data.find(MLLP_START_BLOCK, pos)
+        if start < 0:
+            return
+        end = data.find(MLLP_END_BLOCK, start + 1)
+        if end < 0:
+            # Unterminated trailing frame: treat the rest of the file as the message
+            end = len(data)
+        message = data[start + 1:end].strip()
+        if message:
+            yield message
+        pos = end + len(MLLP_END_BLOCK)
+
+def _iter_segmented(data):
+    """Yield messages from a ``\\r``-segmented stream, splitting at each MSH segment"""
+    size = len(data)
+    pos = data.find(b'MSH|')
+    while 0 <= pos < size:
+        # The next message starts at an MSH segment following a \r or \n terminator
+        nxt = data.find(b'MSH|', pos + 4)
+        while nxt >= 0 and data[nxt - 1] not in (0x0d, 0x0a):
+            nxt = data.find(b'MSH|', nxt + 4)
+        end = size if nxt < 0 else nxt
+        message = data[pos:end].strip()
+        if message:
+            if b'\n' in message:
+                message = message.replace(b'\r\n', b'\r').replace(b'\n', b'\r')
+            yield message
+        pos = end
+
+def strip_envelope(message):
+    """Cut a message off at the first batch envelope segment following it"""
+    end = len(message)
+    for segment in ENVELOPE_SEGMENTS:
+        pos = message.find(b'\r' + segment, 0, end)
+        if pos >= 0:
+            end = pos
+    return message[:end]
+
+def iter_batch_messages(data):
+    """Yield the messages of an HL7 batch file or batch frame, without the FHS/BHS/BTS/FTS segments"""
+    for message in _iter_segmented(data):
+        yield strip_envelope(message)
+
+def _blank_line_separator(data):
+    """Message separator of a blank-line corpus (LF or CRLF line endings)"""
+    return b'\r\n\r\n' if b'\r\n' in data[:DETECT_WINDOW] else b'\n\n'
+
+def _iter_blank_line(data, separator=None):
+    """Yield messages separated by blank lines, converting newlines to ``\\r``"""
+    size = len(data)
+    separator = separator or _blank_line_separator(data)
+    pos = 0
+    while pos < size:
+        end = data.find(separator, pos)
+        if end < 0:
+            end = size
+        message = data[pos:end].strip()
+        if message:
+            if b'\n' in message:
+                message = message.replace(b'\r\n', b'\r').replace(b'\n', b'\r')
+            yield message
+        pos = end + len(separator)
+
+_READERS = {
+    'mllp': _iter_mllp,
+    'segmented': _iter_segmented,
+    'blank-line': _iter_blank_line,
+    'batch': iter_batch_messages,
+}
+
+def detect_compression(file_path):
+    """Return 'gzip', 'zstd' or 'none' from a file's magic number or suffix"""
+    with open(file_path, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return COMPRESSION_SUFFIXES.get(os.path.splitext(file_path)[1], 'none')
+
+def _import_zstandard():
+    """Import the optional zstandard package"""
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("zstd compression requires the 'zstandard' package (pip install zstandard)")
+    return zstandard
+
+def check_compression(compression):
+    """Raise ValueError if a compression is unknown or its optional package is missing"""
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression: {compression}")
+    if compression == 'zstd':
+        _import_zstandard()
+
+def _open_decompressed(file_path, compression):
+    """Open a compressed corpus as a binary stream of decompressed bytes"""
+    if compression == 'gzip':
+        return gzip.open(file_path, 'rb')
+    zstandard = _import_zstandard()
+    return zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'), closefd=True)
+
+def _last_boundary(buffer, fmt, separator):
+    """Offset up to which ``buffer`` holds only complete messages"""
+    if fmt == 'mllp':
+        end = buffer.rfind(MLLP_END_BLOCK)
+        return end + len(MLLP_END_BLOCK) if end >= 0 else 0
+    if fmt == 'blank-line':
+        end = buffer.rfind(separator)
+        return end + len(separator) if end >= 0 else 0
+    # segmented and batch: everything before the last MSH that starts a segment is complete
+    start = buffer.rfind(b'MSH|')
+    while start > 0 and buffer[start - 1] not in (0x0d, 0x0a):
+        start = buffer.rfind(b'MSH|', 0, start)
+    return max(start, 0)
+
+def _iter_compressed(file_path, compression, fmt):
+    """Yield messages from a compressed corpus, decompressing it chunk by chunk"""
+    with _open_decompressed(file_path, compression) as stream:
+        buffer = bytearray()
+        reader = separator = None
+        while True:
+            chunk = stream.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            if reader is None:
+                # The format and line endings are detected from the first chunk
+                if fmt == 'auto':
+                    fmt = detect_format(chunk)
+                separator = _blank_line_separator(chunk)
+                reader = _READERS[fmt]
+                if fmt == 'blank-line':
+                    reader = functools.partial(_iter_blank_line, separator=separator)
+            buffer += chunk
+            boundary = _last_boundary(buffer, fmt, separator)
+            if boundary:
+                complete = bytes(buffer[:boundary])
+                del buffer[:boundary]
+                yield from reader(complete)
+        if buffer:
+            yield from reader(bytes(buffer))
+
+def iter_hl7_messages(file_path, fmt='auto'):
+    """Lazily yield wire-format HL7 messages (bytes) from a corpus file
+
+    Uncompressed files are memory-mapped, so only the message currently being
+    yielded is copied into process memory. gzip and zstd corpora are decompressed
+    in chunks.
+    """
+    if fmt not in CORPUS_FORMATS:
+        raise ValueError(f"Unknown corpus format: {fmt}")
+
+    compression = detect_compression(file_path)
+    if compression != 'none':
+        yield from _iter_compressed(file_path, compression, fmt)
+        return
+
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if hasattr(data, 'madvise'):
+                data.madvise(mmap.MADV_SEQUENTIAL)
+            if fmt == 'auto':
+                fmt = detect_format(data)
+            yield from _READERS[fmt](data)
+
+def compression_for_path(file_path):
+    """Compression implied by an output file name"""
+    return COMPRESSION_SUFFIXES.get(os.path.splitext(file_path)[1], 'none')
+
+def _open_compressed(file_path, compression):
+    """Open an output file, compressing it if requested"""
+    if compression == 'gzip':
+        return gzip.open(file_path, 'wb', compresslevel=6)
+    if compression == 'zstd':
+        zstandard = _import_zstandard()
+        return zstandard.ZstdCompressor(level=3).stream_writer(open(file_path, 'wb'), closefd=True)
+    return open(file_path, 'wb', buffering=READ_CHUNK_SIZE)
+
+def compress_bytes(data, compression):
+    """Compress a standalone block (a valid member when appended to a compressed file)"""
+    if compression == 'gzip':
+        return gzip.compress(data)
+    if compression == 'zstd':
+        return _import_zstandard().ZstdCompressor(level=3).compress(data)
+    return data
+
+class CorpusWriter:
+    """Streams messages to a corpus file in one of the corpus formats
+
+    Subclasses define how a message is encoded and what separates two messages.
+    Messages are written as they are produced, so memory use stays constant.
+    """
+
+    fmt = None
+    separator = b''
+
+    def __init__(self, file_path, compression=None):
+        self.file_path = file_path
+        self.compression = compression or compression_for_path(file_path)
+        self.file = _open_compressed(file_path, self.compression)
+        self.count = 0
+
+    def encode(self, message):
+        """Encode one generated wire-format message for this format"""
+        raise NotImplementedError
+
+    def write(self, message):
+        """Write one message"""
+        if self.count and self.separator:
+            self.file.write(self.separator)
+        self.file.write(self.encode(message))
+        self.count += 1
+
+    def write_many(self, messages):
+        """Write a batch of messages with a single write call"""
+        encoded = [self.encode(message) for message in messages]
+        if not encoded:
+            return
+        if self.count and self.separator:
+            self.file.write(self.separator)
+        self.file.write(self.separator.join(encoded))
+        self.count += len(encoded)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class BlankLineWriter(CorpusWriter):
+    """Newline-separated segments, messages separated by a blank line (the default format)"""
+
+    fmt = 'blank-line'
+    separator = b'\n\n'
+
+    def encode(self, message):
+        return message.replace(b'\r', b'\n')
+
+class SegmentedWriter(CorpusWriter):
+    """Wire format: \\r-terminated segments, one message after another"""
+
+    fmt = 'segmented'
+
+    def encode(self, message):
+        return message
+
+class MLLPWriter(CorpusWriter):
+    """Wire-format messages wrapped in MLLP frames, ready to be sent as-is"""
+
+    fmt = 'mllp'
+
+    def encode(self, message):
+        return encode_frame(message.rstrip(b'\r'))
+
+def pack_index_record(offset, length, message_type, control_id):
+    """Pack one index record, raising ``ValueError`` if MSH-9 or MSH-10 does not fit
+
+    A control ID cut short would never match the MSA-2 of its ACK.
+    """
+    if len(message_type) > INDEX_TYPE_SIZE:
+        raise ValueError(f"MSH-9 {message_type.decode('utf-8', errors='replace')!r} is longer than the "
+                         f"{INDEX_TYPE_SIZE} bytes an index record holds")
+    if len(control_id) > INDEX_CONTROL_ID_SIZE:
+        raise ValueError(f"MSH-10 {control_id.decode('utf-8', errors='replace')!r} is longer than the "
+                         f"{INDEX_CONTROL_ID_SIZE} bytes an index record holds")
+    return INDEX_RECORD.pack(offset, length, message_type, control_id)
+
+class IndexedMLLPWriter(MLLPWriter):
+    """MLLP frames plus an offset/length/type/control ID index in ``<file>.idx``
+
+    The corpus itself is a plain MLLP corpus, so it must not be compressed: the
+    index offsets point straight into the file.
+    """
+
+    fmt = 'indexed'
+
+    def __init__(self, file_path, compression=None):
+        if (compression or compression_for_path(file_path)) != 'none':
+            raise ValueError("Indexed corpora cannot be compressed")
+        super().__init__(file_path, 'none')
+        self.index = open(index_path(file_path), 'wb', buffering=READ_CHUNK_SIZE)
+        # The record count is filled in on close
+        self.index.write(INDEX_HEADER.pack(INDEX_MAGIC, 0))
+        self.offset = 0
+
+    def _frame(self, message):
+        """Frame a message and append its index record
+
+        Raises ``ValueError`` if its MSH-9 or MSH-10 does not fit the index
+        record: a truncated control ID would never match its ACK.
+        """
+        header = HL7Message(message)
+        frame = self.encode(message)
+        self.index.write(pack_index_record(self.offset, len(frame), header.raw_field('MSH', 9) or b'',
+                                           header.raw_field('MSH', 10) or b''))
+        self.offset += len(frame)
+        return frame
+
+    def write(self, message):
+        self.file.write(self._frame(message))
+        self.count += 1
+
+    def write_many(self, messages):
+        frames = [self._frame(message) for message in messages]
+        if not frames:
+            return
+        self.file.write(b''.join(frames))
+        self.count += len(frames)
+
+    def close(self):
+        self.file.close()
+        self.index.seek(0)
+        self.index.write(INDEX_HEADER.pack(INDEX_MAGIC, self.count))
+        self.index.close()
+
+def envelope_header(message):
+    """``(sending app, sending facility, receiving app, receiving facility, MSH-7, MSH-10)`` of a message"""
+    header = HL7Message(message)
+    return tuple(header.field('MSH', number, '') for number in (3, 4, 5, 6, 7, 10))
+
+class HL7BatchWriter(SegmentedWriter):
+    """HL7 batch file: wire-format messages in BHS/BTS batches of ``batch_size`` inside FHS/FTS
+
+    The headers take their applications, facilities and time from the first
+    message they wrap, and their control IDs from its MSH-10 (``F``/``B``
+    prefixed), so the output is as reproducible as the messages.
+    """
+
+    fmt = 'batch'
+
+    def __init__(self, file_path, compression=None, batch_size=DEFAULT_HL7_BATCH):
+        super().__init__(file_path, compression)
+        if batch_size < 1:
+            raise ValueError("HL7 batches need at least one message")
+        self.batch_size = batch_size
+        self.batches = 0
+        self.in_batch = 0
+
+    def write(self, message):
+        if not self.in_batch:
+            header = envelope_header(message)
+            if not self.count:
+                self.file.write(FHS.render(header[:5] + ('F' + header[5], '')))
+            self.file.write(BHS.render(header[:5] + ('B' + header[5], '')))
+            self.batches += 1
+        self.file.write(message.rstrip(b'\r') + b'\r')
+        self.count += 1
+        self.in_batch += 1
+        if self.in_batch == self.batch_size:
+            self.file.write(BTS.render((self.in_batch,)))
+            self.in_batch = 0
+
+    def write_many(self, messages):
+        for message in messages:
+            self.write(message)
+
+    def close(self):
+        if self.in_batch:
+            self.file.write(BTS.render((self.in_batch,)))
+        if self.count:
+            self.file.write(FTS.render((self.batches,)))
+        super().close()
+
+CORPUS_WRITERS = {
+    'blank-line': BlankLineWriter,
+    'segmented': SegmentedWriter,
+    'mllp': MLLPWriter,
+    'indexed': IndexedMLLPWriter,
+    'batch': HL7BatchWriter,
+}
+
+def open_corpus_writer(file_path, fmt='blank-line', compression=None, **options):
+    """Create a writer for ``fmt``; compression defaults to the file name's suffix
+
+    ``options`` go to the writer, e.g. ``batch_size`` for HL7 batch files.
+    """
+    if fmt not in CORPUS_WRITERS:
+        raise ValueError(f"Unknown corpus format: {fmt}")
+    return CORPUS_WRITERS[fmt](file_path, compression, **options)
+
+def shard_separator(fmt, compression):
+    """Bytes to insert between two shard files of a corpus when merging them"""
+    separator = CORPUS_WRITERS[fmt].separator
+    return compress_bytes(separator, compression) if separator else b''
+
+def index_path(corpus_path):
+    """Path of the index file belonging to an indexed corpus"""
+    return corpus_path + INDEX_SUFFIX
+
+def has_index(corpus_path):
+    """True if ``corpus_path`` is an indexed corpus"""
+    return os.path.exists(index_path(corpus_path))
+
+def _index_text(value):
+    return value.rstrip(b'\0').decode('utf-8', errors='replace')
+
+IndexRecord = namedtuple('IndexRecord', 'offset length message_type control_id')
+
+class CorpusIndex:
+    """Read-only view of an indexed corpus' index file
+
+    The index is memory-mapped and records are unpacked as they are iterated.
+    Message type filters are compared against the raw index fields, so selecting
+    a subset neither reads nor decodes the messages themselves.
+    """
+
+    def __init__(self, corpus_path):
+        self.path = index_path(corpus_path)
+        with open(self.path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) < INDEX_HEADER.size:
+            self.data.close()
+            raise ValueError(f"Truncated corpus index: {self.path}")
+        magic, self.count = INDEX_HEADER.unpack_from(self.data)
+        if magic == b'HL7IDX01':
+            self.data.close()
+            raise ValueError(f"Corpus index {self.path} is from an older version and may hold truncated "
+                             f"control IDs; regenerate the corpus or send it with --no-index")
+        if magic != INDEX_MAGIC or len(self.data) < INDEX_HEADER.size + self.count * INDEX_RECORD.size:
+            self.data.close()
+            raise ValueError(f"Invalid corpus index: {self.path}")
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        offset, length, message_type, control_id = INDEX_RECORD.unpack_from(
+            self.data, INDEX_HEADER.size + i * INDEX_RECORD.size)
+        return IndexRecord(offset, length, _index_text(message_type), _index_text(control_id))
+
+    def __iter__(self):
+        return self.select()
+
+    def _records(self):
+        """Yield raw ``(offset, length, message_type, control_id)`` tuples"""
+        end = INDEX_HEADER.size + self.count * INDEX_RECORD.size
+        view = memoryview(self.data)[INDEX_HEADER.size:end]
+        records = INDEX_RECORD.iter_unpack(view)
+        try:
+            yield from records
+        finally:
+            # Release the buffer so the index can be closed even if iteration stopped early
+            del records
+            view.release()
+
+    def select(self, message_types=None):
+        """Yield the records, optionally only those whose MSH-9 is in ``message_types``"""
+        # Pad the wanted types like the index fields so records are compared as-is
+        wanted = {t.encode('utf-8').ljust(INDEX_TYPE_SIZE, b'\0') for t in message_types or ()}
+        for offset, length, message_type, control_id in self._records():
+            if not wanted or message_type in wanted:
+                yield IndexRecord(offset, length, _index_text(message_type), _index_text(control_id))
+
+    def close(self):
+        self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def iter_indexed_frames(corpus_path, message_types=None):
+    """Yield an :class:`EncodedFrame` per selected message of an indexed corpus
+
+    Frames are memoryview slices of the mapped corpus, so they are sent without
+    being copied, re-split or re-encoded.
+    """
+    with CorpusIndex(corpus_path) as index, open(corpus_path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(data)
+        try:
+            for record in index.select(message_types):
+                yield EncodedFrame(view[record.offset:record.offset + record.length],
+                                   record.control_id, record.message_type)
+        finally:
+            view.release()
+            try:
+                data.close()
+            except BufferError:
+                pass  # a frame is still referenced; the mapping goes away with it
+
+def merge_indexes(corpus_paths, output):
+    """Write the index of ``output``, the concatenation of indexed corpora ``corpus_paths``"""
+    count = 0
+    base = 0
+    with open(index_path(output), 'wb', buffering=READ_CHUNK_SIZE) as out:
+        out.write(INDEX_HEADER.pack(INDEX_MAGIC, 0))
+        for path in corpus_paths:
+            with CorpusIndex(path) as index:
+                for offset, length, message_type, control_id in index._records():
+                    out.write(INDEX_RECORD.pack(base + offset, length, message_type, control_id))
+                count += index.count
+            base += os.path.getsize(path)
+        out.seek(0)
+        out.write(INDEX_HEADER.pack(INDEX_MAGIC, count))
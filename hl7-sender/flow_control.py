@@ -0,0 +1,185 @@
+"""
+Adaptive Flow Control
+
+AIMD (additive increase, multiplicative decrease) controller for the persistent
+MLLP sender. Instead of a fixed ``--delay``, the in-flight window and the send
+rate follow what the receiver can sustain:
+
+- every round (one window's worth of ACKs, at least ``MIN_ROUND``) without
+  trouble the window grows by one message and the rate by ``rate_step``
+  msgs/sec; until the first back-off both double per round instead (slow start)
+- a round whose mean ACK latency rises well above the lowest latency seen
+  (queueing at the receiver), an AE/AR share of the last ~``ERROR_HORIZON`` ACKs
+  above ``error_threshold``, or a message failing without an ACK (timeout, lost
+  connection) multiplies the window by ``decrease_factor`` and caps the rate at
+  that fraction of the throughput just achieved
+
+After a back-off the messages already in flight are not counted against the new
+window, so one congestion episode causes a single decrease. Every decision is
+counted in ``METRICS`` and the controller's summary is printed with the run's.
+"""
+import time
+from collections import Counter, deque
+
+from metrics import METRICS
+from send_log import log
+
+DEFAULT_MAX_WINDOW = 256
+DEFAULT_MIN_RATE = 1.0  # msgs/sec; the rate is never cut below this
+DEFAULT_RATE_STEP = 50.0  # msgs/sec added per round
+DECREASE_FACTOR = 0.5
+ERROR_THRESHOLD = 0.05  # AE/AR share that counts as overload
+ERROR_HORIZON = 100  # ACKs over which the AE/AR share is averaged
+LATENCY_FACTOR = 2.0  # mean round latency over the lowest latency seen that counts as queueing
+LATENCY_SLACK = 0.005  # seconds; latency rises smaller than this are ignored
+MIN_ROUND = 8  # results per round at least, so one slow ACK is not taken for congestion
+RECENT_DECREASES = 10  # back-offs listed in the summary
+
+class AIMDController:
+    """Adjusts an in-flight window and a send rate from ACK outcomes
+
+    Call :meth:`pace` before sending each message and wait as long as it says,
+    keep at most :attr:`window` messages in flight and feed every result to
+    :meth:`record`. ``rate`` is the starting rate in msgs/sec; None sends
+    unpaced until the first back-off. ``target_latency`` (seconds) replaces the
+    latency threshold derived from the lowest latency seen.
+    """
+
+    def __init__(self, window=1, max_window=DEFAULT_MAX_WINDOW, rate=None, min_rate=DEFAULT_MIN_RATE,
+                 rate_step=DEFAULT_RATE_STEP, decrease_factor=DECREASE_FACTOR, error_threshold=ERROR_THRESHOLD,
+                 target_latency=None):
+        self.max_window = max(1, max_window)
+        self._window = float(min(max(1, window), self.max_window))
+        self.rate = rate
+        self.min_rate = min_rate
+        self.rate_step = rate_step
+        self.decrease_factor = decrease_factor
+        self.error_threshold = error_threshold
+        self.target_latency = target_latency
+        self.slow_start = True
+        self.base_latency = None
+        self.error_share = 0.0  # moving average of AE/AR over ACKs
+        self.started = time.perf_counter()
+        self.next_send = self.started
+        self.sent = 0
+        self.completed = 0
+        # Messages sent before the last back-off; their results do not count against the new window
+        self.recover_until = 0
+        self.throughput = None  # msgs/sec over the last completed round
+        self.peak_window = self.window
+        self.decisions = Counter()
+        self.recent = deque(maxlen=RECENT_DECREASES)
+        self._new_round()
+
+    @property
+    def window(self):
+        """Messages that may be in flight"""
+        return int(self._window)
+
+    def _new_round(self):
+        self.round_started = time.perf_counter()
+        self.round_results = 0
+        self.round_latency = 0.0
+        self.round_latencies = 0
+
+    def pace(self):
+        """Take the next send slot and return the seconds to wait for it (0 when unpaced)"""
+        self.sent += 1
+        if self.rate is None:
+            return 0.0
+        now = time.perf_counter()
+        wait = self.next_send - now
+        if wait <= 0:
+            self.next_send = now
+        self.next_send += 1.0 / self.rate
+        return max(wait, 0.0)
+
+    def record(self, ack_code, latency=None):
+        """Account for the outcome of one message; ``ack_code`` is None for a failure without ACK"""
+        self.completed += 1
+        if self.completed <= self.recover_until:
+            if self.completed == self.recover_until:
+                self._new_round()
+            return
+        if ack_code is None:
+            self._decrease('timeout')
+            return
+        self.round_results += 1
+        self.error_share += ((ack_code in ('AE', 'AR')) - self.error_share) / ERROR_HORIZON
+        if latency is not None:
+            self.round_latency += latency
+            self.round_latencies += 1
+            if self.base_latency is None or latency < self.base_latency:
+                self.base_latency = latency
+        if self.round_results >= max(self.window, MIN_ROUND):
+            self._end_round()
+
+    def latency_limit(self):
+        """Mean round latency above which the receiver is taken to be queueing"""
+        if self.target_latency is not None:
+            return self.target_latency
+        if self.base_latency is None:
+            return None
+        return max(self.base_latency * LATENCY_FACTOR, self.base_latency + LATENCY_SLACK)
+
+    def _end_round(self):
+        elapsed = time.perf_counter() - self.round_started
+        if elapsed > 0:
+            self.throughput = self.round_results / elapsed
+        limit = self.latency_limit()
+        if self.error_share > self.error_threshold:
+            self._decrease('errors')
+        elif limit is not None and self.round_latencies and self.round_latency / self.round_latencies > limit:
+            self._decrease('latency')
+        else:
+            self._increase()
+            self._new_round()
+
+    def _increase(self):
+        if self.slow_start:
+            self._window = min(self._window * 2, self.max_window)
+            if self.rate is not None:
+                self.rate *= 2
+        else:
+            self._window = min(self._window + 1, self.max_window)
+            if self.rate is not None:
+                self.rate += self.rate_step
+        self.peak_window = max(self.peak_window, self.window)
+        self.decisions['increase'] += 1
+        METRICS.count('flow_control', 'increase')
+
+    def _decrease(self, reason):
+        before = self.window
+        self.slow_start = False
+        self.recover_until = self.sent
+        self._window = max(1.0, self._window * self.decrease_factor)
+        achieved = self.throughput or self.rate
+        if achieved is not None:
+            self.rate = max(self.min_rate, achieved * self.decrease_factor)
+        self.decisions[reason] += 1
+        METRICS.count('flow_control', reason)
+        self.recent.append((time.perf_counter() - self.started, reason, before, self.window, self.rate))
+        log.info("Flow control: backing off on %s, window %d -> %d, rate %s",
+                 reason, before, self.window, self._format_rate(self.rate))
+        self._new_round()
+
+    @staticmethod
+    def _format_rate(rate):
+        return f"{rate:.1f} msgs/sec" if rate is not None else "unpaced"
+
+    def summary(self):
+        """The controller's decisions as printable lines"""
+        decreases = sum(n for reason, n in self.decisions.items() if reason != 'increase')
+        lines = [
+            f"Flow control: final window {self.window} (peak {self.peak_window}), "
+            f"final rate {self._format_rate(self.rate)}",
+            f"Flow control decisions: {self.decisions['increase']} increases, {decreases} decreases "
+            f"(latency {self.decisions['latency']}, AE/AR {self.decisions['errors']}, "
+            f"timeout {self.decisions['timeout']})",
+        ]
+        limit = self.latency_limit()
+        if limit is not None:
+            lines.append(f"Flow control latency limit: {limit * 1000:.2f} ms")
+        for offset, reason, before, after, rate in self.recent:
+            lines.append(f"  +{offset:.1f}s {reason}: window {before} -> {after}, rate {self._format_rate(rate)}")
+        return lines
@@ -7,47 +7,51 @@ This script generates sample HL7 v2.3 messages following the Medsynapse PACS con
 import os
 import sys
 import random
+import shutil
+import hashlib
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
-import uuid
 import re
 from faker import Faker
+from corpus import (
+    CORPUS_WRITERS, COMPRESSIONS, COMPRESSION_SUFFIXES, DEFAULT_HL7_BATCH,
+    check_compression, compression_for_path, index_path, merge_indexes, open_corpus_writer, shard_separator
+)
 from sample_data.templates import (
-    ORM_O01_TEMPLATE, ORU_R01_TEMPLATE, ADT_A08_TEMPLATE, ADT_A40_TEMPLATE, ACK_TEMPLATE,
+    ORM_O01, ORU_R01, ADT_A08, ADT_A40, ACK,
     SENDING_APPLICATIONS, SENDING_FACILITIES, RECEIVING_APPLICATIONS, RECEIVING_FACILITIES,
     PATIENT_CLASSES, GENDER_CODES, ORDER_CONTROLS, MODALITY_CODES, 
-    REPORT_FORMATS, REPORT_STATUSES, PRIORITIES, ACK_CODES
+    REPORT_FORMATS, REPORT_STATUSES, PRIORITIES, ACK_CODES, escape_hl7_text
 )
 
 # Initialize faker for generating realistic fake data
 fake = Faker()
 
+INSTITUTION_NAMES = ["MAIN HOSPITAL", "IMAGING CENTER", "CLINIC"]
+
+# Reference time for generated timestamps (None means the current time)
+BASE_TIME = None
+
+# Message types that can be requested with --types, in generation order
+MESSAGE_TYPES = ['orm', 'oru', 'adt_a08', 'adt_a40']
+
 def escape_hl7_chars(text):
-    """Escape special HL7 characters in text data"""
-    if not text:
-        return text
-    
-    # Replace special HL7 characters with escape sequences
-    # Field separator | -> \F\
-    # Component separator ^ -> \S\
-    # Subcomponent separator & -> \T\
-    # Repetition separator ~ -> \R\
-    # Escape character \ -> \E\
-    # New line -> \X0D\\X0A\
-    
-    text = text.replace('\\', '\\E\\')
-    text = text.replace('|', '\\F\\')
-    text = text.replace('^', '\\S\\')
-    text = text.replace('&', '\\T\\')
-    text = text.replace('~', '\\R\\')
-    text = text.replace('\r\n', '\\X0D\\\\X0A\\')
-    text = text.replace('\n', '\\X0D\\\\X0A\\')
-    
-    return text
+    """Escape special HL7 characters in text data (see ``escape_hl7_text``)"""
+    return escape_hl7_text(text)
+
+def generate_message_id(prefix="MSG"):
+    """Generate a message control ID with 8 random hex digits"""
+    return f"{prefix}{random.getrandbits(32):08X}"
+
+def set_base_time(base_time):
+    """Use a fixed reference time instead of the current time for generated timestamps"""
+    global BASE_TIME
+    BASE_TIME = base_time
 
 def generate_datetime(past_days=30):
     """Generate a random datetime within the past number of days"""
-    random_date = datetime.now() - timedelta(days=random.randint(0, past_days))
+    random_date = (BASE_TIME or datetime.now()) - timedelta(days=random.randint(0, past_days))
     return random_date.strftime('%Y%m%d%H%M%S')
 
 def generate_patient_data():
@@ -83,27 +87,29 @@ def generate_physician_data():
     }
     return physician_data
 
+def modality_procedures(modality):
+    """Return the possible (scheduled step, requested procedure) descriptions for a modality"""
+    if modality == "CT":
+        steps = ["CT HEAD", "CT CHEST", "CT ABDOMEN", "CT SPINE"]
+        return [(step, f"{step} W/WO CONTRAST") for step in steps]
+    elif modality == "MR":
+        steps = ["MR BRAIN", "MR KNEE", "MR SHOULDER", "MR SPINE"]
+        return [(step, f"{step} W/WO CONTRAST") for step in steps]
+    elif modality == "US":
+        steps = ["US ABDOMEN", "US PELVIS", "US THYROID", "US BREAST"]
+    elif modality == "CR" or modality == "DX":
+        steps = ["XR CHEST", "XR HAND", "XR FOOT", "XR KNEE"]
+    else:
+        steps = [f"{modality} PROCEDURE"]
+    return [(step, step) for step in steps]
+
 def generate_study_data():
     """Generate random study/order data"""
     accession_number = f"ACC.{random.randint(100000, 999999)}"
     modality = random.choice(MODALITY_CODES)
     
     # Create study descriptions based on modality
-    if modality == "CT":
-        sps_description = random.choice(["CT HEAD", "CT CHEST", "CT ABDOMEN", "CT SPINE"])
-        rp_description = f"{sps_description} W/WO CONTRAST"
-    elif modality == "MR":
-        sps_description = random.choice(["MR BRAIN", "MR KNEE", "MR SHOULDER", "MR SPINE"])
-        rp_description = f"{sps_description} W/WO CONTRAST"
-    elif modality == "US":
-        sps_description = random.choice(["US ABDOMEN", "US PELVIS", "US THYROID", "US BREAST"])
-        rp_description = sps_description
-    elif modality == "CR" or modality == "DX":
-        sps_description = random.choice(["XR CHEST", "XR HAND", "XR FOOT", "XR KNEE"])
-        rp_description = sps_description
-    else:
-        sps_description = f"{modality} PROCEDURE"
-        rp_description = sps_description
+    sps_description, rp_description = random.choice(modality_procedures(modality))
     
     study_data = {
         'accession_number': accession_number,
@@ -118,7 +124,7 @@ def generate_study_data():
         'priority': random.choice(PRIORITIES),
         'reason_for_study': fake.sentence(nb_words=6),
         'sps_start_datetime': generate_datetime(past_days=7),
-        'institution_name': random.choice(["MAIN HOSPITAL", "IMAGING CENTER", "CLINIC"]),
+        'institution_name': random.choice(INSTITUTION_NAMES),
         'study_instance_uid': f"1.2.826.0.1.3680043.{random.randint(1000000, 9999999)}",
         'patient_weight': str(random.randint(50, 120)),
         'study_id': f"STD{random.randint(10000, 99999)}",
@@ -132,7 +138,7 @@ def generate_report_data():
         'report_format': random.choice(REPORT_FORMATS),
         'report_status': random.choice(REPORT_STATUSES),
         'report_date': generate_datetime(past_days=5),
-        'report_text': escape_hl7_chars(fake.paragraph(nb_sentences=3))
+        'report_text': fake.paragraph(nb_sentences=3)
     }
     return report_data
 
@@ -145,7 +151,7 @@ def generate_orm_message():
         'receiving_app': random.choice(RECEIVING_APPLICATIONS),
         'receiving_facility': random.choice(RECEIVING_FACILITIES),
         'datetime': generate_datetime(past_days=1),
-        'message_id': f"MSG{uuid.uuid4().hex[:8].upper()}",
+        'message_id': generate_message_id(),
         'order_control': random.choice(ORDER_CONTROLS),
         'patient_class': random.choice(PATIENT_CLASSES)
     }
@@ -159,7 +165,7 @@ def generate_orm_message():
     # Add study data
     message_data.update(generate_study_data())
     
-    return ORM_O01_TEMPLATE.format(**message_data)
+    return ORM_O01.render_mapping(message_data)
 
 def generate_oru_message():
     """Generate an ORU^R01 (Observation Result) following Medsynapse format"""
@@ -170,7 +176,7 @@ def generate_oru_message():
         'receiving_app': random.choice(RECEIVING_APPLICATIONS),
         'receiving_facility': random.choice(RECEIVING_FACILITIES),
         'datetime': generate_datetime(past_days=1),
-        'message_id': f"MSG{uuid.uuid4().hex[:8].upper()}",
+        'message_id': generate_message_id(),
         'order_control': "RE",  # Results
         'patient_class': random.choice(PATIENT_CLASSES)
     }
@@ -187,7 +193,7 @@ def generate_oru_message():
     # Add report data
     message_data.update(generate_report_data())
     
-    return ORU_R01_TEMPLATE.format(**message_data)
+    return ORU_R01.render_mapping(message_data)
 
 def generate_adt_a08_message():
     """Generate an ADT^A08 (Patient Information Update) following Medsynapse format"""
@@ -198,13 +204,13 @@ def generate_adt_a08_message():
         'receiving_app': random.choice(RECEIVING_APPLICATIONS),
         'receiving_facility': random.choice(RECEIVING_FACILITIES),
         'datetime': generate_datetime(past_days=1),
-        'message_id': f"MSG{uuid.uuid4().hex[:8].upper()}"
+        'message_id': generate_message_id()
     }
     
     # Add patient data
     message_data.update(generate_patient_data())
     
-    return ADT_A08_TEMPLATE.format(**message_data)
+    return ADT_A08.render_mapping(message_data)
 
 def generate_adt_a40_message():
     """Generate an ADT^A40 (Patient Merge) following Medsynapse format"""
@@ -215,12 +221,12 @@ def generate_adt_a40_message():
         'receiving_app': random.choice(RECEIVING_APPLICATIONS),
         'receiving_facility': random.choice(RECEIVING_FACILITIES),
         'datetime': generate_datetime(past_days=1),
-        'message_id': f"MSG{uuid.uuid4().hex[:8].upper()}",
+        'message_id': generate_message_id(),
         'patient_id_new': str(random.randint(100000, 999999)),
         'patient_id_old': str(random.randint(100000, 999999))
     }
     
-    return ADT_A40_TEMPLATE.format(**message_data)
+    return ADT_A40.render_mapping(message_data)
 
 def generate_ack_message(message_id, trigger_event="O01"):
     """Generate an acknowledgment (ACK) message"""
@@ -230,52 +236,246 @@ def generate_ack_message(message_id, trigger_event="O01"):
         'sending_app': random.choice(SENDING_APPLICATIONS),
         'sending_facility': random.choice(SENDING_FACILITIES),
         'datetime': datetime.now().strftime('%Y%m%d%H%M%S'),
-        'message_id': f"ACK{uuid.uuid4().hex[:8].upper()}",
+        'message_id': generate_message_id("ACK"),
         'ack_code': random.choice(ACK_CODES),
         'message_control_id': message_id,
         'text_message': "Message processed successfully" if random.random() > 0.2 else "Processing error",
         'trigger_event': trigger_event
     }
     
-    return ACK_TEMPLATE.format(**ack_data)
+    return ACK.render_mapping(ack_data)
+
+MESSAGE_GENERATORS = {
+    'orm': generate_orm_message,
+    'oru': generate_oru_message,
+    'adt_a08': generate_adt_a08_message,
+    'adt_a40': generate_adt_a40_message,
+}
+
+def iter_messages(message_types, count):
+    """Yield ``count`` wire-format messages (bytes) of each requested type, interleaved by type"""
+    generators = [MESSAGE_GENERATORS[t] for t in message_types if t in MESSAGE_GENERATORS]
+    for _ in range(count):
+        for generator in generators:
+            yield generator()
+
+def write_messages(output, messages, fmt='blank-line', compression=None, **options):
+    """Write messages to a corpus file as they are produced and return how many were written
+
+    ``options`` go to the corpus writer (e.g. ``batch_size`` for HL7 batch files).
+    """
+    with open_corpus_writer(output, fmt, compression, **options) as writer:
+        for message in messages:
+            writer.write(message)
+    return writer.count
+
+def write_batches(output, batches, fmt='blank-line', compression=None, **options):
+    """Write batches of messages to a corpus file and return how many were written"""
+    with open_corpus_writer(output, fmt, compression, **options) as writer:
+        for batch in batches:
+            writer.write_many(batch)
+    return writer.count
+
+def derive_seed(seed, shard):
+    """Derive an independent, reproducible seed for one shard"""
+    digest = hashlib.sha256(f"{seed}:{shard}".encode('ascii')).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+def shard_path(output, shard):
+    """Name of the file holding one shard of ``output``"""
+    root, suffix = os.path.splitext(output)
+    compression_suffix = ''
+    if suffix in COMPRESSION_SUFFIXES:
+        compression_suffix = suffix
+        root, suffix = os.path.splitext(root)
+    return f"{root}.{shard:04d}{suffix}{compression_suffix}"
+
+def generate_shard(job):
+    """Generate one shard of a corpus (runs in a worker process)"""
+    (output, message_types, count, seed, bulk, batch_size, pool_size, base_time, fmt, compression, workflow,
+     writer_options) = job
+    if workflow is not None:
+        from registry import generate_workflow
+        batches = generate_workflow(message_types, count, batch_size=batch_size, seed=seed, pool_size=pool_size,
+                                    base_time=base_time, **workflow)
+        return write_batches(output, batches, fmt, compression, **writer_options)
+    if bulk:
+        from bulk_generator import generate_bulk
+        batches = generate_bulk(message_types, count, batch_size, seed, pool_size, base_time)
+        return write_batches(output, batches, fmt, compression, **writer_options)
+    random.seed(seed)
+    Faker.seed(seed)
+    set_base_time(base_time)
+    return write_messages(output, iter_messages(message_types, count), fmt, compression, **writer_options)
+
+def merge_shards(shard_paths, output, fmt='blank-line', compression='none'):
+    """Concatenate shard files, in shard order, into one corpus file
+
+    Compressed shards are concatenated as-is: gzip members and zstd frames can be
+    appended to each other to form a single valid stream.
+    """
+    separator = shard_separator(fmt, compression)
+    with open(output, 'wb') as out:
+        first = True
+        for path, count in shard_paths:
+            if not count:
+                continue
+            if not first:
+                out.write(separator)
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, out, 1024 * 1024)
+            first = False
+    if fmt == 'indexed':
+        merge_indexes([path for path, count in shard_paths if count], output)
+
+def generate_sharded(output, message_types, count, shards, workers, seed, bulk=False,
+                     batch_size=10000, pool_size=1000, base_time=None, fmt='blank-line', compression='none',
+                     workflow=None, writer_options=None):
+    """Generate a corpus as ``shards`` files across a pool of ``workers`` processes
+
+    Shard ``i`` gets a seed derived from ``seed`` and ``i``, so for a given seed and
+    shard count the output is identical no matter how many workers are used.
+    ``workflow`` (a dict of registry options) generates a workflow corpus; each
+    shard then owns its own slice of the patients and of the MSH-7 timeline.
+    ``writer_options`` go to each shard's corpus writer. Returns a list of ``(shard_path, message_count)``.
+    """
+    # Every shard must share one reference time for the corpus to be reproducible
+    base_time = base_time or datetime.now()
+    per_shard, remainder = divmod(count, shards)
+    jobs = []
+    first_message = 0
+    for shard in range(shards):
+        shard_count = per_shard + (1 if shard < remainder else 0)
+        shard_workflow = None
+        if workflow is not None:
+            shard_workflow = dict(workflow, partition=shard, partitions=shards, first_message=first_message,
+                                  total_messages=count)
+        jobs.append((shard_path(output, shard), message_types, shard_count, derive_seed(seed, shard),
+                     bulk, batch_size, pool_size, base_time, fmt, compression, shard_workflow,
+                     writer_options or {}))
+        first_message += shard_count
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        counts = list(executor.map(generate_shard, jobs))
+    return [(job[0], n) for job, n in zip(jobs, counts)]
 
 def main():
     parser = argparse.ArgumentParser(description='Generate sample HL7 v2.3 messages for Medsynapse PACS')
     parser.add_argument('--count', type=int, default=5, help='Number of messages to generate')
     parser.add_argument('--output', type=str, default='sample_messages.txt', help='Output file')
     parser.add_argument('--types', type=str, default='all', help='Comma-separated list of message types to generate (orm, oru, adt_a08, adt_a40, all)')
+    parser.add_argument('--seed', type=int, help='Random seed for a reproducible corpus')
+    parser.add_argument('--bulk', action='store_true', help='Use the fast NumPy-vectorized bulk generator')
+    parser.add_argument('--batch-size', type=int, default=10000, help='Messages of each type per batch in bulk mode')
+    parser.add_argument('--pool-size', type=int, default=1000, help='Size of the Faker name/text pools in bulk mode')
+    parser.add_argument('--workflow', action='store_true', help='Draw messages from a patient/order registry: ORU results follow earlier ORM orders and ADT updates/merges use existing patients (--count is then the total number of messages)')
+    parser.add_argument('--patients', type=int, default=100000, help='Number of patients in the workflow registry')
+    parser.add_argument('--mix', type=str, help='Relative frequency of each message type in workflow mode (default: orm=45,oru=35,adt_a08=15,adt_a40=5)')
+    parser.add_argument('--base-time', type=str, help='Reference time for generated timestamps (YYYYMMDDHHMMSS, default: now)')
+    parser.add_argument('--format', type=str, default='blank-line', choices=list(CORPUS_WRITERS), help='Output layout: blank-line text, \\r-segmented wire format, MLLP frames, MLLP frames plus an index for zero-copy sending, or an HL7 batch file (FHS/BHS/BTS/FTS)')
+    parser.add_argument('--hl7-batch', type=int, metavar='N', help=f'Messages per BHS/BTS batch with --format batch (default: {DEFAULT_HL7_BATCH})')
+    parser.add_argument('--compress', type=str, choices=COMPRESSIONS, help='Compress the output (default: from the .gz/.zst suffix of --output)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes; each writes its own shard file')
+    parser.add_argument('--shards', type=int, help='Number of shard files (default: one per worker)')
+    parser.add_argument('--merge', action='store_true', help='Merge the shard files, in order, into --output')
+    parser.add_argument('--keep-shards', action='store_true', help='Keep the shard files after merging')
     
     args = parser.parse_args()
     
     # Determine which message types to generate
     message_types = []
     if args.types.lower() == 'all':
-        message_types = ['orm', 'oru', 'adt_a08', 'adt_a40']
+        message_types = list(MESSAGE_TYPES)
     else:
         message_types = [t.strip().lower() for t in args.types.split(',')]
     
-    messages = []
+    base_time = None
+    if args.base_time:
+        try:
+            base_time = datetime.strptime(args.base_time, '%Y%m%d%H%M%S')
+        except ValueError:
+            parser.error("--base-time must be formatted as YYYYMMDDHHMMSS")
+    
+    compression = args.compress or compression_for_path(args.output)
+    try:
+        check_compression(compression)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.format == 'indexed' and compression != 'none':
+        parser.error("--format indexed cannot be compressed")
+    writer_options = {}
+    if args.format == 'batch':
+        writer_options['batch_size'] = args.hl7_batch or DEFAULT_HL7_BATCH
+        if writer_options['batch_size'] < 1:
+            parser.error("--hl7-batch must be at least 1")
+        if args.merge:
+            parser.error("--format batch shards are complete FHS/FTS files and cannot be merged")
+    elif args.hl7_batch is not None:
+        parser.error("--hl7-batch needs --format batch")
+    
+    workflow = None
+    if args.workflow:
+        from registry import DEFAULT_MIX, parse_mix
+        try:
+            mix = parse_mix(args.mix) if args.mix else DEFAULT_MIX
+        except ValueError as e:
+            parser.error(str(e))
+        if not any(mix.get(t, 0) > 0 for t in message_types):
+            parser.error("--mix gives none of the requested --types a positive weight")
+        workflow = {'patients': args.patients, 'mix': mix}
+        if args.patients < 2:
+            parser.error("--patients must be at least 2")
+    
+    if args.workers > 1 or args.shards:
+        shards = args.shards or args.workers
+        seed = args.seed
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(63)
+            print(f"Using random seed {seed} (pass --seed {seed} to reproduce this corpus)")
+        results = generate_sharded(args.output, message_types, args.count, shards, args.workers, seed,
+                                   args.bulk, args.batch_size, args.pool_size, base_time,
+                                   args.format, compression, workflow, writer_options)
+        total = sum(n for _, n in results)
+        if args.merge:
+            merge_shards(results, args.output, args.format, compression)
+            if not args.keep_shards:
+                for path, _ in results:
+                    os.remove(path)
+                    if args.format == 'indexed':
+                        os.remove(index_path(path))
+            print(f"Generated {total} HL7 messages in {shards} shards and merged them into {args.output}")
+        else:
+            print(f"Generated {total} HL7 messages in {shards} shards:")
+            for path, n in results:
+                print(f"  {path}: {n} messages")
+        return
+    
+    if workflow is not None:
+        from registry import generate_workflow
+        batches = generate_workflow(message_types, args.count, batch_size=args.batch_size, seed=args.seed,
+                                    pool_size=args.pool_size, base_time=base_time, **workflow)
+        total = write_batches(args.output, batches, args.format, compression, **writer_options)
+        print(f"Generated {total} HL7 messages for {args.patients} patients and saved to {args.output}")
+        return
+    
+    if args.bulk:
+        from bulk_generator import generate_bulk
+        # Batches are written as soon as they are generated
+        batches = generate_bulk(message_types, args.count, args.batch_size, args.seed, args.pool_size, base_time)
+        total = write_batches(args.output, batches, args.format, compression, **writer_options)
+        print(f"Generated {total} HL7 messages and saved to {args.output}")
+        return
     
-    # Generate the specified number of each message type
-    for _ in range(args.count):
-        for msg_type in message_types:
-            if msg_type == 'orm':
-                messages.append(generate_orm_message())
-            elif msg_type == 'oru':
-                messages.append(generate_oru_message())
-            elif msg_type == 'adt_a08':
-                messages.append(generate_adt_a08_message())
-            elif msg_type == 'adt_a40':
-                messages.append(generate_adt_a40_message())
+    if args.seed is not None:
+        random.seed(args.seed)
+        Faker.seed(args.seed)
+    if base_time is not None:
+        set_base_time(base_time)
     
-    # Write messages to output file
-    with open(args.output, 'w') as f:
-        for i, message in enumerate(messages):
-            f.write(message)
-            if i < len(messages) - 1:
-                f.write('\n\n')
+    # Generate the specified number of each message type, writing each one as it is produced
+    total = write_messages(args.output, iter_messages(message_types, args.count), args.format, compression,
+                           **writer_options)
     
-    print(f"Generated {len(messages)} HL7 messages and saved to {args.output}")
+    print(f"Generated {total} HL7 messages and saved to {args.output}")
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,146 @@
+"""
+HL7 Batch Protocol Sender
+
+Sends messages in HL7 batch envelopes so that one MLLP frame, and one
+acknowledgment round trip, covers many messages:
+
+- each batch is a BHS header, N messages and a BTS trailer holding N; its
+  control ID (BHS-11) is the first message's MSH-10 prefixed with ``B``
+- the receiver answers with a batch acknowledgment: a BHS naming the batch it
+  answers in BHS-12, followed by an ACK for every message that was not
+  accepted (it may also list accepted ones), or with a single ACK whose MSA
+  applies to the whole batch (e.g. an AR for a batch it could not read)
+- every message is then reported on its own, with the code and text of its ACK
+  in the batch acknowledgment, or the batch's code if it has none
+
+Batches are pipelined over one persistent connection like single messages, so
+``--window`` is the number of batches in flight.
+"""
+import time
+from collections import deque, namedtuple
+
+from corpus import ENVELOPE_SEGMENTS, envelope_header, iter_batch_messages
+from hl7_message import HL7Message
+from metrics import METRICS
+from mllp_codec import EncodedFrame, encode_frame
+from sample_data.templates import BHS, BTS
+from send_hl7 import DEFAULT_ACK_TIMEOUT, DEFAULT_WINDOW, MLLPConnection, report_mllp_result, to_wire_bytes
+from send_log import log
+
+# A parsed batch acknowledgment. ``control_id`` is the batch it answers,
+# ``ack_code``/``ack_text`` apply to every message not listed in ``acks``
+# (control ID -> (ack_code, ack_text)).
+BatchAck = namedtuple('BatchAck', 'control_id ack_code ack_text acks')
+
+def build_batch(messages):
+    """Wrap wire-format messages in BHS/BTS; returns ``(batch_control_id, payload, members)``
+
+    ``members`` lists the ``(control_id, message_type)`` of each message in order.
+    """
+    header = envelope_header(messages[0])
+    batch_control_id = 'B' + header[5]
+    parts = [BHS.render(header[:5] + (batch_control_id, ''))]
+    members = []
+    for message in messages:
+        fields = HL7Message(message)
+        members.append((fields.control_id or "", fields.message_type or "Unknown"))
+        parts.append(message.rstrip(b'\r') + b'\r')
+    parts.append(BTS.render((len(messages),)))
+    return batch_control_id, b''.join(parts), members
+
+def iter_batches(messages, batch_size):
+    """Group a message stream into batches of ``batch_size`` (see :func:`build_batch`)"""
+    def build(batch):
+        started = time.perf_counter()
+        result = build_batch(batch)
+        METRICS.observe('encode', time.perf_counter() - started)
+        return result
+
+    batch = []
+    for message in messages:
+        batch.append(to_wire_bytes(message))
+        if len(batch) == batch_size:
+            yield build(batch)
+            batch = []
+    if batch:
+        yield build(batch)
+
+def parse_batch_ack(frame):
+    """Read a batch acknowledgment (or a single ACK answering a whole batch) into a ``BatchAck``"""
+    data = bytes(frame)
+    if not data.startswith(ENVELOPE_SEGMENTS):
+        ack = HL7Message(data)
+        return BatchAck(ack.ack_control_id or "", ack.ack_code, ack.ack_text or "", {})
+    header = HL7Message(data).fields('BHS') or []
+    # BHS-1 is the separator itself, so BHS-12 is the eleventh value after the ID
+    reference = header[11].decode('utf-8', errors='replace') if len(header) > 11 else ""
+    acks = {}
+    for message in iter_batch_messages(data):
+        ack = HL7Message(message)
+        if ack.ack_code is not None:
+            acks[ack.ack_control_id or ""] = (ack.ack_code, ack.ack_text or "")
+    return BatchAck(reference, "AA", "Accepted in batch", acks)
+
+class BatchMLLPConnection(MLLPConnection):
+    """A pipelined MLLP connection whose frames are batches, answered by batch acknowledgments
+
+    Results carry the ``BatchAck`` in place of the ACK text (failures without an
+    ACK still carry the error text).
+    """
+
+    def match_ack(self, frame):
+        ack = parse_batch_ack(frame)
+        control_id = ack.control_id
+        if control_id not in self.pending:
+            if not self.pending:
+                return (control_id, "Unknown", ack.ack_code, ack)
+            control_id = next(iter(self.pending))
+        message_type = self.pending.pop(control_id)
+        return (control_id, message_type, ack.ack_code, ack)
+
+def send_mllp_batches(messages, host, port, timeout=DEFAULT_ACK_TIMEOUT, window=DEFAULT_WINDOW,
+                      batch_size=100, tls=None):
+    """Send messages in batches of ``batch_size`` over one persistent MLLP connection
+
+    Returns ``(success_count, total_count, batch_count)``.
+    """
+    connection = BatchMLLPConnection(host, port, timeout, window, tls)
+    # Batch control ID -> member lists of the batches sent with it, oldest first
+    members = {}
+    success_count = 0
+    total_count = 0
+    batch_count = 0
+
+    def report(results):
+        accepted = 0
+        for batch_control_id, _, ack_code, detail in results:
+            latency = connection.latency(batch_control_id)
+            queue = members.get(batch_control_id)
+            if not queue:
+                log.warning("Acknowledgment for unknown batch %s", batch_control_id)
+                continue
+            batch = queue.popleft()
+            if not queue:
+                del members[batch_control_id]
+            if isinstance(detail, BatchAck):
+                if ack_code != "AA" or len(detail.acks) < len(batch):
+                    log.debug("Batch %s acknowledged %s with %d message ACKs", batch_control_id, ack_code,
+                              len(detail.acks))
+                for control_id, message_type in batch:
+                    code, text = detail.acks.get(control_id, (ack_code, detail.ack_text))
+                    accepted += report_mllp_result((control_id, message_type, code, text), latency=latency)
+            else:
+                for control_id, message_type in batch:
+                    accepted += report_mllp_result((control_id, message_type, None, detail), latency=latency)
+        return accepted
+
+    try:
+        for batch_control_id, payload, batch in iter_batches(messages, batch_size):
+            members.setdefault(batch_control_id, deque()).append(batch)
+            total_count += len(batch)
+            batch_count += 1
+            success_count += report(connection.send(EncodedFrame(encode_frame(payload), batch_control_id, "BATCH")))
+        success_count += report(connection.flush())
+    finally:
+        connection.close()
+    return success_count, total_count, batch_count
@@ -0,0 +1,146 @@
+"""
+Lazy HL7 v2 Message View
+
+A light wrapper around the raw bytes of a message that finds segments and fields only
+when they are asked for. Segments are located by scanning forward just far enough to
+reach the one requested, only that segment is split into fields, and nothing is
+decoded except the fields that are read, so logging MSH-9 or matching an ACK costs
+O(header) rather than O(message).
+
+Segments may be terminated by ``\\r`` (wire format) or ``\\n`` (generated text). Only
+the first occurrence of each segment type is located, which covers the header-style
+segments used for routing and correlation (MSH, PID, OBR, MSA).
+"""
+
+class HL7Message:
+    """Read-only view of one HL7 message
+
+    ``data`` is the message as bytes (no MLLP framing); a ``str`` is encoded as
+    UTF-8. Field numbers follow HL7 conventions: for MSH, MSH-1 is the field
+    separator itself, so MSH-9 is the ninth field counting it.
+    """
+
+    __slots__ = ('data', 'separator', '_segments', '_scanned', '_fields')
+
+    def __init__(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        elif isinstance(data, memoryview):
+            data = data.tobytes()
+        self.data = data
+        self.separator = data[3:4] if data[:3] == b'MSH' else b'|'
+        # Segment ID (bytes) -> (start, end) of every segment seen while scanning
+        self._segments = {}
+        # Offset up to which segments have been located, -1 once the end is reached
+        self._scanned = 0
+        # Segment name -> its fields, split on first access
+        self._fields = {}
+
+    def _segment(self, segment_id):
+        """``(start, end)`` of the first segment with this ID (bytes), or None"""
+        bounds = self._segments.get(segment_id)
+        if bounds is not None or self._scanned < 0:
+            return bounds
+        data = self.data
+        size = len(data)
+        pos = self._scanned
+        while pos < size:
+            end = data.find(b'\r', pos)
+            if end < 0:
+                end = size
+            newline = data.find(b'\n', pos, end)
+            if newline >= 0:
+                end = newline
+            if end > pos:
+                key = data[pos:pos + 3]
+                self._segments.setdefault(key, (pos, end))
+                if key == segment_id:
+                    self._scanned = end + 1
+                    return pos, end
+            pos = end + 1
+        self._scanned = -1
+        return None
+
+    def fields(self, segment):
+        """Raw fields of the first ``segment`` (index 0 is the segment ID), or None"""
+        fields = self._fields.get(segment)
+        if fields is None:
+            bounds = self._segment(segment.encode('ascii'))
+            if bounds is None:
+                return None
+            fields = self._fields[segment] = self.data[bounds[0]:bounds[1]].split(self.separator)
+        return fields
+
+    def raw_field(self, segment, number):
+        """Bytes of field ``number`` of ``segment``, or None if it is absent"""
+        fields = self.fields(segment)
+        if fields is None:
+            return None
+        if segment == 'MSH':
+            # MSH-1 is the separator itself, so MSH-n is the n-1th value after the ID
+            if number == 1:
+                return self.separator
+            number -= 1
+        return fields[number] if 0 < number < len(fields) else None
+
+    def field(self, segment, number, default=None):
+        """Field ``number`` of ``segment`` decoded as text; ``default`` if absent or empty"""
+        value = self.raw_field(segment, number)
+        if not value:
+            return default
+        return value.decode('utf-8', errors='replace')
+
+    def component(self, segment, number, component=1, default=None):
+        """One ``^``-separated component of a field"""
+        value = self.field(segment, number)
+        if value is None:
+            return default
+        parts = value.split('^')
+        if len(parts) < component or not parts[component - 1]:
+            return default
+        return parts[component - 1]
+
+    @property
+    def is_valid(self):
+        """True if the message starts with an MSH segment"""
+        return self.data[:4] == b'MSH' + self.separator
+
+    @property
+    def message_type(self):
+        """MSH-9, e.g. ``ORU^R01``"""
+        return self.field('MSH', 9)
+
+    @property
+    def trigger_event(self):
+        """Second component of MSH-9, e.g. ``R01``"""
+        return self.component('MSH', 9, 2)
+
+    @property
+    def control_id(self):
+        """MSH-10, the message control ID"""
+        return self.field('MSH', 10)
+
+    @property
+    def patient_id(self):
+        """PID-3, the patient identifier list"""
+        return self.field('PID', 3)
+
+    @property
+    def placer_order_number(self):
+        """OBR-2 (the accession number in Medsynapse messages)"""
+        return self.field('OBR', 2)
+
+    @property
+    def ack_code(self):
+        """MSA-1: AA, AE or AR"""
+        return self.field('MSA', 1)
+
+    @property
+    def ack_control_id(self):
+        """MSA-2, the control ID of the acknowledged message"""
+        return self.field('MSA', 2)
+
+    @property
+    def ack_text(self):
+        """MSA-3, the acknowledgment text"""
+        return self.field('MSA', 3)
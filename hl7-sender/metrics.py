@@ -0,0 +1,170 @@
+"""
+Sender Instrumentation
+
+Per-stage timers and counters for the hot path of send_hl7.py, exported in the
+OpenMetrics (Prometheus) text format. Stages:
+
+- ``read``:      pulling the next message from the corpus reader
+- ``encode``:    extracting MSH fields and building the MLLP frame / HTTP payload
+- ``connect``:   opening a TCP connection
+- ``send``:      ``sendall``/``sendfile`` (or the asyncio write and drain)
+- ``ack_wait``:  blocked waiting for ACKs (a full window, or draining at the end)
+- ``http``:      a complete HTTP request
+
+Recording a sample is two ``perf_counter()`` calls and a bisect into fixed buckets,
+so instrumentation stays on all the time. Stage timings can be written to a file,
+served on a local ``/metrics`` endpoint and summarised at the end of a run.
+"""
+import os
+import time
+import bisect
+import threading
+from collections import Counter
+
+# Histogram bucket upper bounds in seconds (10us .. 10s)
+STAGE_BUCKETS = [1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2,
+                 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+STAGES = ['read', 'encode', 'connect', 'send', 'ack_wait', 'http']
+
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+class StageHistogram:
+    """Cumulative-bucket histogram of one stage's durations"""
+
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(STAGE_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(STAGE_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+class Metrics:
+    """Registry of stage histograms and labelled counters"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {stage: StageHistogram() for stage in STAGES}
+        # Counter name -> Counter of label value -> count
+        self.counters = {
+            'messages': Counter(),     # by result: AA, AE, AR, failed
+            'bytes_sent': Counter(),   # by transport
+            'connections': Counter(),  # by outcome: opened, failed
+            'flow_control': Counter(),  # adaptive sender decisions: increase, latency, errors, timeout
+            'tls_handshakes': Counter(),  # by kind: full, resumed
+        }
+
+    def observe(self, stage, seconds):
+        """Record one duration for a stage"""
+        self.stages[stage].observe(seconds)
+
+    def count(self, name, label, value=1):
+        """Increment a labelled counter"""
+        self.counters[name][label] += value
+
+    def timed(self, iterable, stage='read'):
+        """Yield from ``iterable``, timing each step as ``stage``"""
+        iterator = iter(iterable)
+        histogram = self.stages[stage]
+        perf_counter = time.perf_counter
+        while True:
+            start = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            histogram.observe(perf_counter() - start)
+            yield item
+
+    def render(self):
+        """The metrics in OpenMetrics text format"""
+        lines = [
+            '# TYPE hl7_sender_stage_seconds histogram',
+            '# UNIT hl7_sender_stage_seconds seconds',
+            '# HELP hl7_sender_stage_seconds Time spent in each stage of the send path.',
+        ]
+        for stage, histogram in self.stages.items():
+            counts = list(histogram.counts)
+            running = 0
+            for bound, n in zip(STAGE_BUCKETS + ['+Inf'], counts):
+                running += n
+                lines.append(f'hl7_sender_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {running}')
+            lines.append(f'hl7_sender_stage_seconds_count{{stage="{stage}"}} {running}')
+            lines.append(f'hl7_sender_stage_seconds_sum{{stage="{stage}"}} {histogram.sum:.9f}')
+
+        labels = {'messages': 'result', 'bytes_sent': 'transport', 'connections': 'outcome',
+                  'flow_control': 'decision', 'tls_handshakes': 'handshake'}
+        help_text = {
+            'messages': 'Messages completed, by ACK code (failed: no ACK).',
+            'bytes_sent': 'Bytes written to the receiver.',
+            'connections': 'TCP connection attempts.',
+            'flow_control': 'Adaptive flow control decisions (increase, or the signal that caused a back-off).',
+            'tls_handshakes': 'TLS handshakes on MLLP connections, full or resumed.',
+        }
+        for name, counter in self.counters.items():
+            lines.append(f'# TYPE hl7_sender_{name} counter')
+            lines.append(f'# HELP hl7_sender_{name} {help_text[name]}')
+            for label, value in list(counter.items()):
+                lines.append(f'hl7_sender_{name}_total{{{labels[name]}="{label}"}} {value}')
+        lines.append('# TYPE hl7_sender_start_time_seconds gauge')
+        lines.append('# UNIT hl7_sender_start_time_seconds seconds')
+        lines.append(f'hl7_sender_start_time_seconds {self.started:.3f}')
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Atomically write the metrics to a text file"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def summary(self):
+        """Per-stage breakdown of where the time went, as printable lines"""
+        total = sum(h.sum for h in self.stages.values()) or 1.0
+        lines = [f"{'stage':<10}{'count':>10}{'total s':>10}{'mean us':>10}{'share':>8}"]
+        for stage, histogram in self.stages.items():
+            if histogram.count:
+                lines.append(f"{stage:<10}{histogram.count:>10}{histogram.sum:>10.3f}"
+                             f"{histogram.sum / histogram.count * 1e6:>10.1f}{histogram.sum / total:>8.1%}")
+        return lines
+
+def serve_metrics(port, host='127.0.0.1'):
+    """Serve ``/metrics`` from a daemon thread and return the server"""
+    # Imported here so that runs without an endpoint do not load http.server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = METRICS.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', OPENMETRICS_CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+def write_periodically(path, interval):
+    """Rewrite the metrics file every ``interval`` seconds from a daemon thread"""
+    def loop():
+        while True:
+            time.sleep(interval)
+            METRICS.write(path)
+    threading.Thread(target=loop, name='metrics-writer', daemon=True).start()
+
+# Process-wide registry used by the sender
+METRICS = Metrics()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+"""
+HL7 Sender Microbenchmarks
+
+Times the hot paths of the sender and generators offline, in one command:
+
+- ``escape``:   ``escape_hl7_text`` on a report paragraph
+- ``generate``: each ``generate_*_message`` function (seeded, fixed base time)
+- ``template``: ``MessageTemplate.render`` and ``render_mapping`` per template
+- ``read``:     ``read_hl7_messages`` over a 10MB corpus (and 1GB with ``--large``)
+- ``mllp``:     MLLP framing and deframing, ACK parsing and ACK matching
+- ``loopback``: ``send_mllp_messages`` end to end against an in-process receiver
+
+Every benchmark reports the best time per operation in microseconds (per call,
+per message or per MB). Results are compared against a JSON baseline and the run
+exits with status 1 when any benchmark is slower than the baseline by more than
+``--threshold`` percent.
+
+Timings only compare on one machine, so the baseline is not shipped. Record one
+per machine (and again after an intended speed change), then check later runs
+against it:
+
+    python microbench.py --save
+    python microbench.py
+
+Without a baseline the run exits with status 2, so a check that has nothing to
+compare against does not pass silently; ``--allow-missing-baseline`` only
+prints the results in that case.
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import timeit
+from collections import deque
+from datetime import datetime
+
+from faker import Faker
+
+import generate_hl7
+from bench_templates import TEMPLATES, sample_data
+from corpus import open_corpus_writer
+from mllp_codec import MLLPDecoder, encode_frame, encode_frames
+from mllp_receiver import MLLPReceiver
+from sample_data.templates import escape_hl7_text
+from send_hl7 import match_ack, parse_ack, read_hl7_messages, send_mllp_messages
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'microbench_baseline.json')
+DEFAULT_THRESHOLD = 20.0  # percent slower than the baseline that counts as a regression
+READ_SIZES = {'10MB': 10 * 1024 * 1024}
+LARGE_READ_SIZES = {'1GB': 1024 * 1024 * 1024}
+FRAMES_PER_BUFFER = 100  # messages per encode_frames / MLLPDecoder.feed run
+LOOPBACK_WINDOW = 64
+SEED = 42
+BASE_TIME = datetime(2024, 1, 1, 12, 0, 0)
+
+def per_call(function, number, repeat):
+    """Best time per call in microseconds"""
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number * 1e6
+
+def seed_generators():
+    """Make the generate_* functions reproducible"""
+    random.seed(SEED)
+    Faker.seed(SEED)
+    generate_hl7.set_base_time(BASE_TIME)
+
+def sample_messages(count):
+    """``count`` generated messages, cycling through every message type"""
+    seed_generators()
+    generators = list(generate_hl7.MESSAGE_GENERATORS.values())
+    return [generators[i % len(generators)]() for i in range(count)]
+
+def bench_escape(args):
+    text = sample_data(['report_text'])['report_text']
+    yield 'escape_hl7_text', per_call(lambda: escape_hl7_text(text), args.number, args.repeat), 'call'
+
+def bench_generate(args):
+    # Faker makes these ~100x slower than rendering, so they get fewer calls
+    number = max(1, args.number // 20)
+    seed_generators()
+    for name, generator in generate_hl7.MESSAGE_GENERATORS.items():
+        yield f'generate_{name}_message', per_call(generator, number, args.repeat), 'call'
+    yield 'generate_ack_message', per_call(lambda: generate_hl7.generate_ack_message('MSG00000001'),
+                                           number, args.repeat), 'call'
+
+def bench_template(args):
+    for name, (_, compiled) in TEMPLATES.items():
+        data = sample_data(compiled.fields)
+        values = tuple(data[field] for field in compiled.fields)
+        yield f'{name} render', per_call(lambda: compiled.render(values), args.number, args.repeat), 'call'
+        yield f'{name} render_mapping', per_call(lambda: compiled.render_mapping(data), args.number, args.repeat), 'call'
+
+def corpus_file(data_dir, label, size):
+    """Path of a blank-line corpus of about ``size`` bytes, written on first use and then reused"""
+    path = os.path.join(data_dir, f'microbench_{label}.txt')
+    if os.path.exists(path) and os.path.getsize(path) >= size:
+        return path
+    print(f"Writing {label} benchmark corpus to {path}...", file=sys.stderr)
+    messages = sample_messages(1000)
+    written = 0
+    with open_corpus_writer(path, 'blank-line', 'none') as writer:
+        while written < size:
+            for message in messages:
+                writer.write(message)
+                written += len(message) + 2
+    return path
+
+def bench_read(args):
+    sizes = dict(READ_SIZES, **(LARGE_READ_SIZES if args.large else {}))
+    for label, size in sizes.items():
+        path = corpus_file(args.data_dir, label, size)
+        megabytes = os.path.getsize(path) / (1024 * 1024)
+        # A full pass per run; the larger corpus is read fewer times
+        repeat = args.repeat if size <= 100 * 1024 * 1024 else min(args.repeat, 2)
+        best = min(timeit.repeat(lambda: deque(read_hl7_messages(path), maxlen=0), number=1, repeat=repeat))
+        yield f'read_hl7_messages {label}', best / megabytes * 1e6, 'MB'
+
+def bench_mllp(args):
+    messages = sample_messages(FRAMES_PER_BUFFER)
+    message = messages[1]
+    yield 'encode_frame', per_call(lambda: encode_frame(message), args.number, args.repeat), 'call'
+
+    number = max(1, args.number // FRAMES_PER_BUFFER)
+    buffer = encode_frames(messages)
+    yield 'encode_frames', per_call(lambda: encode_frames(messages), number, args.repeat) / FRAMES_PER_BUFFER, 'message'
+    chunks = [buffer[i:i + 65536] for i in range(0, len(buffer), 65536)]
+
+    def deframe():
+        decoder = MLLPDecoder()
+        for chunk in chunks:
+            decoder.feed(chunk)
+    yield 'MLLPDecoder.feed', per_call(deframe, number, args.repeat) / FRAMES_PER_BUFFER, 'message'
+
+    seed_generators()
+    ack = generate_hl7.generate_ack_message('MSG00000001')
+    yield 'parse_ack', per_call(lambda: parse_ack(ack), args.number, args.repeat), 'call'
+    yield 'match_ack', per_call(lambda: match_ack({'MSG00000001': 'ORM^O01'}, ack), args.number, args.repeat), 'call'
+
+def free_port(host):
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+class LoopbackReceiver:
+    """An always-AA ``MLLPReceiver`` served from a background thread"""
+
+    def __init__(self, host='127.0.0.1'):
+        self.host = host
+        self.port = free_port(host)
+        self.receiver = MLLPReceiver(host, self.port, storage_dir=None, quiet=True)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        start = asyncio.start_server(self.receiver.handle_connection, self.host, self.port)
+        self.server = asyncio.run_coroutine_threadsafe(start, self.loop).result()
+        return self
+
+    def __exit__(self, *exc):
+        self.loop.call_soon_threadsafe(self.server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+def bench_loopback(args):
+    messages = sample_messages(args.loopback_count)
+    with LoopbackReceiver() as receiver:
+        def send():
+            success_count, total_count = send_mllp_messages(messages, receiver.host, receiver.port,
+                                                            window=LOOPBACK_WINDOW)
+            if success_count != total_count:
+                raise RuntimeError(f"Loopback receiver accepted {success_count}/{total_count} messages")
+        best = min(timeit.repeat(send, number=1, repeat=args.repeat))
+    yield f'send_mllp_messages window={LOOPBACK_WINDOW}', best / len(messages) * 1e6, 'message'
+
+BENCHMARKS = {
+    'escape': bench_escape,
+    'generate': bench_generate,
+    'template': bench_template,
+    'read': bench_read,
+    'mllp': bench_mllp,
+    'loopback': bench_loopback,
+}
+
+def environment():
+    """Where the results were measured; timings only compare on the same machine and Python"""
+    return {'python': platform.python_version(), 'implementation': platform.python_implementation(),
+            'machine': platform.machine(), 'node': platform.node()}
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def save_baseline(path, baseline, results):
+    """Write ``results`` over the matching entries of ``baseline`` (kept for benchmarks not run)"""
+    benchmarks = dict(baseline['benchmarks']) if baseline else {}
+    benchmarks.update(results)
+    with open(path, 'w') as f:
+        json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'environment': environment(),
+                   'benchmarks': benchmarks}, f, indent=2)
+        f.write('\n')
+    print(f"Baseline written to {path}")
+
+def compare(results, baseline, threshold):
+    """Print each result against the baseline and return the names that regressed"""
+    previous = baseline['benchmarks'] if baseline else {}
+    regressions = []
+    print(f"{'benchmark':<36}{'unit':>8}{'baseline us':>14}{'current us':>14}{'change':>10}")
+    for name, result in results.items():
+        current = result['us']
+        reference = previous.get(name, {}).get('us')
+        if reference:
+            change = (current / reference - 1.0) * 100
+            status = '  REGRESSION' if change > threshold else ''
+            if status:
+                regressions.append(name)
+            print(f"{name:<36}{result['unit']:>8}{reference:>14.2f}{current:>14.2f}{change:>+9.1f}%{status}")
+        else:
+            print(f"{name:<36}{result['unit']:>8}{'-':>14}{current:>14.2f}{'new':>10}")
+    return regressions
+
+def run(args):
+    baseline = load_baseline(args.baseline)
+    if baseline and baseline.get('environment') != environment():
+        print(f"Warning: the baseline was recorded on {baseline.get('environment')}; timings may not compare",
+              file=sys.stderr)
+
+    results = {}
+    for group in args.only or BENCHMARKS:
+        for name, microseconds, unit in BENCHMARKS[group](args):
+            results[name] = {'us': microseconds, 'unit': unit}
+    regressions = compare(results, baseline, args.threshold)
+
+    if args.save:
+        save_baseline(args.baseline, baseline, results)
+        return 0
+    if baseline is None:
+        print(f"\nNo baseline at {args.baseline}; run with --save to record one.")
+        return 0 if args.allow_missing_baseline else 2
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) regressed by more than {args.threshold:g}%: {', '.join(regressions)}")
+        return 1
+    print(f"\nNo regressions beyond {args.threshold:g}%.")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmark the hl7-sender hot paths and check them against a baseline')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='Run only these benchmark groups')
+    parser.add_argument('--baseline', type=str, default=DEFAULT_BASELINE, help='JSON baseline file to compare against (and to write with --save)')
+    parser.add_argument('--save', action='store_true', help='Record the results as the new baseline instead of failing on regressions')
+    parser.add_argument('--allow-missing-baseline', action='store_true', help='Exit 0 instead of 2 when there is no baseline to compare against')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help='Percent slowdown against the baseline that fails the run')
+    parser.add_argument('--number', type=int, default=20000, help='Calls per timing run for the per-call benchmarks')
+    parser.add_argument('--repeat', type=int, default=5, help='Timing runs per measurement (the best is reported)')
+    parser.add_argument('--large', action='store_true', help='Also read a 1GB corpus (written once to --data-dir)')
+    parser.add_argument('--data-dir', type=str, default=tempfile.gettempdir(), help='Directory for the generated read corpora, reused between runs')
+    parser.add_argument('--loopback-count', type=int, default=2000, help='Messages per loopback send')
+    args = parser.parse_args()
+    if args.threshold < 0:
+        parser.error("--threshold must be 0 or positive")
+    sys.exit(run(args))
+
+if __name__ == "__main__":
+    main()
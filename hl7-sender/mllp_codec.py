@@ -0,0 +1,108 @@
+"""
+MLLP Framing Codec
+
+Shared Minimal Lower Layer Protocol framing used by the sender, the asyncio engine and
+the local receivers. A frame is ``<VT> message <FS><CR>``.
+
+The decoder is incremental: bytes are fed as they arrive from the socket, complete
+frames are returned as soon as their end block is seen, and any partial frame is kept
+for the next read. Each byte is scanned once, so large messages and several frames
+arriving in a single read are handled in linear time.
+"""
+from collections import namedtuple
+
+# MLLP control characters
+MLLP_START_BLOCK = b'\x0b'  # <VT>
+MLLP_END_BLOCK = b'\x1c\x0d'  # <FS><CR>
+
+# A message that is already MLLP-framed, with the MSH fields needed to match its ACK.
+# ``frame`` may be any bytes-like object, e.g. a memoryview slice of a mapped corpus.
+EncodedFrame = namedtuple('EncodedFrame', 'frame control_id message_type')
+
+def encode_frame(message):
+    """Wrap a single wire-format message (bytes) in an MLLP frame"""
+    return b''.join((MLLP_START_BLOCK, message, MLLP_END_BLOCK))
+
+def frame_parts(messages):
+    """Return the buffers making up the MLLP frames for ``messages``
+
+    The list can be handed to ``socket.sendmsg`` (scatter/gather) or ``b''.join``
+    without building any intermediate per-frame copies.
+    """
+    parts = []
+    append = parts.append
+    for message in messages:
+        append(MLLP_START_BLOCK)
+        append(message)
+        append(MLLP_END_BLOCK)
+    return parts
+
+def encode_frames(messages):
+    """Encode a batch of messages into one buffer of consecutive MLLP frames"""
+    return b''.join(frame_parts(messages))
+
+class MLLPDecoder:
+    """Incremental MLLP deframer
+
+    Feed it raw bytes with :meth:`feed`; it returns the payload of every frame
+    completed by that data. Bytes outside of a frame are discarded.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # Offset of the current frame's payload, or -1 while between frames
+        self._frame_start = -1
+        # Offset from which to resume looking for the end block
+        self._scan_from = 0
+
+    def reset(self):
+        """Discard any buffered partial frame"""
+        self._buffer.clear()
+        self._frame_start = -1
+        self._scan_from = 0
+
+    @property
+    def buffered(self):
+        """Number of bytes held for an incomplete frame"""
+        return len(self._buffer)
+
+    def feed(self, data):
+        """Add received bytes and return a list of complete frame payloads"""
+        buffer = self._buffer
+        buffer += data
+        frames = []
+        pos = 0
+
+        with memoryview(buffer) as view:
+            while True:
+                if self._frame_start < 0:
+                    start = buffer.find(MLLP_START_BLOCK, pos)
+                    if start < 0:
+                        pos = len(buffer)
+                        break
+                    self._frame_start = start + 1
+                    self._scan_from = start + 1
+
+                end = buffer.find(MLLP_END_BLOCK, self._scan_from)
+                if end < 0:
+                    # Resume one byte early in case <FS> arrived without its <CR>
+                    self._scan_from = max(self._frame_start, len(buffer) - 1)
+                    pos = self._frame_start - 1
+                    break
+
+                frames.append(bytes(view[self._frame_start:end]))
+                pos = end + len(MLLP_END_BLOCK)
+                self._frame_start = -1
+
+        # Drop consumed bytes and rebase the offsets of any partial frame
+        if pos:
+            del buffer[:pos]
+            if self._frame_start >= 0:
+                self._frame_start -= pos
+                self._scan_from -= pos
+        return frames
+
+    def frames(self, chunks):
+        """Yield complete frame payloads from an iterable of received chunks"""
+        for chunk in chunks:
+            yield from self.feed(chunk)
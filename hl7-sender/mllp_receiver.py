@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+"""
+Local HL7 MLLP Receiver (asyncio)
+
+A lightweight stand-in for the Node MLLP server, used to measure sender performance in
+isolation. Received messages are appended in batches to a single MLLP-framed storage
+file (which send_hl7.py can replay directly) instead of one file per message, and the
+acknowledgment behaviour can be tuned to simulate a healthy or struggling PACS broker:
+
+- AA/AE/AR ratios
+- a fixed (plus optional random) delay before each ACK
+- randomly dropped connections
+
+HL7 batches (BHS...BTS frames, see hl7_batch.py) are answered with one batch
+acknowledgment listing an ACK for every message that was not accepted (or for
+every message with ``--batch-ack all``).
+
+With ``--tls-cert`` it listens for MLLP over TLS (optionally requiring client
+certificates), as a stand-in for a TLS-tunnelled site; see mllp_tls.py for
+creating self-signed test certificates.
+"""
+import os
+import time
+import random
+import signal
+import asyncio
+import argparse
+from datetime import datetime
+from dotenv import load_dotenv
+from corpus import ENVELOPE_SEGMENTS, iter_batch_messages
+from hl7_message import HL7Message
+from mllp_codec import MLLPDecoder, encode_frame
+from sample_data.templates import ACK, BHS, BTS
+
+# Load environment variables
+load_dotenv()
+
+DEFAULT_HOST = os.getenv("HL7_RECEIVER_HOST", "127.0.0.1")
+DEFAULT_PORT = int(os.getenv("HL7_SERVER_PORT", "2575"))
+DEFAULT_STORAGE_DIR = os.getenv("HL7_RECEIVER_STORAGE", "storage")
+DEFAULT_FLUSH_INTERVAL = 1.0  # seconds between storage flushes
+DEFAULT_STATS_INTERVAL = 5.0  # seconds between throughput reports
+STORAGE_BUFFER_SIZE = 1024 * 1024
+BATCH_ACK_MODES = ['errors', 'all']  # which messages get an ACK in a batch acknowledgment
+
+def build_ack(control_id, trigger_event, ack_code, text):
+    """Render an ACK for a received message as wire-format bytes"""
+    # Values in ACK.fields order
+    return ACK.render(("PACS_APP", "PACS_FACILITY", "HL7_SENDER", "SENDER_FACILITY",
+                       datetime.now().strftime('%Y%m%d%H%M%S'), trigger_event or '',
+                       f"ACK{control_id}", ack_code, control_id, text))
+
+def build_batch_ack(batch_control_id, acks):
+    """Render a batch acknowledgment: a BHS answering the batch, the given ACKs and a BTS"""
+    # Values in BHS.fields order
+    header = BHS.render(("PACS_APP", "PACS_FACILITY", "HL7_SENDER", "SENDER_FACILITY",
+                         datetime.now().strftime('%Y%m%d%H%M%S'), f"ACK{batch_control_id}", batch_control_id))
+    return b''.join([header, *acks, BTS.render((len(acks),))])
+
+class ReceiverStats:
+    """Throughput counters for the receiver"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.connections = 0
+        self.tls_connections = 0
+        self.tls_resumed = 0
+        self.dropped = 0
+        self.batches = 0
+        self.received = 0
+        self.bytes = 0
+        self.ack_codes = {'AA': 0, 'AE': 0, 'AR': 0}
+        self._last_time = self.started
+        self._last_received = 0
+
+    def interval_rate(self):
+        """Messages per second since the previous call"""
+        now = time.perf_counter()
+        rate = (self.received - self._last_received) / (now - self._last_time)
+        self._last_time, self._last_received = now, self.received
+        return rate
+
+    def summary(self):
+        """One-line summary of the counters"""
+        elapsed = time.perf_counter() - self.started
+        codes = ", ".join(f"{code}={n}" for code, n in self.ack_codes.items())
+        tls = f" ({self.tls_resumed} resumed TLS sessions)" if self.tls_connections else ""
+        batches = f" in {self.batches} batches" if self.batches else ""
+        return (f"{self.received} messages{batches} ({self.bytes / 1e6:.1f} MB) in {elapsed:.1f}s "
+                f"({self.received / elapsed if elapsed else 0.0:.1f} msgs/sec), {codes}, "
+                f"{self.connections} connections{tls}, {self.dropped} dropped")
+
+class MLLPReceiver:
+    """Asyncio MLLP server with configurable acknowledgment behaviour"""
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, ae_ratio=0.0, ar_ratio=0.0,
+                 ack_delay=0.0, ack_jitter=0.0, drop_rate=0.0, storage_dir=DEFAULT_STORAGE_DIR,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, seed=None, quiet=False, ssl_context=None,
+                 batch_ack='errors'):
+        if ae_ratio + ar_ratio > 1.0:
+            raise ValueError("AE and AR ratios must add up to at most 1.0")
+        self.host = host
+        self.port = port
+        self.ae_ratio = ae_ratio
+        self.ar_ratio = ar_ratio
+        self.ack_delay = ack_delay
+        self.ack_jitter = ack_jitter
+        self.drop_rate = drop_rate
+        self.storage_dir = storage_dir
+        self.flush_interval = flush_interval
+        self.quiet = quiet
+        self.ssl_context = ssl_context
+        self.batch_ack = batch_ack
+        self.random = random.Random(seed)
+        self.stats = ReceiverStats()
+        self.storage = None
+        self.storage_path = None
+        self.server = None
+
+    def open_storage(self):
+        """Open the append-only storage file for this run"""
+        if self.storage_dir:
+            os.makedirs(self.storage_dir, exist_ok=True)
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            self.storage_path = os.path.join(self.storage_dir, f"received_{timestamp}.mllp")
+            # Writes accumulate in a large buffer and hit the disk in batches
+            self.storage = open(self.storage_path, 'ab', buffering=STORAGE_BUFFER_SIZE)
+
+    def close_storage(self):
+        """Flush and close the storage file"""
+        if self.storage is not None:
+            self.storage.close()
+            self.storage = None
+
+    def choose_ack_code(self):
+        """Pick an acknowledgment code according to the configured ratios"""
+        roll = self.random.random()
+        if roll < self.ar_ratio:
+            return "AR"
+        if roll < self.ar_ratio + self.ae_ratio:
+            return "AE"
+        return "AA"
+
+    async def handle_connection(self, reader, writer):
+        """Receive frames from one client and acknowledge them in order"""
+        self.stats.connections += 1
+        ssl_object = writer.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            self.stats.tls_connections += 1
+            self.stats.tls_resumed += ssl_object.session_reused
+        decoder = MLLPDecoder()
+        # ACKs are queued with their due time so a delay never reorders them
+        acks = asyncio.Queue()
+        ack_writer = asyncio.create_task(self._write_acks(writer, acks))
+        try:
+            while True:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    break
+                for message in decoder.feed(chunk):
+                    if self.drop_rate and self.random.random() < self.drop_rate:
+                        # Simulate a broker crash: abort without sending queued ACKs
+                        self.stats.dropped += 1
+                        ack_writer.cancel()
+                        writer.transport.abort()
+                        return
+                    if bytes(message[:4]) in ENVELOPE_SEGMENTS:
+                        acks.put_nowait(self.process_batch(message))
+                    else:
+                        acks.put_nowait(self.process_message(message))
+        except (OSError, ConnectionError):
+            pass
+        finally:
+            acks.put_nowait(None)
+            try:
+                await ack_writer
+            except (OSError, ConnectionError, asyncio.CancelledError):
+                pass
+            writer.close()
+
+    def receive(self, message):
+        """Store a received message and return ``(control_id, trigger_event, ack_code, text)`` for its ACK"""
+        self.stats.received += 1
+        self.stats.bytes += len(message)
+        if self.storage is not None:
+            self.storage.write(encode_frame(message))
+
+        header = HL7Message(message)
+        control_id = header.control_id if header.is_valid else None
+        trigger_event = header.trigger_event
+        if control_id is None:
+            ack_code, text = "AE", "Failed to parse HL7 message"
+            control_id = "UNKNOWN"
+        else:
+            ack_code = self.choose_ack_code()
+            text = "Message processed successfully" if ack_code == "AA" else "Simulated processing error"
+        self.stats.ack_codes[ack_code] += 1
+        return control_id, trigger_event, ack_code, text
+
+    def ack_due(self):
+        """When the next ACK should be written"""
+        due = time.perf_counter() + self.ack_delay
+        if self.ack_jitter:
+            due += self.random.uniform(0, self.ack_jitter)
+        return due
+
+    def process_message(self, message):
+        """Store a received message and return ``(due_time, ack_frame)``"""
+        return self.ack_due(), encode_frame(build_ack(*self.receive(message)))
+
+    def process_batch(self, payload):
+        """Store the messages of a received batch and return ``(due_time, batch_ack_frame)``"""
+        self.stats.batches += 1
+        payload = bytes(payload)
+        header = HL7Message(payload).fields('BHS') or []
+        # BHS-11 is the batch control ID (BHS-n is field n-1 after the segment ID)
+        batch_control_id = header[10].decode('utf-8', errors='replace') if len(header) > 10 else ""
+        acks = []
+        for message in iter_batch_messages(payload):
+            result = self.receive(message)
+            if result[2] != "AA" or self.batch_ack == 'all':
+                acks.append(build_ack(*result))
+        return self.ack_due(), encode_frame(build_batch_ack(batch_control_id, acks))
+
+    async def _write_acks(self, writer, acks):
+        """Write queued ACKs once they are due"""
+        while True:
+            item = await acks.get()
+            if item is None:
+                break
+            due, frame = item
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            writer.write(frame)
+            if acks.empty():
+                await writer.drain()
+
+    async def _flush_storage(self):
+        """Periodically push buffered messages to disk"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if self.storage is not None:
+                self.storage.flush()
+
+    async def _report_stats(self, interval):
+        """Periodically print the receive rate"""
+        while True:
+            await asyncio.sleep(interval)
+            print(f"[receiver] {self.stats.interval_rate():.1f} msgs/sec | {self.stats.summary()}")
+
+    async def serve(self, stats_interval=DEFAULT_STATS_INTERVAL):
+        """Run the server until cancelled"""
+        self.open_storage()
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port, ssl=self.ssl_context)
+        print(f"MLLP receiver listening on {self.host}:{self.port}{' (TLS)' if self.ssl_context else ''}")
+        if self.storage_path:
+            print(f"Storing received messages in {self.storage_path}")
+        background = [asyncio.create_task(self._flush_storage())]
+        if not self.quiet and stats_interval:
+            background.append(asyncio.create_task(self._report_stats(stats_interval)))
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            for task in background:
+                task.cancel()
+            self.close_storage()
+            print(f"[receiver] {self.stats.summary()}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Local asyncio MLLP receiver for testing send_hl7.py')
+    parser.add_argument('--host', type=str, default=DEFAULT_HOST, help='Address to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Port to listen on')
+    parser.add_argument('--ae-ratio', type=float, default=0.0, help='Fraction of messages answered with AE')
+    parser.add_argument('--ar-ratio', type=float, default=0.0, help='Fraction of messages answered with AR')
+    parser.add_argument('--ack-delay', type=float, default=0.0, help='Delay in seconds before each ACK is sent')
+    parser.add_argument('--ack-jitter', type=float, default=0.0, help='Extra random ACK delay of up to this many seconds')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='Probability of dropping the connection instead of acknowledging a message')
+    parser.add_argument('--storage', type=str, default=DEFAULT_STORAGE_DIR, help='Directory for the append-only storage file')
+    parser.add_argument('--no-store', action='store_true', help='Do not store received messages')
+    parser.add_argument('--flush-interval', type=float, default=DEFAULT_FLUSH_INTERVAL, help='Seconds between storage flushes')
+    parser.add_argument('--stats-interval', type=float, default=DEFAULT_STATS_INTERVAL, help='Seconds between throughput reports (0 to disable)')
+    parser.add_argument('--seed', type=int, help='Random seed for ACK codes, delays and drops')
+    parser.add_argument('--quiet', action='store_true', help='Only print the final summary')
+    parser.add_argument('--batch-ack', type=str, default='errors', choices=BATCH_ACK_MODES, help='Messages of an HL7 batch that get an ACK in the batch acknowledgment: those not accepted, or all')
+    parser.add_argument('--tls-cert', type=str, help='Serve MLLP over TLS with this certificate (PEM)')
+    parser.add_argument('--tls-key', type=str, help='Private key for --tls-cert if it is not in the same file')
+    parser.add_argument('--tls-client-ca', type=str, help='Require client certificates signed by this CA')
+
+    args = parser.parse_args()
+
+    ssl_context = None
+    if args.tls_cert:
+        from mllp_tls import server_context
+        try:
+            ssl_context = server_context(args.tls_cert, args.tls_key, args.tls_client_ca)
+        except (OSError, ValueError) as e:
+            parser.error(f"Cannot load TLS certificates: {e}")
+    elif args.tls_key or args.tls_client_ca:
+        parser.error("--tls-key and --tls-client-ca need --tls-cert")
+
+    try:
+        receiver = MLLPReceiver(args.host, args.port, args.ae_ratio, args.ar_ratio, args.ack_delay,
+                                args.ack_jitter, args.drop_rate, None if args.no_store else args.storage,
+                                args.flush_interval, args.seed, args.quiet, ssl_context,
+                                args.batch_ack)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Treat SIGTERM like Ctrl-C so the storage file is flushed and counters are printed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncio.run(receiver.serve(args.stats_interval))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""
+MLLP over TLS
+
+TLS settings shared by the MLLP senders and the local receiver, for sites that
+tunnel MLLP over TLS:
+
+- client certificates (mutual TLS)
+- CA pinning: with ``--tls-ca`` only that CA is trusted, not the system store,
+  and ``--tls-pin`` additionally requires the receiver's certificate to have a
+  given SHA-256 fingerprint
+- session resumption: the session (or TLS 1.3 ticket) of each connection is
+  kept per destination and offered on the next connect, so a reconnect costs an
+  abbreviated handshake instead of a full one
+
+Run as a script, it writes a throwaway CA with server and client certificates
+for testing against ``mllp_receiver.py --tls-cert``:
+
+    python mllp_tls.py --make-certs certs
+"""
+import os
+import ssl
+import hashlib
+import argparse
+import subprocess
+import tempfile
+
+from metrics import METRICS
+
+def certificate_fingerprint(der):
+    """SHA-256 fingerprint of a DER certificate as lowercase hex"""
+    return hashlib.sha256(der).hexdigest()
+
+def file_fingerprint(cert_file):
+    """SHA-256 fingerprint of the (first) certificate in a PEM file"""
+    with open(cert_file) as f:
+        return certificate_fingerprint(ssl.PEM_cert_to_DER_cert(f.read()))
+
+def normalize_pin(pin):
+    """Accept fingerprints as plain hex or colon-separated, in either case"""
+    return pin.replace(':', '').strip().lower() if pin else None
+
+class PinMismatchError(ssl.SSLError):
+    """The receiver's certificate does not have the pinned fingerprint"""
+
+    def __str__(self):
+        return self.args[0]
+
+class TLSClient:
+    """Client-side TLS for MLLP connections, resuming sessions across reconnects
+
+    One instance is shared by every connection of a run. ``server_name`` is the
+    name checked against the receiver's certificate when it differs from the
+    host connected to (e.g. when connecting by IP address).
+    """
+
+    def __init__(self, ca_file=None, cert_file=None, key_file=None, pin=None, server_name=None):
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.context.minimum_version = ssl.TLSVersion.TLSv1_2
+        if ca_file:
+            self.context.load_verify_locations(ca_file)
+        else:
+            self.context.load_default_certs()
+        if cert_file:
+            self.context.load_cert_chain(cert_file, key_file)
+        self.pin = normalize_pin(pin)
+        self.server_name = server_name
+        # (host, port) -> SSLSession of the last connection to that destination
+        self.sessions = {}
+
+    def check_pin(self, ssl_object):
+        """Raise ``PinMismatchError`` unless the peer certificate matches the pinned fingerprint"""
+        if self.pin is None:
+            return
+        fingerprint = certificate_fingerprint(ssl_object.getpeercert(binary_form=True))
+        if fingerprint != self.pin:
+            raise PinMismatchError(f"Server certificate fingerprint {fingerprint} does not match the pinned {self.pin}")
+
+    def wrap(self, sock, host, port):
+        """Run the TLS handshake on a connected socket, offering the last session for the destination"""
+        tls_sock = self.context.wrap_socket(sock, server_hostname=self.server_name or host,
+                                            session=self.sessions.get((host, port)))
+        try:
+            self.check_pin(tls_sock)
+        except ssl.SSLError:
+            tls_sock.close()
+            raise
+        METRICS.count('tls_handshakes', 'resumed' if tls_sock.session_reused else 'full')
+        return tls_sock
+
+    def save_session(self, tls_sock, host, port):
+        """Keep a connection's session for the next connect to the same destination
+
+        TLS 1.3 tickets arrive after the handshake, so this is called when the
+        connection is closed rather than when it is opened.
+        """
+        session = getattr(tls_sock, 'session', None)
+        if session is not None:
+            self.sessions[(host, port)] = session
+
+def server_context(cert_file, key_file=None, client_ca=None):
+    """TLS context for the receiver; with ``client_ca`` clients must present a certificate it signed"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert_file, key_file)
+    if client_ca:
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.load_verify_locations(client_ca)
+    return context
+
+def _openssl(*args):
+    subprocess.run(['openssl', *args], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+def _issue(directory, name, subject, extensions):
+    """Write ``name.key`` and ``name.crt`` signed by the test CA in ``directory``"""
+    key, csr, crt = (os.path.join(directory, f"{name}.{suffix}") for suffix in ('key', 'csr', 'crt'))
+    _openssl('req', '-new', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+             '-keyout', key, '-out', csr, '-subj', subject)
+    with tempfile.NamedTemporaryFile('w', suffix='.ext', delete=False) as ext:
+        ext.write('\n'.join(extensions) + '\n')
+    try:
+        _openssl('x509', '-req', '-in', csr, '-CA', os.path.join(directory, 'ca.crt'),
+                 '-CAkey', os.path.join(directory, 'ca.key'), '-CAcreateserial', '-days', '365',
+                 '-out', crt, '-extfile', ext.name)
+    finally:
+        os.remove(ext.name)
+        os.remove(csr)
+    return crt
+
+def generate_test_certificates(directory, hostnames=('localhost', '127.0.0.1')):
+    """Write a self-signed CA plus server and client certificates for local TLS testing
+
+    Needs the ``openssl`` command. Returns the paths by role.
+    """
+    os.makedirs(directory, exist_ok=True)
+    _openssl('req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+             '-keyout', os.path.join(directory, 'ca.key'), '-out', os.path.join(directory, 'ca.crt'),
+             '-days', '365', '-subj', '/CN=HL7 Sender Test CA',
+             '-addext', 'basicConstraints=critical,CA:TRUE', '-addext', 'keyUsage=critical,keyCertSign,cRLSign')
+    names = ','.join(f"IP:{name}" if name.replace('.', '').isdigit() else f"DNS:{name}" for name in hostnames)
+    common = ['basicConstraints=CA:FALSE', 'keyUsage=critical,digitalSignature',
+              'subjectKeyIdentifier=hash', 'authorityKeyIdentifier=keyid,issuer']
+    server = _issue(directory, 'server', f"/CN={hostnames[0]}",
+                    common + [f'subjectAltName={names}', 'extendedKeyUsage=serverAuth'])
+    client = _issue(directory, 'client', '/CN=hl7-sender', common + ['extendedKeyUsage=clientAuth'])
+    return {'ca': os.path.join(directory, 'ca.crt'), 'server': server, 'client': client}
+
+def main():
+    parser = argparse.ArgumentParser(description='Create self-signed certificates for testing MLLP over TLS')
+    parser.add_argument('--make-certs', type=str, required=True, metavar='DIR', help='Directory to write ca/server/client certificates and keys to')
+    parser.add_argument('--hostname', type=str, action='append', help='Name or IP the server certificate is valid for (repeatable; default: localhost and 127.0.0.1)')
+    args = parser.parse_args()
+
+    try:
+        paths = generate_test_certificates(args.make_certs, args.hostname or ('localhost', '127.0.0.1'))
+    except FileNotFoundError:
+        parser.error("the openssl command is required to create certificates")
+    except subprocess.CalledProcessError as e:
+        parser.error(f"openssl failed: {e.stderr.decode(errors='replace').strip()}")
+    print(f"Test CA:            {paths['ca']}")
+    print(f"Server certificate: {paths['server']} (key {paths['server'][:-4]}.key)")
+    print(f"Client certificate: {paths['client']} (key {paths['client'][:-4]}.key)")
+    print(f"Server SHA-256 pin: {file_fingerprint(paths['server'])}")
+
+if __name__ == "__main__":
+    main()
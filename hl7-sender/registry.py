@@ -0,0 +1,382 @@
+"""
+Patient and Order Registry
+
+Generates corpora whose messages refer to each other the way a real RIS feed
+does: results (ORU^R01) are for orders placed earlier in the corpus (ORM^O01
+NW), cancellations (ORM CA) close open orders, demographic updates (ADT^A08)
+change patients that exist, and merges (ADT^A40) join two real patient IDs,
+after which only the surviving ID is used.
+
+Patients and open orders are stored in typed ``array`` columns, a few dozen
+bytes per entity instead of a dict each, so a registry of millions of
+patients fits in tens of MB. Names, dates of birth, procedures and free text are
+indexes into the Faker pools of :class:`bulk_generator.BulkGenerator`, and
+messages are rendered with its compiled templates.
+
+MSH-7 advances steadily through the corpus (about one message per
+``MESSAGE_INTERVAL`` seconds, ending at the base time), so every ORU is dated
+after its ORM.
+"""
+import random
+from array import array
+from datetime import timedelta
+
+from bulk_generator import BulkGenerator, COMPILED_TEMPLATES, DEFAULT_BATCH_SIZE, DEFAULT_POOL_SIZE
+from generate_hl7 import INSTITUTION_NAMES, MESSAGE_TYPES
+from sample_data.templates import GENDER_CODES, MODALITY_CODES, PATIENT_CLASSES, PRIORITIES
+
+DEFAULT_PATIENTS = 100000
+DEFAULT_MAX_OPEN_ORDERS = 100000
+
+# Relative frequency of each message type in a workflow corpus
+DEFAULT_MIX = {'orm': 45, 'oru': 35, 'adt_a08': 15, 'adt_a40': 5}
+CANCEL_RATIO = 0.1       # share of ORM messages that cancel an open order instead of placing one
+RENAME_RATIO = 0.2       # share of ADT^A08 updates that change the patient's name
+MESSAGE_INTERVAL = 1.0   # mean seconds between messages on the MSH-7 timeline
+
+# Bases of the sequential identifiers
+ACCESSION_BASE = 100000
+ADMISSION_BASE = 100000
+STUDY_UID_BASE = 1000000
+PROCEDURE_ID_BASE = 10000
+ID_MULTIPLIER = 2654435761  # coprime to 9 * 10**k, so patient_id() is a bijection
+
+def parse_mix(text):
+    """Parse ``orm=45,oru=35,...`` into a dict of message type weights"""
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip().lower()
+        if name not in MESSAGE_TYPES:
+            raise ValueError(f"Unknown message type in mix: {name!r}")
+        try:
+            mix[name] = float(weight)
+        except ValueError:
+            raise ValueError(f"Invalid weight for {name}: {weight!r}") from None
+    return mix
+
+def _zeros(typecode, n):
+    """A zero-filled array of ``n`` items"""
+    return array(typecode, bytes(array(typecode).itemsize * n))
+
+class PatientRegistry:
+    """Fixed-capacity patient table with merge tracking
+
+    Slot ``i`` is born the first time it is picked, so early orders are mostly
+    for new patients and later ones increasingly for returning patients. With
+    ``partitions`` > 1 each generator owns every ``partitions``-th global slot,
+    which keeps patient and admission IDs unique across shards.
+    """
+
+    def __init__(self, capacity, rng, pools, partition=0, partitions=1):
+        self.capacity = capacity
+        self.rng = rng
+        self.partition = partition
+        self.partitions = partitions
+        first_names, first_offsets, first_lengths = pools['first_names']
+        self.first_offsets = first_offsets.tolist()
+        self.first_lengths = first_lengths.tolist()
+        self.last_name_count = len(pools['last_names'])
+        self.dob_count = len(pools['dobs'])
+
+        # Patient IDs have the same 6 digits as the standard generator unless
+        # the registry needs more
+        digits = 6
+        while 9 * 10 ** (digits - 1) < capacity * partitions:
+            digits += 1
+        self.id_low = 10 ** (digits - 1)
+        self.id_span = 9 * 10 ** (digits - 1)
+
+        self.admission = _zeros('I', capacity)  # 0 until the slot is born
+        self.last_name = _zeros('I', capacity)
+        self.first_name = _zeros('I', capacity)
+        self.gender = _zeros('B', capacity)
+        self.dob = _zeros('H', capacity)
+        self.weight = _zeros('B', capacity)
+        self.merged_into = array('i', [-1]) * capacity
+        self.born = array('i')
+        self.admissions = 0
+        self.merges = 0
+
+    def patient_id(self, slot):
+        """Unique, scattered numeric patient ID of a slot"""
+        global_slot = self.partition + slot * self.partitions
+        return self.id_low + (global_slot + 1) * ID_MULTIPLIER % self.id_span
+
+    def _next_admission(self):
+        self.admissions += 1
+        return ADMISSION_BASE + self.partition + self.admissions * self.partitions
+
+    def _create(self, slot):
+        # int(random() * n) rather than randrange(): a fraction of the cost and
+        # uniform enough for test data
+        random = self.rng.random
+        gender = int(random() * len(GENDER_CODES))
+        self.gender[slot] = gender
+        self.first_name[slot] = self.first_offsets[gender] + int(random() * self.first_lengths[gender])
+        self.last_name[slot] = int(random() * self.last_name_count)
+        self.dob[slot] = int(random() * self.dob_count)
+        self.weight[slot] = 50 + int(random() * 71)
+        self.admission[slot] = self._next_admission()
+        self.born.append(slot)
+
+    def resolve(self, slot):
+        """Surviving slot of a (possibly merged) patient"""
+        merged_into = self.merged_into
+        while merged_into[slot] >= 0:
+            survivor = merged_into[slot]
+            if merged_into[survivor] >= 0:
+                merged_into[slot] = merged_into[survivor]  # path halving
+            slot = survivor
+        return slot
+
+    def pick(self):
+        """A patient for a new order: any slot, born on first use"""
+        slot = int(self.rng.random() * self.capacity)
+        if not self.admission[slot]:
+            self._create(slot)
+        return self.resolve(slot)
+
+    @property
+    def survivors(self):
+        """Born patients that have not been merged into another"""
+        return len(self.born) - self.merges
+
+    def pick_existing(self):
+        """An existing patient (one is born if there is none yet)"""
+        if not self.born:
+            return self.pick()
+        return self.resolve(self.born[int(self.rng.random() * len(self.born))])
+
+    def update(self, slot):
+        """Apply an ADT^A08 change: a new visit, sometimes a new last name"""
+        self.admission[slot] = self._next_admission()
+        if self.rng.random() < RENAME_RATIO:
+            self.last_name[slot] = int(self.rng.random() * self.last_name_count)
+
+    def merge(self, old, survivor):
+        """Record that ``old`` was merged into ``survivor`` (ADT^A40)"""
+        self.merged_into[old] = survivor
+        self.merges += 1
+
+class OrderBook:
+    """Open orders as fixed-width records in one flat integer array
+
+    A closed order is overwritten by the last record, so opening and closing an
+    order are each a single slice operation.
+    """
+
+    FIELDS = ('number', 'patient', 'ordered_at', 'modality', 'procedure', 'priority', 'patient_class',
+              'reason', 'referring', 'requesting', 'performing')
+    WIDTH = len(FIELDS)
+
+    def __init__(self):
+        self.records = array('q')
+
+    def __len__(self):
+        return len(self.records) // self.WIDTH
+
+    def add(self, values):
+        """Open an order from a tuple of values in ``FIELDS`` order"""
+        self.records.extend(values)
+
+    def take(self, index):
+        """Close the order at ``index`` and return its values"""
+        records = self.records
+        start = index * self.WIDTH
+        end = start + self.WIDTH
+        values = records[start:end].tolist()
+        if end < len(records):
+            records[start:end] = records[-self.WIDTH:]
+        del records[-self.WIDTH:]
+        return values
+
+class WorkflowGenerator:
+    """Generates a referentially consistent ORM/ORU/ADT message stream"""
+
+    def __init__(self, message_types=None, mix=None, patients=DEFAULT_PATIENTS, seed=None,
+                 pool_size=DEFAULT_POOL_SIZE, base_time=None, max_open_orders=DEFAULT_MAX_OPEN_ORDERS,
+                 partition=0, partitions=1, first_message=0, total_messages=0):
+        # Vectorized columns (control IDs, applications, report text) come from
+        # the bulk generator; the registry draws its own sequential choices
+        self.bulk = BulkGenerator(seed, pool_size, base_time)
+        self.rng = random.Random(seed)
+        mix = dict(mix or DEFAULT_MIX)
+        if message_types is not None:
+            mix = {name: weight for name, weight in mix.items() if name in message_types}
+        self.kinds = [name for name, weight in mix.items() if weight > 0]
+        if not self.kinds:
+            raise ValueError("The message mix selects no message types")
+        self.weights = [mix[name] for name in self.kinds]
+        # Without orders, patients first appear in ADT^A08 updates (they predate the corpus)
+        self.adt_only = 'orm' not in self.kinds and 'oru' not in self.kinds
+        self.max_open_orders = max_open_orders
+        self.partition = partition
+        self.partitions = partitions
+
+        self.last_names = self.bulk.last_names.tolist()
+        self.first_names = self.bulk.first_names[0].tolist()
+        self.dobs = self.bulk.dobs.tolist()
+        self.sentences = self.bulk.sentences.tolist()
+        self.sps_descriptions = self.bulk.sps_descriptions[0].tolist()
+        self.rp_descriptions = self.bulk.rp_descriptions[0].tolist()
+        self.procedure_offsets = self.bulk.sps_descriptions[1].tolist()
+        self.procedure_counts = self.bulk.sps_descriptions[2].tolist()
+
+        pools = {'first_names': self.bulk.first_names, 'last_names': self.last_names, 'dobs': self.dobs}
+        capacity = -(-patients // partitions)
+        self.patients = PatientRegistry(capacity, self.rng, pools, partition, partitions)
+        self.orders = OrderBook()
+        self.order_count = 0
+
+        # The timeline ends at the base time; a shard starts where the previous one ended
+        self.position = first_message
+        start = self.bulk.base_time - timedelta(seconds=total_messages * MESSAGE_INTERVAL)
+        self.start_date = start.date()
+        self.start_offset = start.hour * 3600 + start.minute * 60 + start.second
+        self._days = {}
+
+    def _timestamp_for(self, seconds):
+        """MSH-7 style timestamp ``seconds`` after the start of the timeline"""
+        day, second = divmod(self.start_offset + seconds, 86400)
+        date = self._days.get(day)
+        if date is None:
+            date = self._days[day] = (self.start_date + timedelta(days=day)).strftime('%Y%m%d')
+        hour, second = divmod(second, 3600)
+        return '%s%02d%02d%02d' % (date, hour, second // 60, second % 60)
+
+    def _patient_fields(self, slot, message):
+        patients = self.patients
+        message['patient_id'] = patients.patient_id(slot)
+        message['patient_name'] = (f"{self.last_names[patients.last_name[slot]]}^"
+                                   f"{self.first_names[patients.first_name[slot]]}")
+        message['dob'] = self.dobs[patients.dob[slot]]
+        message['gender'] = GENDER_CODES[patients.gender[slot]]
+        message['admission_id'] = patients.admission[slot]
+        message['patient_weight'] = patients.weight[slot]
+
+    def _new_order(self, now):
+        random = self.rng.random
+        self.order_count += 1
+        modality = int(random() * len(MODALITY_CODES))
+        last_names = len(self.last_names)
+        values = (
+            self.partition + self.order_count * self.partitions, self.patients.pick(), now, modality,
+            self.procedure_offsets[modality] + int(random() * self.procedure_counts[modality]),
+            int(random() * len(PRIORITIES)), int(random() * len(PATIENT_CLASSES)),
+            int(random() * len(self.sentences)), int(random() * last_names), int(random() * last_names),
+            int(random() * last_names),
+        )
+        self.orders.add(values)
+        return values
+
+    def _order_fields(self, values, message):
+        (number, patient, ordered_at, modality, procedure, priority, patient_class, reason, referring,
+         requesting, performing) = values
+        self._patient_fields(self.patients.resolve(patient), message)
+        message.update({
+            'patient_class': PATIENT_CLASSES[patient_class],
+            'referring_physician': self.last_names[referring],
+            'requesting_physician': self.last_names[requesting],
+            'performing_physician': self.last_names[performing],
+            'accession_number': ACCESSION_BASE + number,
+            'sps_id': PROCEDURE_ID_BASE + number,
+            'sps_description': self.sps_descriptions[procedure],
+            'rp_id': PROCEDURE_ID_BASE + number,
+            'rp_description': self.rp_descriptions[procedure],
+            # Scheduled station details are derived from the order number so
+            # the ORM and ORU agree without storing them
+            'ss_name': 100 + number % 900,
+            'ss_aetitle': 1 + number % 9,
+            'sps_location': 1 + number % 20,
+            'modality': MODALITY_CODES[modality],
+            'priority': PRIORITIES[priority],
+            'reason_for_study': self.sentences[reason],
+            'sps_start_datetime': self._timestamp_for(ordered_at),
+            'institution_name': INSTITUTION_NAMES[number % len(INSTITUTION_NAMES)],
+            'study_instance_uid': STUDY_UID_BASE + number,
+            'study_id': PROCEDURE_ID_BASE + number,
+            'study_description': self.sps_descriptions[procedure],
+        })
+
+    def _next_kind(self, kind):
+        """Adjust a drawn message type to what the registry can support"""
+        if kind == 'oru' and not self.orders and 'orm' in self.kinds:
+            return 'orm'
+        if kind == 'orm' and len(self.orders) >= self.max_open_orders and 'oru' in self.kinds:
+            return 'oru'
+        if kind == 'adt_a40' and self.patients.survivors < 2:
+            kind = 'adt_a08'  # a merge needs two patients that have appeared in earlier messages
+        if kind == 'adt_a08' and not self.patients.born and 'orm' in self.kinds:
+            return 'orm'
+        return kind
+
+    def generate_batch(self, n):
+        """Generate the next ``n`` messages of the stream"""
+        rng = self.rng
+        kinds = rng.choices(self.kinds, self.weights, k=n)
+        header = self.bulk._header_columns(n)
+        report = self.bulk._report_columns(n)
+        physicians = self.bulk._choice(self.bulk.last_names, n)
+        radiologist_ids = self.bulk._numbers(1000, 9999, n)
+        header_fields = list(header)
+        messages = []
+        for i, kind in enumerate(kinds):
+            kind = self._next_kind(kind)
+            seconds = int((self.position + rng.random()) * MESSAGE_INTERVAL)
+            self.position += 1
+            now = self._timestamp_for(seconds)
+            message = {field: header[field][i] for field in header_fields}
+            message['datetime'] = now
+
+            if kind == 'orm':
+                if self.orders and rng.random() < CANCEL_RATIO:
+                    values = self.orders.take(int(rng.random() * len(self.orders)))
+                    message['order_control'] = 'CA'
+                else:
+                    values = self._new_order(seconds)
+                    message['order_control'] = 'NW'
+                self._order_fields(values, message)
+            elif kind == 'oru':
+                if self.orders:
+                    values = self.orders.take(int(rng.random() * len(self.orders)))
+                else:
+                    # Only results were requested: the order predates the corpus
+                    values = self._new_order(seconds)
+                    self.orders.take(len(self.orders) - 1)
+                message['order_control'] = 'RE'  # Results
+                self._order_fields(values, message)
+                for field in report:
+                    message[field] = report[field][i]
+                message['report_date'] = now
+                message['radiologist_id'] = radiologist_ids[i]
+                message['radiologist_name'] = physicians[i]
+            elif kind == 'adt_a08':
+                slot = self.patients.pick() if self.adt_only else self.patients.pick_existing()
+                self.patients.update(slot)
+                self._patient_fields(slot, message)
+            else:
+                survivor = self.patients.pick_existing()
+                old = self.patients.pick_existing()
+                while old == survivor:
+                    old = self.patients.pick_existing()
+                self.patients.merge(old, survivor)
+                message['patient_id_new'] = self.patients.patient_id(survivor)
+                message['patient_id_old'] = self.patients.patient_id(old)
+
+            messages.append(COMPILED_TEMPLATES[kind].render_mapping(message))
+        return messages
+
+def generate_workflow(message_types, count, mix=None, patients=DEFAULT_PATIENTS, batch_size=DEFAULT_BATCH_SIZE,
+                      seed=None, pool_size=DEFAULT_POOL_SIZE, base_time=None,
+                      max_open_orders=DEFAULT_MAX_OPEN_ORDERS, partition=0, partitions=1, first_message=0,
+                      total_messages=None):
+    """Yield batches of workflow messages until ``count`` messages (of all types) were generated"""
+    generator = WorkflowGenerator(message_types, mix, patients, seed, pool_size, base_time, max_open_orders,
+                                  partition, partitions, first_message,
+                                  count if total_messages is None else total_messages)
+    remaining = count
+    while remaining > 0:
+        n = min(batch_size, remaining)
+        yield generator.generate_batch(n)
+        remaining -= n
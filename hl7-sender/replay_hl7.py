@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+"""
+HL7 Traffic Replay
+
+Re-sends captured traffic to an MLLP receiver (e.g. a staging PACS) with the
+original inter-arrival gaps, optionally sped up. Sources can be any mix of:
+
+- storage directories written by the receivers (one ``.hl7`` file per message,
+  named ``YYYYMMDD_HHMMSS_...``)
+- large capture files in any corpus layout, such as the MLLP storage file of
+  mllp_receiver.py
+
+Each source is read as a stream in its stored order (directories in file name
+order) and put in timestamp order with a small reorder buffer. The streams are
+then heap-merged into one timeline ordered by MSH-7, or by the file name
+timestamp. Memory stays bounded however many files there are: directories are
+listed in sorted chunks, only one file per source is open at a time, and at
+most ``--reorder-window`` messages per source are held.
+"""
+import os
+import re
+import time
+import heapq
+import calendar
+import argparse
+from dotenv import load_dotenv
+from corpus import iter_hl7_messages, INDEX_SUFFIX, CORPUS_FORMATS
+from hl7_message import HL7Message
+from metrics import METRICS
+from send_log import log, summary, setup_logging, shutdown_logging, LOG_LEVELS
+from send_hl7 import DEFAULT_HOST, DEFAULT_PORT, DEFAULT_ACK_TIMEOUT, DEFAULT_WINDOW, MLLPConnection, report_mllp_result
+
+# Load environment variables
+load_dotenv()
+
+DEFAULT_REORDER_WINDOW = 1000  # messages held per source to fix local disorder
+DIRECTORY_CHUNK = 65536  # file names held at a time while listing a directory
+
+FILENAME_TIMESTAMP = re.compile(r'(\d{8})_(\d{6})')
+HL7_TIMESTAMP = re.compile(r'(\d{4})(\d{2})?(\d{2})?(\d{2})?(\d{2})?(\d{2})?(\.\d+)?([+-]\d{4})?$')
+
+def parse_hl7_timestamp(value):
+    """Seconds since the epoch for an HL7 TS value (``YYYY[MM[DD[HH[MM[SS[.S]]]]]][+/-ZZZZ]``)
+
+    Values without a UTC offset are taken as UTC, which keeps the gaps between
+    them right. Returns None for a missing or malformed value.
+    """
+    match = HL7_TIMESTAMP.match(value or '')
+    if not match:
+        return None
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    try:
+        seconds = calendar.timegm((int(year), int(month or 1), int(day or 1), int(hour or 0),
+                                   int(minute or 0), int(second or 0), 0, 0, 0))
+    except (ValueError, OverflowError):
+        return None
+    if fraction:
+        seconds += float(fraction)
+    if offset:
+        sign = -1 if offset[0] == '+' else 1
+        seconds += sign * (int(offset[1:3]) * 3600 + int(offset[3:5]) * 60)
+    return seconds
+
+def filename_timestamp(name):
+    """Seconds since the epoch for a ``YYYYMMDD_HHMMSS`` timestamp in a file name, or None"""
+    match = FILENAME_TIMESTAMP.search(name)
+    return parse_hl7_timestamp(match.group(1) + match.group(2)) if match else None
+
+def iter_sorted_names(directory, chunk=DIRECTORY_CHUNK):
+    """Names of the files in ``directory`` in sorted order, holding at most ``chunk`` at a time
+
+    Each pass over the directory takes the next ``chunk`` smallest names, so a
+    directory of millions of files costs a few extra listings rather than memory.
+    """
+    last = ''
+    while True:
+        with os.scandir(directory) as entries:
+            names = heapq.nsmallest(chunk, (
+                entry.name for entry in entries
+                if entry.name > last and not entry.name.startswith('.')
+                and not entry.name.endswith(INDEX_SUFFIX) and entry.is_file()
+            ))
+        yield from names
+        if len(names) < chunk:
+            return
+        last = names[-1]
+
+def iter_source(path, fmt='auto', order_by='msh7'):
+    """Yield ``(timestamp, message)`` from a capture file or storage directory in stored order
+
+    The timestamp is MSH-7 (``order_by='msh7'``) or the file name timestamp
+    (``order_by='filename'``), each falling back to the other. Messages with
+    neither inherit the previous timestamp.
+    """
+    if os.path.isdir(path):
+        files = ((os.path.join(path, name), filename_timestamp(name)) for name in iter_sorted_names(path))
+    else:
+        files = [(path, filename_timestamp(os.path.basename(path)))]
+    previous = None
+    for file_path, file_time in files:
+        for message in iter_hl7_messages(file_path, fmt):
+            if order_by == 'filename' and file_time is not None:
+                timestamp = file_time
+            else:
+                timestamp = parse_hl7_timestamp(HL7Message(message).field('MSH', 7)) or file_time
+            if timestamp is None:
+                timestamp = previous
+            previous = timestamp
+            yield timestamp, message
+
+def reorder(stream, window=DEFAULT_REORDER_WINDOW):
+    """Sort a nearly ordered ``(timestamp, message)`` stream with a heap of at most ``window`` entries
+
+    Messages out of place by fewer than ``window`` positions come out in
+    timestamp order; ties keep their stored order.
+    """
+    heap = []
+    for sequence, (timestamp, message) in enumerate(stream):
+        # Messages without any timestamp sort first and are sent without delay
+        heapq.heappush(heap, (timestamp if timestamp is not None else float('-inf'), sequence, message))
+        if len(heap) > window:
+            timestamp, _, message = heapq.heappop(heap)
+            yield timestamp, message
+    while heap:
+        timestamp, _, message = heapq.heappop(heap)
+        yield timestamp, message
+
+def merge_sources(paths, fmt='auto', order_by='msh7', window=DEFAULT_REORDER_WINDOW):
+    """One timeline of ``(timestamp, message)`` across all sources"""
+    streams = [reorder(iter_source(path, fmt, order_by), window) for path in paths]
+    return heapq.merge(*streams, key=lambda item: item[0])
+
+def replay(timeline, host, port, speed=1.0, max_gap=None, timeout=DEFAULT_ACK_TIMEOUT, window=DEFAULT_WINDOW):
+    """Send a timeline over one pipelined MLLP connection, keeping its gaps
+
+    Gaps are divided by ``speed``; a speed of 0 sends as fast as possible.
+    ``max_gap`` caps any single gap (in original seconds), e.g. to skip quiet
+    nights. Returns ``(success_count, total_count, max_lag)`` where ``max_lag``
+    is how far (seconds) sending fell behind the schedule.
+    """
+    connection = MLLPConnection(host, port, timeout, window)
+    success_count = 0
+    total_count = 0
+    max_lag = 0.0
+    start = None
+    offset = 0.0  # scheduled send time relative to the first message, in original seconds
+    previous = None
+    try:
+        for timestamp, message in timeline:
+            if speed > 0 and timestamp is not None and timestamp != float('-inf'):
+                if start is None:
+                    start = time.perf_counter()
+                elif previous is not None:
+                    gap = max(timestamp - previous, 0.0)
+                    offset += min(gap, max_gap) if max_gap is not None else gap
+                previous = timestamp
+                wait = start + offset / speed - time.perf_counter()
+                if wait > 0:
+                    # Read ACKs while waiting, so the gap does not count as ACK latency
+                    for result in connection.poll(wait):
+                        success_count += report_mllp_result(result, latency=connection.latency(result[0]))
+                else:
+                    max_lag = max(max_lag, -wait)
+            total_count += 1
+            for result in connection.send(message):
+                success_count += report_mllp_result(result, latency=connection.latency(result[0]))
+        for result in connection.flush():
+            success_count += report_mllp_result(result, latency=connection.latency(result[0]))
+    finally:
+        connection.close()
+    return success_count, total_count, max_lag
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured HL7 traffic to an MLLP receiver with its original timing')
+    parser.add_argument('sources', nargs='+', help='Storage directories (one message per file) and/or capture files')
+    parser.add_argument('--format', type=str, default='auto', choices=CORPUS_FORMATS, help='Layout of the capture files (default: detect)')
+    parser.add_argument('--host', type=str, default=DEFAULT_HOST, help='HL7 MLLP server hostname or IP')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='HL7 MLLP server port')
+    parser.add_argument('--timeout', type=int, default=DEFAULT_ACK_TIMEOUT, help='Timeout for acknowledgment in seconds')
+    parser.add_argument('--window', type=int, default=DEFAULT_WINDOW, help='Maximum unacknowledged MLLP messages in flight')
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay speed factor (1 = original timing, 10 = ten times faster, 0 = as fast as possible)')
+    parser.add_argument('--max-gap', type=float, help='Cap any gap between messages at this many (original) seconds')
+    parser.add_argument('--order-by', type=str, default='msh7', choices=['msh7', 'filename'], help='Order and time messages by MSH-7 or by the storage file name timestamp')
+    parser.add_argument('--reorder-window', type=int, default=DEFAULT_REORDER_WINDOW, help='Messages buffered per source to put slightly out-of-order captures in time order')
+    parser.add_argument('--log-level', type=str.upper, default='INFO', choices=LOG_LEVELS, help='Console log level')
+    parser.add_argument('--log-sample', type=int, default=1, help='Log only one in every N accepted messages')
+    parser.add_argument('--quiet', action='store_true', help='Only print errors and the end-of-run summary')
+    parser.add_argument('--results', type=str, help='Write one JSON line per message to this file')
+
+    args = parser.parse_args()
+    if args.speed < 0:
+        parser.error("--speed must be 0 or positive")
+    for source in args.sources:
+        if not os.path.exists(source):
+            parser.error(f"No such file or directory: {source}")
+
+    setup_logging(args.log_level, args.quiet, args.log_sample, args.results)
+    try:
+        pace = f"{args.speed:g}x" if args.speed else "as fast as possible"
+        log.info("Replaying %s to MLLP server at %s:%s (%s)...", ", ".join(args.sources), args.host, args.port, pace)
+        timeline = METRICS.timed(merge_sources(args.sources, args.format, args.order_by, args.reorder_window), 'read')
+        started = time.perf_counter()
+        try:
+            success_count, total_count, max_lag = replay(timeline, args.host, args.port, args.speed, args.max_gap,
+                                                         args.timeout, args.window)
+        except (OSError, ValueError) as e:
+            log.error("Error reading captured messages: %s", e)
+            return
+        elapsed = time.perf_counter() - started
+        summary.info("\nReplay complete. Successfully sent %d/%d messages in %.1fs.", success_count, total_count, elapsed)
+        if args.speed and max_lag > 0.001:
+            summary.info("Fell behind the original timing by up to %.3fs.", max_lag)
+    finally:
+        shutdown_logging()
+
+if __name__ == "__main__":
+    main()
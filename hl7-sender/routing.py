@@ -0,0 +1,197 @@
+"""
+Message Routing and Fan-Out
+
+Sends one input stream to several MLLP destinations (PACS, VNA, worklist, ...).
+A JSON routing file names the destinations and maps each message to one or
+more of them by MSH-5 (receiving application) and MSH-9 (message type):
+
+    {
+      "destinations": {
+        "pacs":     {"host": "pacs.local", "port": 2575, "sessions": 4, "window": 16},
+        "vna":      {"host": "vna.local",  "port": 2575, "sessions": 2},
+        "worklist": {"host": "mwl.local",  "port": 2576}
+      },
+      "routes": [
+        {"message_type": "ORU^*", "to": ["pacs", "vna"]},
+        {"receiving_application": "WORKLIST*", "message_type": ["ORM^O01", "ADT^*"], "to": "worklist"}
+      ],
+      "default": ["pacs"]
+    }
+
+Routes are tried in order and the first match wins; patterns use shell-style
+wildcards and an omitted field matches anything. Messages no route matches go to
+``default`` (or are skipped, with a warning, if there is none).
+
+Each destination has its own pool of pipelined sessions. Messages are
+partitioned across a pool by a consistent hash of PID-3, so every message for a
+patient travels over the same connection, in input order, while different
+patients are sent in parallel. Messages without a PID segment are spread by
+control ID. Session queues are bounded, so a slow destination holds back the
+reader rather than buffering the input in memory.
+"""
+import json
+import bisect
+import asyncio
+import hashlib
+from fnmatch import fnmatchcase
+
+from async_sender import AsyncMLLPSession
+from hl7_message import HL7Message
+from mllp_codec import EncodedFrame, encode_frame
+from send_log import log, summary
+from send_hl7 import DEFAULT_ACK_TIMEOUT, DEFAULT_WINDOW, to_wire_bytes
+
+HASH_REPLICAS = 64  # points per session on the hash ring
+QUEUE_DEPTH = 4     # queued messages per session, in multiples of its window
+
+def _hash(key):
+    """64-bit hash of a bytes key"""
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big')
+
+class HashRing:
+    """Consistent hashing of keys onto ``count`` partitions
+
+    Each partition owns ``replicas`` points on the ring, so changing the number
+    of sessions moves only about 1/count of the patients to another session.
+    """
+
+    def __init__(self, count, replicas=HASH_REPLICAS):
+        points = sorted((_hash(f"{node}:{replica}".encode('ascii')), node)
+                        for node in range(count) for replica in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def node(self, key_hash):
+        """Partition owning a precomputed key hash"""
+        return self.nodes[bisect.bisect(self.hashes, key_hash) % len(self.hashes)]
+
+    def __getitem__(self, key):
+        return self.node(_hash(key))
+
+class Destination:
+    """An MLLP receiver and the size of its session pool"""
+
+    def __init__(self, name, host, port, sessions=1, window=DEFAULT_WINDOW):
+        if sessions < 1 or window < 1:
+            raise ValueError(f"Destination {name!r} needs at least one session and a window of at least 1")
+        self.name = name
+        self.host = host
+        self.port = port
+        self.sessions = sessions
+        self.window = window
+        self.ring = HashRing(sessions)
+
+def _patterns(route, key):
+    """A route field as a tuple of patterns (``("*",)`` when omitted)"""
+    value = route.get(key, '*')
+    return (value,) if isinstance(value, str) else tuple(value)
+
+class RoutingTable:
+    """Maps MSH-5 and MSH-9 to destination names"""
+
+    def __init__(self, destinations, routes, default=()):
+        self.destinations = destinations
+        # (receiving application patterns, message type patterns, destination names)
+        self.routes = routes
+        self.default = tuple(default)
+        for _, _, names in self.routes + [((), (), self.default)]:
+            for name in names:
+                if name not in destinations:
+                    raise ValueError(f"Route refers to unknown destination {name!r}")
+        # (MSH-5, MSH-9) -> destination names, filled as combinations are seen
+        self._cache = {}
+
+    @classmethod
+    def load(cls, path, sessions=1, window=DEFAULT_WINDOW):
+        """Read a routing file; ``sessions`` and ``window`` are the per-destination defaults"""
+        with open(path) as f:
+            try:
+                config = json.load(f)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Invalid routing file {path}: {e}") from None
+        try:
+            destinations = {
+                name: Destination(name, spec['host'], int(spec['port']), int(spec.get('sessions', sessions)),
+                                  int(spec.get('window', window)))
+                for name, spec in config['destinations'].items()
+            }
+            routes = [
+                (_patterns(route, 'receiving_application'), _patterns(route, 'message_type'),
+                 _patterns(route, 'to'))
+                for route in config.get('routes', [])
+            ]
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError(f"Invalid routing file {path}: missing or malformed {e}") from None
+        default = config.get('default', ())
+        return cls(destinations, routes, (default,) if isinstance(default, str) else default)
+
+    def route(self, receiving_application, message_type):
+        """Names of the destinations for a message"""
+        key = (receiving_application, message_type)
+        names = self._cache.get(key)
+        if names is None:
+            names = self.default
+            for applications, types, targets in self.routes:
+                if (any(fnmatchcase(receiving_application, p) for p in applications)
+                        and any(fnmatchcase(message_type, p) for p in types)):
+                    names = targets
+                    break
+            self._cache[key] = names
+        return names
+
+async def _send_routed(messages, table, timeout):
+    """Dispatch messages to the session queues of their destinations"""
+    pools = {
+        name: [AsyncMLLPSession(f"{name}/{i + 1}", d.host, d.port, timeout, d.window)
+               for i in range(d.sessions)]
+        for name, d in table.destinations.items()
+    }
+    queues = {
+        name: [asyncio.Queue(maxsize=session.window * QUEUE_DEPTH) for session in pool]
+        for name, pool in pools.items()
+    }
+    workers = [asyncio.create_task(session.run_queue(queue))
+               for name in pools for session, queue in zip(pools[name], queues[name])]
+
+    unrouted = 0
+    for message in messages:
+        header = HL7Message(message)
+        message_type = header.message_type or "Unknown"
+        control_id = header.control_id or ""
+        names = table.route(header.field('MSH', 5, ''), message_type)
+        if not names:
+            unrouted += 1
+            log.warning("%s %s matches no route; skipped", message_type, control_id)
+            continue
+        # Encode once; the same frame is fanned out to every destination
+        frame = EncodedFrame(encode_frame(to_wire_bytes(message)), control_id, message_type)
+        key_hash = _hash(header.raw_field('PID', 3) or control_id.encode('utf-8'))
+        for name in names:
+            await queues[name][table.destinations[name].ring.node(key_hash)].put((frame, None))
+
+    for name in queues:
+        for queue in queues[name]:
+            await queue.put(None)
+    await asyncio.gather(*workers)
+    return pools, unrouted
+
+def send_routed(messages, table, timeout=DEFAULT_ACK_TIMEOUT):
+    """Send messages to their routed destinations and print a per-destination summary
+
+    Returns a dict with per-destination counters and the number of unrouted
+    messages.
+    """
+    pools, unrouted = asyncio.run(_send_routed(messages, table, timeout))
+    stats = {'unrouted': unrouted, 'destinations': {}}
+    summary.info("\nDestinations:")
+    for name, pool in pools.items():
+        accepted = sum(session.accepted for session in pool)
+        failed = sum(session.failed for session in pool)
+        stats['destinations'][name] = {'accepted': accepted, 'failed': failed, 'sessions': len(pool)}
+        summary.info("  %s (%s:%s, %d sessions): %d accepted, %d failed", name, table.destinations[name].host,
+                     table.destinations[name].port, len(pool), accepted, failed)
+    if unrouted:
+        summary.info("  %d messages matched no route", unrouted)
+    stats['accepted'] = sum(d['accepted'] for d in stats['destinations'].values())
+    stats['total'] = stats['accepted'] + sum(d['failed'] for d in stats['destinations'].values())
+    return stats
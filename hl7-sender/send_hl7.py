@@ -8,12 +8,19 @@ import os
 import sys
 import time
 import socket
+import ssl
 import json
+import itertools
 import argparse
 import base64
-import requests
+import gzip
 from datetime import datetime
 from dotenv import load_dotenv
+from corpus import iter_hl7_messages, iter_indexed_frames, has_index, CorpusIndex, CORPUS_FORMATS
+from hl7_message import HL7Message
+from mllp_codec import MLLPDecoder, EncodedFrame, encode_frame
+from metrics import METRICS
+from send_log import log, summary, log_result, setup_logging, shutdown_logging, SAMPLED, LOG_LEVELS
 
 # Load environment variables
 load_dotenv()
@@ -24,44 +31,59 @@ DEFAULT_PORT = int(os.getenv("HL7_SERVER_PORT", "2575"))
 DEFAULT_ENDPOINT = os.getenv("HL7_API_ENDPOINT", "http://localhost:3000/api/hl7")
 DEFAULT_API_KEY = os.getenv("HL7_API_KEY", "")
 DEFAULT_ACK_TIMEOUT = 10  # seconds
+DEFAULT_WINDOW = int(os.getenv("HL7_MLLP_WINDOW", "1"))  # unacknowledged messages in flight
+DEFAULT_HTTP_BATCH = int(os.getenv("HL7_HTTP_BATCH", "1"))  # messages per HTTP request
+DEFAULT_TLS_CA = os.getenv("HL7_TLS_CA")  # pinned CA bundle for MLLP over TLS
+DEFAULT_TLS_CERT = os.getenv("HL7_TLS_CERT")  # client certificate
+DEFAULT_TLS_KEY = os.getenv("HL7_TLS_KEY")
+HTTP_BATCH_CONTENT_TYPES = {
+    'json': 'application/json',                 # {"messages": [raw HL7 text, ...]}
+    'hl7': 'application/hl7-v2; charset=utf-8',  # messages back to back, no base64
+}
+GZIP_LEVEL = 1  # HL7 text compresses well even at the fastest level
 
-# MLLP control characters
-MLLP_START_BLOCK = b'\x0b'  # <VT>
-MLLP_END_BLOCK = b'\x1c\x0d'  # <FS><CR>
+_http_session = None
 
-def read_hl7_messages(file_path):
-    """Read HL7 messages from a file"""
+def read_hl7_messages(file_path, fmt='auto'):
+    """Lazily read HL7 messages from a file as wire-format bytes"""
     try:
-        with open(file_path, 'r') as f:
-            content = f.read()
-        
-        # Split the content by double newlines to separate messages
-        messages = [msg.strip() for msg in content.split('\n\n') if msg.strip()]
-        return messages
-    except Exception as e:
-        print(f"Error reading HL7 messages: {e}")
-        return []
+        yield from METRICS.timed(iter_hl7_messages(file_path, fmt), 'read')
+    except (OSError, ValueError) as e:
+        log.error("Error reading HL7 messages: %s", e)
+
+def to_wire_bytes(message):
+    """Return a message as UTF-8 bytes with \\r segment terminators"""
+    if isinstance(message, str):
+        return message.replace('\n', '\r').encode('utf-8')
+    return message
 
 def encode_hl7_message(message):
     """Encode HL7 message to Base64 for transmission via HTTP"""
-    return base64.b64encode(message.encode('utf-8')).decode('utf-8')
+    return base64.b64encode(to_wire_bytes(message)).decode('utf-8')
+
+def http_session():
+    """The shared ``requests.Session``, so HTTP sends reuse pooled keep-alive connections"""
+    global _http_session
+    if _http_session is None:
+        # Imported here so that MLLP-only runs do not pay for loading requests
+        import requests
+        _http_session = requests.Session()
+    return _http_session
 
-def send_http_message(message, endpoint, api_key=None):
-    """Send HL7 message to REST API endpoint"""
+def send_http_message(message, endpoint, api_key=None, session=None):
+    """Send HL7 message to REST API endpoint
+
+    Requests go through ``session`` if given, otherwise the shared session.
+    """
+    started = time.perf_counter()
     
     # Prepare message for sending
     encoded_message = encode_hl7_message(message)
     
-    # Extract message type (MSH-9) for logging
-    message_lines = message.split('\n')
-    if message_lines and message_lines[0].startswith('MSH|'):
-        msh_fields = message_lines[0].split('|')
-        if len(msh_fields) > 9:
-            message_type = msh_fields[8]
-        else:
-            message_type = "Unknown"
-    else:
-        message_type = "Unknown"
+    # Extract message type (MSH-9) and control ID (MSH-10) for logging
+    header = HL7Message(message)
+    message_type = header.message_type or "Unknown"
+    control_id = header.control_id or ""
     
     # Prepare request data
     payload = {
@@ -77,177 +99,814 @@ def send_http_message(message, endpoint, api_key=None):
     # Add API key if provided
     if api_key:
         headers["X-API-Key"] = api_key
+    body = json.dumps(payload)
+    METRICS.observe('encode', time.perf_counter() - started)
     
     try:
         # Send request to endpoint
-        print(f"Sending {message_type} message to REST API at {endpoint}...")
-        response = requests.post(endpoint, data=json.dumps(payload), headers=headers)
+        log.debug("Sending %s message to REST API at %s...", message_type, endpoint)
+        started = time.perf_counter()
+        response = (session or http_session()).post(endpoint, data=body, headers=headers)
+        latency = time.perf_counter() - started
+        METRICS.observe('http', latency)
+        METRICS.count('bytes_sent', 'http', len(body))
+        METRICS.count('messages', f"http_{response.status_code}")
+        log_result(control_id, message_type, f"HTTP {response.status_code}", latency,
+                   None if response.ok else response.text[:200])
         
-        # Process response
+        # Process response (the body is only rendered when debug logging is on)
         if response.status_code in [200, 201, 202]:
-            print(f"Successfully sent message. Status: {response.status_code}")
-            try:
-                resp_data = response.json()
-                print(f"Response: {json.dumps(resp_data, indent=2)}")
-                return True
-            except:
-                print(f"Response: {response.text}")
-                return True
+            log.info("%s %s sent. Status: %s", message_type, control_id, response.status_code, extra=SAMPLED)
+            log.debug("Response: %s", response.text)
+            return True
         else:
-            print(f"Failed to send message. Status: {response.status_code}")
-            print(f"Response: {response.text}")
+            log.warning("%s %s failed. Status: %s", message_type, control_id, response.status_code)
+            log.warning("Response: %s", response.text)
             return False
             
     except Exception as e:
-        print(f"Error sending message via HTTP: {e}")
+        METRICS.count('messages', 'failed')
+        log_result(control_id, message_type, None, None, str(e))
+        log.warning("Error sending message via HTTP: %s", e)
         return False
 
-def send_mllp_message(message, host, port, timeout=DEFAULT_ACK_TIMEOUT):
-    """Send HL7 message using MLLP over TCP/IP and wait for ACK"""
+def batch_endpoint(endpoint):
+    """URL of the batch endpoint next to a single-message endpoint"""
+    return endpoint.rstrip('/') + '/batch'
+
+def send_http_batch(messages, endpoint, api_key=None, fmt='json', compress=True, session=None):
+    """POST several messages to the batch endpoint in one request
+
+    ``fmt`` is ``json`` (an array of raw HL7 strings) or ``hl7`` (the messages
+    back to back as ``application/hl7-v2``); neither is base64-encoded. The body
+    is gzip-compressed unless ``compress`` is False. Each message is reported
+    with the ACK code of its acknowledgment. Returns the number accepted.
+    """
+    started = time.perf_counter()
+    wire = [to_wire_bytes(message) for message in messages]
+    headers = {"Content-Type": HTTP_BATCH_CONTENT_TYPES[fmt]}
+    if fmt == 'json':
+        payload = {
+            "messages": [message.decode('utf-8', errors='replace') for message in wire],
+            "sendTime": datetime.now().isoformat()
+        }
+        body = json.dumps(payload).encode('utf-8')
+    else:
+        # Terminate every message's last segment so the next MSH starts a new message
+        body = b''.join(message if message.endswith(b'\r') else message + b'\r' for message in wire)
+    if compress:
+        body = gzip.compress(body, GZIP_LEVEL)
+        headers["Content-Encoding"] = "gzip"
+    if api_key:
+        headers["X-API-Key"] = api_key
+    METRICS.observe('encode', time.perf_counter() - started)
     
-    # Extract message type (MSH-9) for logging
-    message_lines = message.split('\n')
-    if message_lines and message_lines[0].startswith('MSH|'):
-        msh_fields = message_lines[0].split('|')
-        if len(msh_fields) > 9:
-            message_type = msh_fields[8]
+    outcomes = {}
+    error = None
+    latency = None
+    try:
+        log.debug("Sending a batch of %d messages to REST API at %s...", len(wire), batch_endpoint(endpoint))
+        started = time.perf_counter()
+        response = (session or http_session()).post(batch_endpoint(endpoint), data=body, headers=headers)
+        latency = time.perf_counter() - started
+        METRICS.observe('http', latency)
+        METRICS.count('bytes_sent', 'http', len(body))
+        if response.ok:
+            outcomes = {outcome.get('index'): outcome for outcome in response.json().get('results', [])}
         else:
-            message_type = "Unknown"
-    else:
-        message_type = "Unknown"
+            error = f"HTTP {response.status_code}: {response.text[:200]}"
+    except Exception as e:
+        error = f"Error sending batch via HTTP: {e}"
     
-    # Replace \n with \r as per HL7 standard
-    message = message.replace('\n', '\r')
+    accepted = 0
+    for index, message in enumerate(wire):
+        header = HL7Message(message)
+        control_id = header.control_id or ""
+        message_type = header.message_type or "Unknown"
+        outcome = outcomes.get(index, {})
+        if error:
+            result = (control_id, message_type, None, error)
+        elif outcome.get('acknowledgment'):
+            ack = HL7Message(outcome['acknowledgment'])
+            result = (control_id, message_type, ack.ack_code, ack.ack_text or "")
+        else:
+            result = (control_id, message_type, None, outcome.get('error', "No result in batch response"))
+        accepted += report_mllp_result(result, latency=latency)
+    return accepted
+
+def send_http_messages(messages, endpoint, api_key=None, batch_size=DEFAULT_HTTP_BATCH, fmt='json',
+                       compress=True, delay=0.0, session=None):
+    """Send messages to the batch endpoint ``batch_size`` at a time
+
+    Returns a ``(success_count, total_count)`` tuple.
+    """
+    success_count = 0
+    total_count = 0
+    messages = iter(messages)
+    while True:
+        batch = list(itertools.islice(messages, batch_size))
+        if not batch:
+            break
+        if delay and total_count:
+            time.sleep(delay)
+        total_count += len(batch)
+        success_count += send_http_batch(batch, endpoint, api_key, fmt, compress, session)
+    return success_count, total_count
+
+def send_mllp_message(message, host, port, timeout=DEFAULT_ACK_TIMEOUT, tls=None):
+    """Send HL7 message using MLLP over TCP/IP and wait for ACK
+
+    With ``tls`` (an ``mllp_tls.TLSClient``) the connection is TLS-wrapped,
+    resuming the previous connection's session when the receiver allows it.
+    """
+    started = time.perf_counter()
     
-    # Convert to bytes
-    message_bytes = message.encode('utf-8')
+    # Extract message type (MSH-9) and control ID (MSH-10) for logging
+    header = HL7Message(message)
+    message_type = header.message_type or "Unknown"
+    control_id = header.control_id or ""
+    
+    # Convert to bytes with \r segment terminators as per HL7 standard
+    message_bytes = to_wire_bytes(message)
     
     # Create MLLP frame
-    mllp_message = MLLP_START_BLOCK + message_bytes + MLLP_END_BLOCK
+    mllp_message = encode_frame(message_bytes)
+    METRICS.observe('encode', time.perf_counter() - started)
     
     try:
         # Create socket connection
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.settimeout(timeout)
-        s.connect((host, port))
+        started = time.perf_counter()
+        try:
+            s.connect((host, port))
+        except OSError:
+            METRICS.count('connections', 'failed')
+            raise
+        if tls is not None:
+            s = tls.wrap(s, host, port)
+        METRICS.observe('connect', time.perf_counter() - started)
+        METRICS.count('connections', 'opened')
         
-        print(f"Connected to MLLP server at {host}:{port}")
-        print(f"Sending {message_type} message...")
+        log.debug("Connected to MLLP server at %s:%s", host, port)
         
         # Send the message
+        started = time.perf_counter()
         s.sendall(mllp_message)
+        sent_at = time.perf_counter()
+        METRICS.observe('send', sent_at - started)
+        METRICS.count('bytes_sent', 'mllp', len(mllp_message))
         
         # Wait for ACK
-        print("Waiting for acknowledgment...")
-        ack_data = b''
+        decoder = MLLPDecoder()
+        frames = []
         
-        # Read until we get the MLLP end block
-        while True:
-            chunk = s.recv(1024)
+        # Read until the decoder has a complete MLLP frame
+        while not frames:
+            chunk = s.recv(4096)
             if not chunk:
                 break
-            ack_data += chunk
-            if MLLP_END_BLOCK in ack_data:
-                break
+            frames = decoder.feed(chunk)
+        latency = time.perf_counter() - sent_at
+        METRICS.observe('ack_wait', latency)
                 
         # Process ACK
-        if ack_data:
-            # Strip MLLP control characters
-            if ack_data.startswith(MLLP_START_BLOCK):
-                ack_data = ack_data[1:]
-            if ack_data.endswith(MLLP_END_BLOCK):
-                ack_data = ack_data[:-2]
-                
-            # Decode ACK
-            ack_message = ack_data.decode('utf-8')
-            ack_segments = ack_message.split('\r')
+        if frames:
+            ack_data = frames[0]
+            ack_code, _, ack_text = parse_ack(ack_data)
+            METRICS.count('messages', ack_code or 'unknown')
+            log_result(control_id, message_type, ack_code, latency, ack_text)
             
-            if len(ack_segments) >= 2:
-                msa_segment = ack_segments[1]
-                msa_fields = msa_segment.split('|')
-                
-                if len(msa_fields) >= 2:
-                    ack_code = msa_fields[1]
-                    ack_text = msa_fields[2] if len(msa_fields) > 2 else ""
-                    
-                    if ack_code == "AA":
-                        print(f"Message accepted: {ack_text}")
-                        return True
-                    elif ack_code == "AR":
-                        print(f"Message rejected: {ack_text}")
-                        return False
-                    elif ack_code == "AE":
-                        print(f"Error processing message: {ack_text}")
-                        return False
-                    else:
-                        print(f"Unknown acknowledgment code: {ack_code}")
-                        return False
+            if ack_code == "AA":
+                log.info("%s %s accepted: %s", message_type, control_id, ack_text, extra=SAMPLED)
+                return True
+            elif ack_code == "AR":
+                log.warning("%s %s rejected: %s", message_type, control_id, ack_text)
+                return False
+            elif ack_code == "AE":
+                log.warning("%s %s error: %s", message_type, control_id, ack_text)
+                return False
+            elif ack_code is not None:
+                log.warning("%s %s unknown acknowledgment code: %s", message_type, control_id, ack_code)
+                return False
             
-            print(f"Received ACK: {ack_message}")
+            log.info("Received ACK: %s", ack_data.decode('utf-8', errors='replace'))
             return True
         else:
-            print("No acknowledgment received")
-            return False
+            error = "No acknowledgment received"
     
     except socket.timeout:
-        print(f"Timeout waiting for acknowledgment after {timeout} seconds")
-        return False
+        error = f"Timeout waiting for acknowledgment after {timeout} seconds"
     except ConnectionRefusedError:
-        print(f"Connection refused to {host}:{port}")
-        return False
+        error = f"Connection refused to {host}:{port}"
+    except ssl.SSLError as e:
+        error = f"TLS error: {e}"
     except Exception as e:
-        print(f"Error sending message: {e}")
-        return False
+        error = f"Error sending message: {e}"
     finally:
         # Always close the socket
         try:
+            if tls is not None and isinstance(s, ssl.SSLSocket):
+                tls.save_session(s, host, port)
             s.close()
         except:
             pass
+    
+    METRICS.count('messages', 'failed')
+    log_result(control_id, message_type, None, None, error)
+    log.warning("%s %s failed: %s", message_type, control_id, error)
+    return False
+
+def parse_ack(frame):
+    """Return ``(ack_code, control_id, ack_text)`` from the MSA segment of an ACK frame"""
+    ack = HL7Message(frame)
+    return ack.ack_code, ack.ack_control_id or "", ack.ack_text or ""
+
+def match_ack(pending, frame):
+    """Pop the message acknowledged by an ACK frame from ``pending`` and return its result
+
+    ``pending`` maps control ID to message type in send order. Servers answer in
+    order, so an unmatched ACK (e.g. a NAK with an UNKNOWN control ID) is
+    attributed to the oldest outstanding message.
+    """
+    ack_code, control_id, ack_text = parse_ack(frame)
+    if control_id not in pending:
+        if not pending:
+            return (control_id, "Unknown", ack_code, ack_text)
+        control_id = next(iter(pending))
+    message_type = pending.pop(control_id)
+    return (control_id, message_type, ack_code, ack_text)
+
+class MLLPConnection:
+    """Persistent MLLP session that pipelines messages over a single TCP connection
+
+    Up to ``window`` messages may be sent before their ACKs arrive. Each ACK is
+    matched back to its message by comparing MSA-2 with the MSH-10 that was sent.
+    With ``tls`` (an ``mllp_tls.TLSClient``) the connection is TLS-wrapped and a
+    reconnect resumes the previous session.
+    """
+
+    def __init__(self, host, port, timeout=DEFAULT_ACK_TIMEOUT, window=DEFAULT_WINDOW, tls=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.window = max(1, window)
+        self.tls = tls
+        self.sock = None
+        self.decoder = MLLPDecoder()
+        # Control ID -> message type for messages awaiting an ACK, in send order
+        self.pending = {}
+        # Control ID -> perf_counter() time the message was sent
+        self.sent_at = {}
+        # Control ID -> send-to-ACK seconds of acknowledged messages not yet reported
+        self.latencies = {}
+
+    def connect(self):
+        """Open the TCP connection if it is not already open"""
+        if self.sock is None:
+            started = time.perf_counter()
+            try:
+                sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.sock = self.tls.wrap(sock, self.host, self.port) if self.tls is not None else sock
+            except OSError:
+                METRICS.count('connections', 'failed')
+                raise
+            METRICS.observe('connect', time.perf_counter() - started)
+            METRICS.count('connections', 'opened')
+            self.decoder.reset()
+            log.info("Connected to MLLP server at %s:%s", self.host, self.port)
+
+    def close(self):
+        """Close the TCP connection"""
+        if self.sock is not None:
+            if self.tls is not None:
+                self.tls.save_session(self.sock, self.host, self.port)
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def send(self, message):
+        """Send a message, blocking only while the in-flight window is full
+
+        Returns a list of ``(control_id, message_type, ack_code, ack_text)`` tuples
+        for every message whose outcome became known meanwhile. ``ack_code`` is
+        None when the message failed without an ACK (timeout, connection lost).
+        """
+        if isinstance(message, EncodedFrame):
+            frame, control_id, message_type = message
+        else:
+            started = time.perf_counter()
+            header = HL7Message(message)
+            message_type = header.message_type or "Unknown"
+            control_id = header.control_id or ""
+            frame = encode_frame(to_wire_bytes(message))
+            METRICS.observe('encode', time.perf_counter() - started)
+        results = []
+
+        try:
+            self.connect()
+            # Wait for a free slot (or for a duplicate control ID to clear)
+            if len(self.pending) >= self.window or control_id in self.pending:
+                started = time.perf_counter()
+                while len(self.pending) >= self.window or control_id in self.pending:
+                    results.extend(self._read_acks())
+                METRICS.observe('ack_wait', time.perf_counter() - started)
+            started = time.perf_counter()
+            self.sock.sendall(frame)
+            sent_at = time.perf_counter()
+            METRICS.observe('send', sent_at - started)
+            METRICS.count('bytes_sent', 'mllp', len(frame))
+            self.pending[control_id] = message_type
+            self.sent_at[control_id] = sent_at
+        except (OSError, ConnectionError) as e:
+            results.extend(self._fail_pending(e))
+            results.append((control_id, message_type, None, str(e)))
+        return results
+
+    def send_file(self, file, records):
+        """Send consecutive frames of an indexed corpus straight from ``file``
+
+        ``records`` are index records of frames that follow each other in the file.
+        As many frames as there are free window slots go out in a single
+        ``sendfile`` call, so the data never passes through user space. Returns
+        results like :meth:`send`.
+        """
+        results = []
+        try:
+            self.connect()
+            while records:
+                if len(self.pending) >= self.window or records[0].control_id in self.pending:
+                    started = time.perf_counter()
+                    while len(self.pending) >= self.window or records[0].control_id in self.pending:
+                        results.extend(self._read_acks())
+                    METRICS.observe('ack_wait', time.perf_counter() - started)
+                sending = {}
+                for record in records[:self.window - len(self.pending)]:
+                    if record.control_id in self.pending or record.control_id in sending:
+                        break
+                    sending[record.control_id] = record.message_type
+                first, last = records[0], records[len(sending) - 1]
+                started = time.perf_counter()
+                sent = self.sock.sendfile(file, first.offset, last.offset + last.length - first.offset)
+                sent_at = time.perf_counter()
+                METRICS.observe('send', sent_at - started)
+                METRICS.count('bytes_sent', 'mllp', sent)
+                self.pending.update(sending)
+                self.sent_at.update(dict.fromkeys(sending, sent_at))
+                records = records[len(sending):]
+        except (OSError, ConnectionError) as e:
+            results.extend(self._fail_pending(e))
+            results.extend((record.control_id, record.message_type, None, str(e)) for record in records)
+        return results
+
+    def flush(self):
+        """Wait until every in-flight message has been acknowledged"""
+        if not self.pending:
+            return []
+        results = []
+        started = time.perf_counter()
+        try:
+            while self.pending:
+                results.extend(self._read_acks())
+        except (OSError, ConnectionError) as e:
+            results.extend(self._fail_pending(e))
+        METRICS.observe('ack_wait', time.perf_counter() - started)
+        return results
+
+    def poll(self, seconds=0.0):
+        """Read the ACKs that arrive within ``seconds`` (0: those already received) and return their results
+
+        Unlike sleeping, this keeps ACK latencies accurate while the sender idles.
+        """
+        results = []
+        deadline = time.perf_counter() + seconds
+        try:
+            while self.pending:
+                self.sock.settimeout(max(deadline - time.perf_counter(), 0.0))
+                try:
+                    results.extend(self._read_acks())
+                except (socket.timeout, BlockingIOError, ssl.SSLWantReadError):
+                    break
+        except (OSError, ConnectionError) as e:
+            results.extend(self._fail_pending(e))
+        finally:
+            if self.sock is not None:
+                self.sock.settimeout(self.timeout)
+        remaining = deadline - time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+        return results
+
+    def _read_acks(self):
+        """Read from the socket and return the results of any complete ACK frames"""
+        chunk = self.sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("Connection closed by MLLP server")
+        received_at = time.perf_counter()
+        results = [self.match_ack(frame) for frame in self.decoder.feed(chunk)]
+        for result in results:
+            sent_at = self.sent_at.pop(result[0], None)
+            if sent_at is not None:
+                self.latencies[result[0]] = received_at - sent_at
+        return results
+
+    def match_ack(self, frame):
+        """Result of an ACK frame for the in-flight message it answers (see :func:`match_ack`)"""
+        return match_ack(self.pending, frame)
+
+    def latency(self, control_id):
+        """Send-to-ACK seconds of an acknowledged message (once), or None"""
+        return self.latencies.pop(control_id, None)
+
+    def _fail_pending(self, error):
+        """Drop the connection and report every in-flight message as failed"""
+        results = [(control_id, message_type, None, str(error))
+                   for control_id, message_type in self.pending.items()]
+        self.pending.clear()
+        self.sent_at.clear()
+        self.close()
+        return results
+
+def report_mllp_result(result, prefix="", latency=None):
+    """Log the outcome of a pipelined MLLP (or batched HTTP) send and return True on AA
+
+    Accepted messages are logged at INFO (subject to sampling), anything else
+    as a warning. ``latency`` (seconds) goes to the results file.
+    """
+    control_id, message_type, ack_code, ack_text = result
+    METRICS.count('messages', ack_code or 'failed')
+    log_result(control_id, message_type, ack_code, latency, ack_text)
+    if ack_code == "AA":
+        log.info("%s%s %s accepted: %s", prefix, message_type, control_id, ack_text, extra=SAMPLED)
+        return True
+    elif ack_code == "AR":
+        log.warning("%s%s %s rejected: %s", prefix, message_type, control_id, ack_text)
+    elif ack_code == "AE":
+        log.warning("%s%s %s error: %s", prefix, message_type, control_id, ack_text)
+    elif ack_code is None:
+        log.warning("%s%s %s failed: %s", prefix, message_type, control_id, ack_text)
+    else:
+        log.warning("%s%s %s unknown acknowledgment code: %s", prefix, message_type, control_id, ack_code)
+    return False
+
+def send_mllp_messages(messages, host, port, timeout=DEFAULT_ACK_TIMEOUT, window=DEFAULT_WINDOW, delay=0.0,
+                       controller=None, tls=None):
+    """Send messages over one persistent MLLP connection
+
+    With a flow ``controller`` (see ``flow_control.AIMDController``) the window
+    and send rate follow its decisions and ``window``/``delay`` are ignored.
+    Returns a ``(success_count, total_count)`` tuple.
+    """
+    connection = MLLPConnection(host, port, timeout, controller.window if controller else window, tls)
+    success_count = 0
+    total_count = 0
+
+    def report(results):
+        accepted = 0
+        for result in results:
+            latency = connection.latency(result[0])
+            accepted += report_mllp_result(result, latency=latency)
+            if controller is not None:
+                controller.record(result[2], latency)
+        if controller is not None:
+            connection.window = controller.window
+        return accepted
+
+    try:
+        for message in messages:
+            if controller is not None:
+                # ACKs are read while waiting for the next send slot, so their latency stays exact
+                success_count += report(connection.poll(controller.pace()))
+            elif delay and total_count:
+                time.sleep(delay)
+            total_count += 1
+            success_count += report(connection.send(message))
+        success_count += report(connection.flush())
+    finally:
+        connection.close()
+    return success_count, total_count
+
+def contiguous_runs(records, limit):
+    """Group index records into runs of at most ``limit`` frames adjacent in the file"""
+    run = []
+    for record in records:
+        if run and (len(run) >= limit or run[-1].offset + run[-1].length != record.offset):
+            yield run
+            run = []
+        run.append(record)
+    if run:
+        yield run
+
+def send_indexed_corpus(corpus_path, host, port, timeout=DEFAULT_ACK_TIMEOUT, window=DEFAULT_WINDOW,
+                        message_types=None, tls=None):
+    """Send an indexed corpus over one persistent MLLP connection using sendfile
+
+    Only messages whose MSH-9 is in ``message_types`` are sent, if given; the
+    selection is made from the index alone. Returns ``(success_count, total_count)``.
+    """
+    connection = MLLPConnection(host, port, timeout, window, tls)
+    success_count = 0
+    total_count = 0
+    try:
+        with CorpusIndex(corpus_path) as index, open(corpus_path, 'rb') as f:
+            for run in contiguous_runs(index.select(message_types), connection.window):
+                total_count += len(run)
+                for result in connection.send_file(f, run):
+                    success_count += report_mllp_result(result, latency=connection.latency(result[0]))
+        for result in connection.flush():
+            success_count += report_mllp_result(result, latency=connection.latency(result[0]))
+    finally:
+        connection.close()
+    return success_count, total_count
 
 def main():
     parser = argparse.ArgumentParser(description='Send HL7 v2.3 messages using MLLP or HTTP')
-    parser.add_argument('--input', type=str, required=True, help='Input file containing HL7 messages')
+    parser.add_argument('--input', type=str, help='Input file containing HL7 messages')
+    parser.add_argument('--format', type=str, default='auto', choices=CORPUS_FORMATS, help='Input file layout (default: detect)')
     parser.add_argument('--host', type=str, default=DEFAULT_HOST, help='HL7 MLLP server hostname or IP')
     parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='HL7 MLLP server port')
     parser.add_argument('--timeout', type=int, default=DEFAULT_ACK_TIMEOUT, help='Timeout for acknowledgment in seconds')
     parser.add_argument('--http', action='store_true', help='Use HTTP instead of MLLP for sending messages')
     parser.add_argument('--endpoint', type=str, default=DEFAULT_ENDPOINT, help='REST API endpoint (when using --http)')
     parser.add_argument('--apikey', type=str, default=DEFAULT_API_KEY, help='API key for authentication (when using --http)')
-    parser.add_argument('--delay', type=float, default=1.0, help='Delay between messages in seconds')
+    parser.add_argument('--http-batch', type=int, default=DEFAULT_HTTP_BATCH, help='Messages per HTTP request; above 1, messages are POSTed to the batch endpoint (ENDPOINT/batch)')
+    parser.add_argument('--http-format', type=str, default='json', choices=list(HTTP_BATCH_CONTENT_TYPES), help='Batch body: a JSON array of messages or raw application/hl7-v2 text')
+    parser.add_argument('--no-compress', action='store_true', help='Do not gzip HTTP batch bodies')
+    parser.add_argument('--delay', type=float, default=0.0, help='Delay between messages in seconds')
+    parser.add_argument('--window', type=int, default=DEFAULT_WINDOW, help='Maximum unacknowledged MLLP messages in flight on the persistent connection')
+    parser.add_argument('--adaptive', action='store_true', help='Adapt the MLLP window and send rate to the receiver (AIMD on ACK latency, AE/AR rate and timeouts); --window and --delay become the starting point')
+    parser.add_argument('--max-window', type=int, default=256, help='Largest window --adaptive may grow to')
+    parser.add_argument('--error-threshold', type=float, default=0.05, help='Back off (--adaptive) when more than this fraction of recent ACKs are AE/AR')
+    parser.add_argument('--target-latency', type=float, help='Back off (--adaptive) when the mean ACK latency exceeds this many milliseconds (default: twice the lowest latency seen)')
+    parser.add_argument('--hl7-batch', type=int, metavar='N', help='Wrap every N messages in a BHS/BTS batch sent as one MLLP frame and answered by one batch ACK (--window counts batches)')
+    parser.add_argument('--concurrency', type=int, default=1, help='Number of concurrent MLLP sessions (asyncio engine when greater than 1)')
+    parser.add_argument('--tls', action='store_true', help='Wrap MLLP connections in TLS; sessions are resumed across reconnects')
+    parser.add_argument('--tls-ca', type=str, default=DEFAULT_TLS_CA, help='Only trust receiver certificates signed by this CA bundle instead of the system store (HL7_TLS_CA)')
+    parser.add_argument('--tls-cert', type=str, default=DEFAULT_TLS_CERT, help='Client certificate (PEM) for receivers that require mutual TLS (HL7_TLS_CERT)')
+    parser.add_argument('--tls-key', type=str, default=DEFAULT_TLS_KEY, help='Private key for --tls-cert if it is not in the same file (HL7_TLS_KEY)')
+    parser.add_argument('--tls-pin', type=str, help="Also require the receiver's certificate to have this SHA-256 fingerprint (hex)")
+    parser.add_argument('--tls-server-name', type=str, help='Name to verify the receiver certificate against when it differs from --host')
+    parser.add_argument('--reconnect', action='store_true', help='Open a new MLLP connection for every message (legacy behaviour)')
+    parser.add_argument('--bench', type=str, choices=['closed', 'open'], help='Run an MLLP load test: closed loop (fixed concurrency) or open loop (fixed arrival rate)')
+    parser.add_argument('--rate', type=float, help='Target arrival rate in msgs/sec (open-loop benchmark)')
+    parser.add_argument('--arrival', type=str, default='constant', choices=['constant', 'poisson'], help='Arrival process for open-loop benchmarks')
+    parser.add_argument('--bench-count', type=int, help='Number of messages to send in a benchmark, re-reading the input as needed')
+    parser.add_argument('--bench-output', type=str, help='Write benchmark results as JSON to this file')
+    parser.add_argument('--seed', type=int, help='Random seed for Poisson arrivals')
+    parser.add_argument('--select-types', type=str, help='Only send these message types (comma-separated MSH-9 values, e.g. ORU^R01); indexed corpora select them from the index')
+    parser.add_argument('--no-index', action='store_true', help='Read an indexed corpus like a plain MLLP file')
+    parser.add_argument('--validate', action='store_true', help='Check messages against the Medsynapse conformance rules (across all cores) and only send the conformant ones')
+    parser.add_argument('--spool', type=str, help='Spool directory recording every message and its ACK state, so the run can be resumed')
+    parser.add_argument('--resume', action='store_true', help='Resume the run recorded in --spool (default spool directory: HL7_SPOOL_DIR or ./spool)')
+    parser.add_argument('--max-retries', type=int, default=5, help='Retries for a failed or AE-acknowledged message when spooling')
+    parser.add_argument('--retry-delay', type=float, default=1.0, help='Seconds before the first retry when spooling; doubled for each further retry')
+    parser.add_argument('--metrics-file', type=str, help='Write per-stage timings and counters to this file in OpenMetrics text format')
+    parser.add_argument('--metrics-interval', type=float, default=0.0, help='Also rewrite --metrics-file every N seconds during the run')
+    parser.add_argument('--metrics-port', type=int, help='Serve per-stage timings and counters at http://127.0.0.1:PORT/metrics during the run')
+    parser.add_argument('--stage-summary', action='store_true', help='Print a per-stage timing breakdown at the end of the run')
+    parser.add_argument('--profile', type=str, nargs='?', const='send_hl7.prof', help='Run under cProfile, dump the stats to this file (default: send_hl7.prof) and print the top functions')
+    parser.add_argument('--routes', type=str, help='JSON routing file mapping MSH-5/MSH-9 to MLLP destinations, each with its own session pool (--concurrency and --window are the per-destination defaults)')
+    parser.add_argument('--watch', type=str, help='Run as a daemon: send every file that appears in this directory over a persistent connection')
+    parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds between directory scans when inotify is unavailable (--watch)')
+    parser.add_argument('--no-inotify', action='store_true', help='Poll the watched directory instead of using inotify')
+    parser.add_argument('--log-level', type=str.upper, default='INFO', choices=LOG_LEVELS, help='Console log level (DEBUG also shows HTTP response bodies)')
+    parser.add_argument('--log-sample', type=int, default=1, help='Log only one in every N accepted messages (failures are always logged)')
+    parser.add_argument('--quiet', action='store_true', help='Only print errors and the end-of-run summary')
+    parser.add_argument('--results', type=str, help='Write one JSON line per message (control ID, type, ACK code, latency) to this file')
     
     args = parser.parse_args()
+    if not args.input and not args.resume and not args.watch:
+        parser.error("--input is required")
+    
+    # Console output and the results file are written by a background thread
+    setup_logging(args.log_level, args.quiet, args.log_sample, args.results)
     
-    print(f"Reading HL7 messages from {args.input}...")
-    messages = read_hl7_messages(args.input)
+    if args.metrics_port is not None:
+        from metrics import serve_metrics
+        serve_metrics(args.metrics_port)
+        log.info("Serving metrics at http://127.0.0.1:%d/metrics", args.metrics_port)
+    if args.metrics_file and args.metrics_interval > 0:
+        from metrics import write_periodically
+        write_periodically(args.metrics_file, args.metrics_interval)
     
-    if not messages:
-        print("No messages found in the input file.")
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+    try:
+        if profiler is not None:
+            profiler.runcall(run, args, parser)
+        else:
+            run(args, parser)
+    finally:
+        # Drain queued log lines before printing anything else
+        shutdown_logging()
+        if profiler is not None:
+            import pstats
+            profiler.dump_stats(args.profile)
+            print(f"\nProfile written to {args.profile}; top functions by cumulative time:")
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+        if args.results:
+            print(f"Per-message results written to {args.results}")
+        if args.metrics_file:
+            METRICS.write(args.metrics_file)
+            print(f"Metrics written to {args.metrics_file}")
+        if args.stage_summary:
+            print("\nTime by stage:")
+            for line in METRICS.summary():
+                print(f"  {line}")
+
+def run(args, parser):
+    """Send the input as selected by the parsed command-line arguments"""
+    if args.adaptive and (args.http or args.reconnect or args.concurrency > 1 or args.routes or args.bench
+                          or args.spool or args.resume or args.watch):
+        parser.error("--adaptive works with the persistent MLLP sender only")
+    if args.concurrency > 1 and not args.http and (args.delay or args.reconnect):
+        parser.error("--concurrency pipelines messages over persistent sessions and cannot be combined with "
+                     "--delay or --reconnect")
+    if args.hl7_batch is not None:
+        if args.hl7_batch < 1:
+            parser.error("--hl7-batch must be at least 1")
+        if (args.http or args.reconnect or args.concurrency > 1 or args.adaptive or args.routes or args.bench
+                or args.spool or args.resume or args.watch):
+            parser.error("--hl7-batch works with the persistent MLLP sender only")
+    
+    tls = None
+    if args.tls:
+        if args.http or args.routes or args.bench or args.spool or args.resume or args.watch:
+            parser.error("--tls works with the MLLP sender (persistent, --reconnect or --concurrency) only")
+        from mllp_tls import TLSClient
+        try:
+            tls = TLSClient(args.tls_ca, args.tls_cert, args.tls_key, args.tls_pin, args.tls_server_name)
+        except (OSError, ValueError) as e:
+            parser.error(f"Cannot load TLS certificates: {e}")
+    elif args.tls_pin or args.tls_server_name:
+        parser.error("--tls-pin and --tls-server-name need --tls")
+    
+    if args.watch:
+        if (args.input or args.spool or args.resume or args.bench or args.reconnect or args.routes
+                or args.concurrency > 1):
+            parser.error("--watch sends over one persistent MLLP or HTTP connection and takes no --input")
+        if args.validate:
+            parser.error("--validate cannot be combined with --watch")
+        from watch_folder import WatchFolderSender
+        sender = WatchFolderSender(args.watch, args.host, args.port, args.format, args.timeout, args.window,
+                                   args.http, args.endpoint, args.apikey, args.http_batch, args.http_format,
+                                   not args.no_compress)
+        sender.run(args.poll_interval, not args.no_inotify)
         return
     
+    if args.spool or args.resume:
+        if args.http or args.reconnect or args.concurrency > 1 or args.bench or args.routes:
+            parser.error("--spool and --resume work with the persistent MLLP sender only")
+        if args.validate:
+            parser.error("--validate cannot be combined with --spool or --resume")
+        from spool import send_spooled, DEFAULT_SPOOL_DIR
+        spool_dir = args.spool or DEFAULT_SPOOL_DIR
+        log.info("Spooling HL7 messages in %s and sending them to MLLP server at %s:%s...", spool_dir, args.host, args.port)
+        try:
+            success_count, total_count = send_spooled(args.input, spool_dir, args.host, args.port, args.format,
+                                                      args.timeout, args.window, args.delay, args.resume,
+                                                      args.max_retries, args.retry_delay)
+        except (OSError, ValueError) as e:
+            log.error("Error: %s", e)
+            sys.exit(1)
+        summary.info("\nSending complete. Successfully sent %d/%d messages.", success_count, total_count)
+        return
+    
+    if args.bench:
+        if args.http or args.reconnect:
+            parser.error("--bench load-tests pipelined MLLP sessions and cannot be combined with --http or --reconnect")
+        if args.validate or args.select_types:
+            parser.error("--bench sends the whole input and cannot be combined with --validate or --select-types")
+        from bench import run_benchmark
+        try:
+            run_benchmark(args.input, args.host, args.port, args.bench, args.concurrency, args.window,
+                          args.rate, args.arrival, args.bench_count, args.timeout, args.format,
+                          args.seed, args.bench_output)
+        except ValueError as e:
+            parser.error(str(e))
+        return
+    
+    if args.routes:
+        if args.http or args.reconnect:
+            parser.error("--routes sends over MLLP sessions and cannot be combined with --http or --reconnect")
+        if args.delay:
+            parser.error("--routes pipelines messages over per-destination sessions and cannot be combined with --delay")
+        from routing import RoutingTable, send_routed
+        try:
+            table = RoutingTable.load(args.routes, args.concurrency, args.window)
+        except (OSError, ValueError) as e:
+            log.error("Error loading routes: %s", e)
+            sys.exit(1)
+        log.info("Routing HL7 messages from %s to %s...", args.input, ", ".join(table.destinations))
+        messages = read_hl7_messages(args.input, args.format)
+        if args.select_types:
+            message_types = [t.strip() for t in args.select_types.split(',')]
+            messages = (m for m in messages if HL7Message(m).message_type in message_types)
+        if args.validate:
+            from validate_hl7 import filter_valid
+            messages = filter_valid(messages)
+        stats = send_routed(messages, table, args.timeout)
+        summary.info("\nSending complete. Successfully delivered %d/%d messages.", stats['accepted'], stats['total'])
+        return
+    
+    message_types = [t.strip() for t in args.select_types.split(',')] if args.select_types else None
+    use_index = (not args.no_index and not args.http and not args.reconnect and not args.validate
+                 and not args.hl7_batch and args.format in ('auto', 'mllp') and has_index(args.input))
+    
+    if use_index and args.concurrency <= 1 and not args.adaptive:
+        log.info("Sending indexed corpus %s to MLLP server at %s:%s...", args.input, args.host, args.port)
+        try:
+            success_count, total_count = send_indexed_corpus(args.input, args.host, args.port, args.timeout,
+                                                             args.window, message_types, tls)
+        except (OSError, ValueError) as e:
+            log.error("Error reading indexed corpus: %s", e)
+            return
+        summary.info("\nSending complete. Successfully sent %d/%d messages.", success_count, total_count)
+        return
+    
+    log.info("Reading HL7 messages from %s...", args.input)
+    if use_index:
+        messages = METRICS.timed(iter_indexed_frames(args.input, message_types), 'read')
+    else:
+        messages = read_hl7_messages(args.input, args.format)
+        if message_types:
+            messages = (m for m in messages if HL7Message(m).message_type in message_types)
+        if args.validate:
+            from validate_hl7 import filter_valid
+            messages = filter_valid(messages)
+    
+    # Messages are streamed from the file, so peek at the first one to detect an empty corpus
+    first_message = next(messages, None)
+    if first_message is None:
+        summary.info("No messages found in the input file.")
+        return
+    messages = itertools.chain([first_message], messages)
+    
     if args.http:
-        print(f"Found {len(messages)} HL7 messages. Sending to REST API at {args.endpoint}...")
+        log.info("Streaming HL7 messages to REST API at %s...", args.endpoint)
     else:
-        print(f"Found {len(messages)} HL7 messages. Sending to MLLP server at {args.host}:{args.port}...")
+        log.info("Streaming HL7 messages to MLLP server at %s:%s...", args.host, args.port)
+    
+    if args.hl7_batch:
+        from hl7_batch import send_mllp_batches
+        success_count, total_count, batch_count = send_mllp_batches(messages, args.host, args.port, args.timeout,
+                                                                    args.window, args.hl7_batch, tls)
+        summary.info("\nSending complete. Successfully sent %d/%d messages in %d batches.",
+                     success_count, total_count, batch_count)
+        return
+    
+    if not args.http and args.concurrency > 1:
+        from async_sender import send_concurrent
+        stats = send_concurrent(messages, args.host, args.port, args.concurrency, args.timeout, args.window, tls)
+        summary.info("\nSending complete. Successfully sent %d/%d messages.", stats['accepted'], stats['total'])
+        return
+    
+    if args.http and args.http_batch > 1:
+        success_count, total_count = send_http_messages(messages, args.endpoint, args.apikey, args.http_batch,
+                                                        args.http_format, not args.no_compress, args.delay)
+        summary.info("\nSending complete. Successfully sent %d/%d messages.", success_count, total_count)
+        return
+    
+    if not args.http and not args.reconnect:
+        controller = None
+        if args.adaptive:
+            from flow_control import AIMDController
+            controller = AIMDController(args.window, args.max_window, 1.0 / args.delay if args.delay > 0 else None,
+                                        error_threshold=args.error_threshold,
+                                        target_latency=args.target_latency / 1000 if args.target_latency else None)
+        success_count, total_count = send_mllp_messages(messages, args.host, args.port, args.timeout, args.window,
+                                                        args.delay, controller, tls)
+        summary.info("\nSending complete. Successfully sent %d/%d messages.", success_count, total_count)
+        if controller is not None:
+            for line in controller.summary():
+                summary.info("%s", line)
+        return
     
     success_count = 0
+    total_count = 0
     
     for i, message in enumerate(messages):
-        print(f"\nSending message {i+1}/{len(messages)}...")
+        # Add delay between messages
+        if i:
+            time.sleep(args.delay)
+        
+        log.debug("Sending message %d...", i + 1)
+        total_count += 1
         
         if args.http:
             success = send_http_message(message, args.endpoint, args.apikey)
         else:
-            success = send_mllp_message(message, args.host, args.port, args.timeout)
+            success = send_mllp_message(message, args.host, args.port, args.timeout, tls)
             
         if success:
             success_count += 1
-        
-        # Add delay between messages
-        if i < len(messages) - 1:
-            time.sleep(args.delay)
     
-    print(f"\nSending complete. Successfully sent {success_count}/{len(messages)} messages.")
+    summary.info("\nSending complete. Successfully sent %d/%d messages.", success_count, total_count)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,121 @@
+"""
+Sender Logging
+
+Console output and per-message results of send_hl7.py go through the standard
+``logging`` module, but the send loop only puts records on a queue: a
+background ``QueueListener`` thread formats them and does the I/O. Records are
+enqueued unformatted, so a suppressed or sampled-out line costs a level check
+and a disabled one costs nothing at all.
+
+- ``log``:      progress and per-message lines. Accepted messages are logged at
+  INFO and can be sampled (1 in N); failures are WARNING and never sampled.
+- ``summary``:  end-of-run totals, shown even with ``--quiet``.
+- ``results``:  one JSON line per message (control ID, type, ACK code, latency),
+  written to the results file when one is configured.
+"""
+import sys
+import json
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+log = logging.getLogger('hl7_sender')
+summary = logging.getLogger('hl7_sender.summary')
+results = logging.getLogger('hl7_sender.results')
+
+# Pass as ``extra`` to mark a record as subject to sampling
+SAMPLED = {'sampled': True}
+
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+
+_listener = None
+
+class SampleFilter(logging.Filter):
+    """Let through only one in every ``rate`` records marked as sampled"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = max(1, rate)
+        self.seen = 0
+
+    def filter(self, record):
+        if not getattr(record, 'sampled', False):
+            return True
+        self.seen += 1
+        return (self.seen - 1) % self.rate == 0
+
+class DeferredQueueHandler(QueueHandler):
+    """Enqueue records as they are; formatting happens on the listener thread
+
+    Only pass immutable arguments (str, numbers) to the loggers using it.
+    """
+
+    def prepare(self, record):
+        return record
+
+class ResultsFileHandler(logging.Handler):
+    """Write ``results`` records to a file as compact JSON lines"""
+
+    def __init__(self, path):
+        super().__init__()
+        self.file = open(path, 'w', encoding='utf-8', buffering=1 << 16)
+
+    def emit(self, record):
+        control_id, message_type, ack_code, latency, detail = record.args
+        entry = {'ts': round(record.created, 6), 'control_id': control_id, 'type': message_type,
+                 'ack': ack_code}
+        if latency is not None:
+            entry['latency_ms'] = round(latency * 1000, 3)
+        if detail and ack_code != 'AA':
+            entry['detail'] = detail
+        self.file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+def log_result(control_id, message_type, ack_code, latency=None, detail=None):
+    """Record the outcome of one message in the results file (if enabled)"""
+    if results.isEnabledFor(logging.INFO):
+        results.info('%s %s %s %s %s', control_id, message_type, ack_code, latency, detail)
+
+def setup_logging(level='INFO', quiet=False, sample=1, results_path=None):
+    """Route sender logging through a queue drained by a background thread
+
+    ``quiet`` hides everything below ERROR except the summary. ``sample`` logs
+    one in every N accepted messages. ``results_path`` enables the JSONL
+    results file.
+    """
+    global _listener
+    shutdown_logging()
+
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter('%(message)s'))
+    console.addFilter(lambda record: record.name != results.name)
+    handlers = [console]
+    if results_path:
+        results_file = ResultsFileHandler(results_path)
+        results_file.addFilter(lambda record: record.name == results.name)
+        handlers.append(results_file)
+
+    records = queue.SimpleQueue()
+    handler = DeferredQueueHandler(records)
+    handler.addFilter(SampleFilter(sample))
+    for logger in (log, results):
+        logger.handlers = [handler]
+        logger.propagate = False
+    log.setLevel('ERROR' if quiet else level)
+    summary.setLevel('INFO')
+    results.setLevel('INFO' if results_path else logging.CRITICAL + 1)
+
+    _listener = QueueListener(records, *handlers)
+    _listener.start()
+
+def shutdown_logging():
+    """Drain the queue, stop the background thread and close the handlers"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
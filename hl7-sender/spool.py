@@ -0,0 +1,365 @@
+"""
+Store-and-Forward Spool
+
+Durable on-disk record of a send run, so an interrupted backfill can be resumed
+without re-sending what the receiver already accepted. A spool directory holds:
+
+- ``messages.mllp``: every message read from the input, MLLP-framed, append-only
+- ``messages.idx``:  one index record (offset, length, MSH-9, MSH-10) per message
+- ``state.log``:     append-only ``(sequence, state)`` records; the last record for
+  a message is its current state
+- ``spool.json``:    the input file, its format and whether it was fully read
+
+Only whole records count when a spool is reopened, so a crash can at worst lose
+the tail of a file: those messages are read from the input or sent again.
+
+``send_spooled`` drives a persistent MLLP connection from a spool. Messages that
+fail or are answered with AE go to a retry queue with exponential backoff and are
+interleaved with new messages, so they never hold up the rest of the run.
+"""
+import os
+import json
+import time
+import heapq
+import struct
+import itertools
+from collections import defaultdict, deque
+
+from corpus import INDEX_RECORD, iter_hl7_messages, pack_index_record
+from hl7_message import HL7Message
+from mllp_codec import EncodedFrame, encode_frame
+from send_hl7 import (
+    DEFAULT_ACK_TIMEOUT, DEFAULT_WINDOW, MLLPConnection, report_mllp_result
+)
+from send_log import log, summary
+
+DEFAULT_SPOOL_DIR = os.getenv("HL7_SPOOL_DIR", "spool")
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_RETRY_DELAY = 1.0  # seconds before the first retry, doubled for each further one
+MAX_RETRY_DELAY = 300.0
+SYNC_INTERVAL = 1.0  # seconds between fsyncs of the spool files
+
+STATE_RECORD = struct.Struct('<IB')
+
+# Message states. ACCEPTED, REJECTED and GAVE_UP are final within a run; --resume
+# sends everything else again, including messages that ran out of retries.
+QUEUED = 0
+SENT = 1
+ACCEPTED = 2
+FAILED = 3
+REJECTED = 4
+GAVE_UP = 5
+
+STATE_NAMES = {QUEUED: 'queued', SENT: 'sent', ACCEPTED: 'accepted', FAILED: 'failed',
+               REJECTED: 'rejected', GAVE_UP: 'gave up'}
+
+class MessageSpool:
+    """An append-only message spool with per-message send/ACK state"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.data_path = os.path.join(directory, 'messages.mllp')
+        self.index_path = os.path.join(directory, 'messages.idx')
+        self.state_path = os.path.join(directory, 'state.log')
+        self.meta_path = os.path.join(directory, 'spool.json')
+
+        self.meta = {}
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.meta = json.load(f)
+
+        os.makedirs(directory, exist_ok=True)
+        self.count, self.size = self._recover_index()
+        # One byte per message: its current state
+        self.states = bytearray(self.count)
+        self.log_records = self._replay_state()
+
+        self.data = open(self.data_path, 'a+b')
+        self.index = open(self.index_path, 'a+b')
+        # State changes are written straight through so a killed process loses none
+        # of them; fsync (every SYNC_INTERVAL) guards against losing them in a crash
+        self.state_log = open(self.state_path, 'ab', buffering=0)
+        # Appended frames still in the write buffers
+        self.appended = False
+        self.last_sync = time.monotonic()
+
+    @property
+    def is_empty(self):
+        return not self.count and not self.meta
+
+    @property
+    def input_complete(self):
+        return self.meta.get('complete', False)
+
+    def _recover_index(self):
+        """Count the complete messages, truncating any partially written tail"""
+        data_size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        count = size = 0
+        if os.path.exists(self.index_path):
+            count = os.path.getsize(self.index_path) // INDEX_RECORD.size
+            with open(self.index_path, 'rb') as f:
+                # Drop index records whose frame did not make it to disk
+                while count:
+                    f.seek((count - 1) * INDEX_RECORD.size)
+                    offset, length, _, _ = INDEX_RECORD.unpack(f.read(INDEX_RECORD.size))
+                    if offset + length <= data_size:
+                        size = offset + length
+                        break
+                    count -= 1
+        for path, keep in ((self.index_path, count * INDEX_RECORD.size), (self.data_path, size)):
+            if os.path.exists(path) and os.path.getsize(path) != keep:
+                os.truncate(path, keep)
+        return count, size
+
+    def _replay_state(self):
+        """Rebuild the state of every message from the log and return the record count"""
+        if not os.path.exists(self.state_path):
+            return 0
+        with open(self.state_path, 'rb') as f:
+            log = f.read()
+        records = len(log) // STATE_RECORD.size
+        for sequence, state in STATE_RECORD.iter_unpack(log[:records * STATE_RECORD.size]):
+            if sequence < self.count:
+                self.states[sequence] = state
+        return records
+
+    def start(self, input_path, fmt):
+        """Record the input of a new spool"""
+        self.meta = {'input': os.path.abspath(input_path), 'format': fmt, 'complete': False}
+        self._write_meta()
+
+    def mark_complete(self):
+        """Record that every input message has been spooled"""
+        self.meta['complete'] = True
+        self._write_meta()
+
+    def _write_meta(self):
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.meta, f, indent=2)
+        os.replace(tmp_path, self.meta_path)
+
+    def append(self, message):
+        """Spool one wire-format message and return ``(sequence, EncodedFrame)``
+
+        Raises ``ValueError`` (before writing anything) if its MSH-9 or MSH-10
+        does not fit an index record.
+        """
+        header = HL7Message(message)
+        message_type = header.raw_field('MSH', 9) or b''
+        control_id = header.raw_field('MSH', 10) or b''
+        frame = encode_frame(message)
+        record = pack_index_record(self.size, len(frame), message_type, control_id)
+        self.data.write(frame)
+        self.index.write(record)
+        self.size += len(frame)
+        sequence = self.count
+        self.count += 1
+        self.states.append(QUEUED)
+        self.appended = True
+        return sequence, EncodedFrame(frame, control_id.decode('utf-8', errors='replace') or "",
+                                      message_type.decode('utf-8', errors='replace') or "Unknown")
+
+    def _flush_appended(self):
+        """Push appended frames to the files before anything refers to them"""
+        if self.appended:
+            self.data.flush()
+            self.index.flush()
+            self.appended = False
+
+    def frame(self, sequence):
+        """Read a spooled message back as an EncodedFrame"""
+        self._flush_appended()
+        index_fd = self.index.fileno()
+        record = os.pread(index_fd, INDEX_RECORD.size, sequence * INDEX_RECORD.size)
+        offset, length, message_type, control_id = INDEX_RECORD.unpack(record)
+        frame = os.pread(self.data.fileno(), length, offset)
+        if control_id[-1:] != b'\0':
+            # A control ID filling its whole field may have been cut short by an
+            # older spool; the ACK carries the full MSH-10, so take it from the frame
+            control_id = HL7Message(frame[1:-2]).raw_field('MSH', 10) or b''
+        return EncodedFrame(frame, control_id.rstrip(b'\0').decode('utf-8', errors='replace'),
+                            message_type.rstrip(b'\0').decode('utf-8', errors='replace') or "Unknown")
+
+    def mark(self, sequence, state):
+        """Record a new state for a message"""
+        self._flush_appended()
+        self.states[sequence] = state
+        self.state_log.write(STATE_RECORD.pack(sequence, state))
+        self.log_records += 1
+        if time.monotonic() - self.last_sync >= SYNC_INTERVAL:
+            self.sync()
+
+    def unfinished(self):
+        """Sequence numbers of messages that still have to be sent, in order"""
+        return [i for i, state in enumerate(self.states) if state not in (ACCEPTED, REJECTED)]
+
+    def counts(self):
+        """Number of messages in each state"""
+        return {STATE_NAMES[state]: self.states.count(state) for state in STATE_NAMES}
+
+    def sync(self):
+        """Flush and fsync the spool files (frames before the state that refers to them)"""
+        self._flush_appended()
+        for f in (self.data, self.index, self.state_log):
+            os.fsync(f.fileno())
+        self.last_sync = time.monotonic()
+
+    def compact(self):
+        """Rewrite the state log with a single record per message that has left QUEUED"""
+        self.sync()
+        tmp_path = self.state_path + '.tmp'
+        records = 0
+        with open(tmp_path, 'wb') as f:
+            for sequence, state in enumerate(self.states):
+                if state != QUEUED:
+                    f.write(STATE_RECORD.pack(sequence, state))
+                    records += 1
+            f.flush()
+            os.fsync(f.fileno())
+        self.state_log.close()
+        os.replace(tmp_path, self.state_path)
+        self.state_log = open(self.state_path, 'ab', buffering=0)
+        self.log_records = records
+
+    def close(self):
+        if self.log_records > self.count:
+            self.compact()
+        self.sync()
+        for f in (self.data, self.index, self.state_log):
+            f.close()
+
+class SpoolSender:
+    """Sends spooled messages over one persistent MLLP connection with retries"""
+
+    def __init__(self, spool, host, port, timeout=DEFAULT_ACK_TIMEOUT, window=DEFAULT_WINDOW,
+                 max_retries=DEFAULT_MAX_RETRIES, retry_delay=DEFAULT_RETRY_DELAY):
+        self.spool = spool
+        self.connection = MLLPConnection(host, port, timeout, window)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        # Control ID -> sequence numbers of in-flight messages, oldest first
+        self.in_flight = defaultdict(deque)
+        self.attempts = {}
+        # (due time, sequence) of messages waiting to be retried
+        self.retries = []
+        # While the receiver is unreachable, nothing is sent until this time
+        self.down_until = 0.0
+        self.reconnect_delay = retry_delay
+        self.success_count = 0
+
+    def send(self, sequence, frame=None):
+        """Send one spooled message, first retrying any message that is due"""
+        self._send_due_retries()
+        self._send(sequence, frame)
+
+    def _send(self, sequence, frame=None):
+        self._wait_until_up()
+        if frame is None:
+            frame = self.spool.frame(sequence)
+        self.attempts[sequence] = self.attempts.get(sequence, 0) + 1
+        self.spool.mark(sequence, SENT)
+        self.in_flight[frame.control_id].append(sequence)
+        self._handle(self.connection.send(frame))
+
+    def _send_due_retries(self):
+        now = time.monotonic()
+        while self.retries and self.retries[0][0] <= now:
+            _, sequence = heapq.heappop(self.retries)
+            self._send(sequence)
+
+    def _wait_until_up(self):
+        delay = self.down_until - time.monotonic()
+        if delay > 0:
+            log.warning("Receiver unavailable, waiting %.1fs before reconnecting...", delay)
+            time.sleep(delay)
+
+    def _handle(self, results):
+        for result in results:
+            control_id, _, ack_code, _ = result
+            queue = self.in_flight.get(control_id)
+            if not queue:
+                continue
+            sequence = queue.popleft()
+            if not queue:
+                del self.in_flight[control_id]
+
+            if report_mllp_result(result, latency=self.connection.latency(control_id)):
+                self.spool.mark(sequence, ACCEPTED)
+                self.success_count += 1
+                self.reconnect_delay = self.retry_delay
+            elif ack_code == "AR":
+                self.spool.mark(sequence, REJECTED)
+            elif self.attempts[sequence] > self.max_retries:
+                self.spool.mark(sequence, GAVE_UP)
+            else:
+                self.spool.mark(sequence, FAILED)
+                backoff = min(self.retry_delay * 2 ** (self.attempts[sequence] - 1), MAX_RETRY_DELAY)
+                heapq.heappush(self.retries, (time.monotonic() + backoff, sequence))
+
+            now = time.monotonic()
+            if ack_code is None and self.connection.sock is None and self.down_until <= now:
+                # The connection was lost: back off before the next attempt
+                self.down_until = now + self.reconnect_delay
+                self.reconnect_delay = min(self.reconnect_delay * 2, MAX_RETRY_DELAY)
+
+    def finish(self):
+        """Wait for outstanding ACKs and retries until every message is settled"""
+        while True:
+            self._handle(self.connection.flush())
+            if not self.retries:
+                break
+            delay = self.retries[0][0] - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._send_due_retries()
+        self.connection.close()
+
+def send_spooled(input_path, spool_dir, host, port, fmt='auto', timeout=DEFAULT_ACK_TIMEOUT,
+                 window=DEFAULT_WINDOW, delay=0.0, resume=False, max_retries=DEFAULT_MAX_RETRIES,
+                 retry_delay=DEFAULT_RETRY_DELAY):
+    """Spool the messages of ``input_path`` and send them, or resume an earlier run
+
+    Returns a ``(success_count, total_count)`` tuple for this run.
+    """
+    spool = MessageSpool(spool_dir)
+    try:
+        if resume:
+            if spool.is_empty:
+                raise ValueError(f"Nothing to resume in spool {spool_dir}")
+            input_path = input_path or spool.meta['input']
+            fmt = spool.meta.get('format', fmt)
+        else:
+            if not spool.is_empty:
+                raise ValueError(f"Spool {spool_dir} already holds a run; use --resume or another --spool")
+            spool.start(input_path, fmt)
+
+        sender = SpoolSender(spool, host, port, timeout, window, max_retries, retry_delay)
+        backlog = spool.unfinished()
+        total_count = len(backlog)
+        if resume:
+            log.info("Resuming spool %s: %d of %d spooled messages already settled, %d to send",
+                     spool_dir, spool.count - len(backlog), spool.count, len(backlog))
+
+        # Unfinished spooled messages go first, then the rest of the input
+        for sequence in backlog:
+            if delay and sequence != backlog[0]:
+                time.sleep(delay)
+            sender.send(sequence)
+        if not spool.input_complete:
+            # Read errors propagate so that a missing input never marks the spool complete
+            messages = iter_hl7_messages(input_path, fmt)
+            for message in itertools.islice(messages, spool.count, None):
+                if delay and total_count:
+                    time.sleep(delay)
+                sequence, frame = spool.append(message)
+                total_count += 1
+                sender.send(sequence, frame)
+            spool.mark_complete()
+        sender.finish()
+    finally:
+        spool.close()
+
+    counts = spool.counts()
+    summary.info("Spool: " + ", ".join(f"{name}={n}" for name, n in counts.items() if n))
+    return sender.success_count, total_count
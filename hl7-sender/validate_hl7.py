@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+"""
+HL7 Pre-flight Conformance Validator
+
+Checks a corpus against the Medsynapse PACS Broker requirements before it is
+sent, so malformed messages are caught locally instead of one AE/NAK round trip
+at a time. The layout rules (segments, their order and the position of every
+field) are derived from the message templates in ``sample_data/templates.py``.
+The mandatory fields come from the conformance statement (section G), and the
+coded values from the template value lists. For each message the validator
+checks:
+
+- MSH: encoding characters, supported message type (MSH-9), control ID
+  (MSH-10) and version 2.3 (MSH-12)
+- required segments present, no unexpected or repeated segments, segment order
+- field counts: a segment with more fields than its template usually contains an
+  unescaped ``|``
+- mandatory fields present, coded fields (sex, modality, order control, report
+  status/format) valid, timestamps well-formed
+- escaping: every ``\\`` starts a valid escape sequence, and there are no bare line
+  feeds
+
+Large corpora are validated in chunks across a process pool while the file is
+streamed, and results come back in input order. The report has one JSON line
+per message, and valid and invalid messages can be split into separate corpora.
+"""
+import os
+import re
+import sys
+import json
+import argparse
+import itertools
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+from corpus import iter_hl7_messages, open_corpus_writer, compression_for_path, CORPUS_FORMATS, CORPUS_WRITERS
+from metrics import METRICS
+from send_log import log, summary
+from sample_data.templates import (
+    ORM_O01_TEMPLATE, ORU_R01_TEMPLATE, ADT_A08_TEMPLATE, ADT_A40_TEMPLATE,
+    GENDER_CODES, MODALITY_CODES, ORDER_CONTROLS, REPORT_FORMATS, REPORT_STATUSES
+)
+
+DEFAULT_CHUNK_SIZE = 2000
+SUPPORTED_VERSION = b'2.3'
+ENCODING_CHARACTERS = b'^~\\&'
+
+# Mandatory broker fields (conformance statement, section G), by template placeholder
+ORDER_FIELDS = ('accession_number', 'patient_id', 'patient_name', 'gender', 'modality', 'ss_aetitle', 'ss_name',
+                'sps_start_datetime', 'sps_id', 'sps_description', 'rp_id', 'rp_description')
+MANDATORY_FIELDS = {
+    'ORM^O01': ORDER_FIELDS,
+    'ORU^R01': ORDER_FIELDS + ('report_text', 'report_date'),
+    'ADT^A08': ('patient_id', 'patient_name'),
+    'ADT^A40': ('patient_id_new', 'patient_id_old'),
+}
+
+# Coded fields and their allowed values; ORU messages carry order control RE
+CODED_FIELDS = {
+    'gender': GENDER_CODES,
+    'modality': MODALITY_CODES,
+    'order_control': ORDER_CONTROLS + ['RE'],
+    'report_status': REPORT_STATUSES,
+    'report_format': REPORT_FORMATS,
+}
+TIMESTAMP_FIELDS = ('datetime', 'sps_start_datetime', 'report_date', 'dob')
+
+SEGMENT_ID = re.compile(rb'[A-Z][A-Z0-9]{2}$')
+TIMESTAMP = re.compile(rb'\d{4}(\d{2}(\d{2}(\d{2}(\d{2}(\d{2}(\.\d{1,4})?)?)?)?)?)?([+-]\d{4})?$')
+# Escape sequences of HL7 v2.3 section 2.9: delimiters, formatting and hex data
+ESCAPE_SEQUENCE = re.compile(rb'\\(?:[FSTRE]|H|N|X[0-9A-Fa-f]*|\.[a-z]{2}[+-]?\d*|[CM][0-9A-Fa-f]+|Z[^\\|]*)\\')
+
+class MessageRules:
+    """Segment layout and field positions of one message type, read from its template"""
+
+    def __init__(self, message_type, template, mandatory):
+        self.message_type = message_type
+        lines = template.strip('\n').split('\n')
+        self.segments = [line[:3].encode('ascii') for line in lines]
+        self.order = {segment: i for i, segment in enumerate(self.segments)}
+        # Segment -> number of fields after the segment ID
+        self.field_counts = {}
+        # Placeholder -> (segment, index into the split segment, component index)
+        self.locations = {}
+        for segment, line in zip(self.segments, lines):
+            fields = line.split('|')
+            self.field_counts[segment] = len(fields) - 1
+            for index, value in enumerate(fields):
+                for component, part in enumerate(value.split('^')):
+                    if part.startswith('{') and part.endswith('}'):
+                        self.locations.setdefault(part[1:-1], (segment, index, component))
+        self.mandatory = [(name,) + self.locations[name] for name in mandatory]
+        self.coded = [(name,) + self.locations[name] + (frozenset(v.encode('ascii') for v in values),)
+                      for name, values in CODED_FIELDS.items() if name in self.locations]
+        self.timestamps = [(name,) + self.locations[name] for name in TIMESTAMP_FIELDS if name in self.locations]
+        self.required_segments = list(dict.fromkeys([b'MSH'] + [location[1] for location in self.mandatory]))
+
+RULES = {
+    message_type: MessageRules(message_type, template, MANDATORY_FIELDS[message_type])
+    for message_type, template in (('ORM^O01', ORM_O01_TEMPLATE), ('ORU^R01', ORU_R01_TEMPLATE),
+                                   ('ADT^A08', ADT_A08_TEMPLATE), ('ADT^A40', ADT_A40_TEMPLATE))
+}
+
+def field_name(segment, index):
+    """HL7 name of a field, e.g. ``OBR-2`` (MSH fields count the separator as MSH-1)"""
+    segment = segment.decode('ascii', 'replace')
+    return f"{segment}-{index + 1 if segment == 'MSH' else index}"
+
+def _text(value):
+    return value.decode('utf-8', 'replace')
+
+def _value(fields, index, component):
+    """One component of a split segment, or ``b''``"""
+    if index >= len(fields):
+        return b''
+    value = fields[index]
+    if component:
+        parts = value.split(b'^')
+        return parts[component] if component < len(parts) else b''
+    return value.split(b'^', 1)[0] if b'^' in value else value
+
+def validate_message(message):
+    """Check one wire-format message; returns ``(control_id, message_type, issues)``
+
+    ``issues`` is a list of ``(rule, detail)`` pairs and is empty for a
+    conformant message.
+    """
+    issues = []
+    if not message.startswith(b'MSH|'):
+        return '', 'Unknown', [('header', "message does not start with an MSH segment")]
+    segments = [segment for segment in message.split(b'\r') if segment]
+    msh = segments[0].split(b'|')
+    control_id = _text(msh[9]) if len(msh) > 9 else ''
+    message_type = _text(msh[8]) if len(msh) > 8 else ''
+
+    if msh[1] != ENCODING_CHARACTERS:
+        issues.append(('header', f"MSH-2 encoding characters are {_text(msh[1])!r}, expected '^~\\&'"))
+    if not control_id:
+        issues.append(('missing-field', "MSH-10 message control ID is required"))
+    version = msh[11].split(b'^', 1)[0] if len(msh) > 11 else b''
+    if version != SUPPORTED_VERSION:
+        issues.append(('version', f"MSH-12 version is {_text(version) or 'missing'}, the broker accepts 2.3"))
+    rules = RULES.get(message_type)
+    if rules is None:
+        issues.append(('message-type', f"MSH-9 message type {message_type or 'missing'} is not supported"))
+        return control_id, message_type or 'Unknown', issues
+
+    # Segment structure
+    split = {}
+    last_position = -1
+    for number, segment in enumerate(segments, 1):
+        segment_id = segment[:3]
+        if not SEGMENT_ID.match(segment_id) or segment[3:4] not in (b'|', b''):
+            issues.append(('segment', f"segment {number} has an invalid segment ID "
+                                      f"{_text(segment[:12])!r} (unescaped line break?)"))
+            continue
+        position = rules.order.get(segment_id)
+        if position is None:
+            issues.append(('segment', f"{_text(segment_id)} segment is not part of {message_type}"))
+            continue
+        if segment_id in split:
+            issues.append(('segment', f"{_text(segment_id)} occurs more than once"))
+            continue
+        if position < last_position:
+            issues.append(('segment', f"{_text(segment_id)} is out of order"))
+        last_position = max(last_position, position)
+        fields = split[segment_id] = segment.split(b'|')
+        expected = rules.field_counts[segment_id]
+        if len(fields) - 1 > expected:
+            issues.append(('field-count', f"{_text(segment_id)} has {len(fields) - 1} fields, at most {expected} "
+                                          f"expected (unescaped '|'?)"))
+        if b'\\' in segment:
+            start = 2 if segment_id == b'MSH' else 1
+            for index in range(start, len(fields)):
+                if b'\\' in fields[index] and b'\\' in ESCAPE_SEQUENCE.sub(b'', fields[index]):
+                    issues.append(('escape', f"{field_name(segment_id, index)} contains an invalid escape sequence"))
+        if b'\n' in segment:
+            issues.append(('escape', f"{_text(segment_id)} contains an unescaped line feed"))
+    for segment_id in rules.required_segments:
+        if segment_id not in split:
+            issues.append(('segment', f"required {_text(segment_id)} segment is missing"))
+
+    # Field contents
+    for name, segment_id, index, component in rules.mandatory:
+        fields = split.get(segment_id)
+        if fields is not None and not _value(fields, index, component):
+            issues.append(('missing-field', f"{field_name(segment_id, index)} ({name}) is required"))
+    for name, segment_id, index, component, allowed in rules.coded:
+        fields = split.get(segment_id)
+        value = _value(fields, index, component) if fields is not None else b''
+        if value and value not in allowed:
+            issues.append(('code', f"{field_name(segment_id, index)} ({name}) has invalid value {_text(value)!r}"))
+    for name, segment_id, index, component in rules.timestamps:
+        fields = split.get(segment_id)
+        value = _value(fields, index, component) if fields is not None else b''
+        if value and not TIMESTAMP.match(value):
+            issues.append(('timestamp', f"{field_name(segment_id, index)} ({name}) is not an HL7 timestamp: "
+                                        f"{_text(value)!r}"))
+    return control_id, message_type, issues
+
+def validate_chunk(messages):
+    """Validate a list of messages (runs in a worker process)"""
+    return [validate_message(message) for message in messages]
+
+def _chunks(messages, size):
+    iterator = iter(messages)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def iter_validated(messages, workers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield ``(message, control_id, message_type, issues)`` for every message, in input order
+
+    Chunks of ``chunk_size`` messages are validated across ``workers`` processes
+    (default: one per CPU); at most two chunks per worker are in flight, so
+    memory stays bounded however large the input is.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for message in messages:
+            yield (message,) + validate_message(message)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in _chunks(messages, chunk_size):
+            pending.append((chunk, executor.submit(validate_chunk, chunk)))
+            if len(pending) >= workers * 2:
+                chunk, future = pending.popleft()
+                for message, result in zip(chunk, future.result()):
+                    yield (message,) + result
+        while pending:
+            chunk, future = pending.popleft()
+            for message, result in zip(chunk, future.result()):
+                yield (message,) + result
+
+def format_issues(issues):
+    """Issues as one line of text"""
+    return "; ".join(detail for _, detail in issues)
+
+def filter_valid(messages, workers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield only the conformant messages, logging every one that is held back"""
+    skipped = 0
+    for message, control_id, message_type, issues in iter_validated(messages, workers, chunk_size):
+        if not issues:
+            yield message
+            continue
+        skipped += 1
+        METRICS.count('messages', 'invalid')
+        log.warning("%s %s not sent, failed validation: %s", message_type, control_id, format_issues(issues))
+    if skipped:
+        summary.info("%d non-conformant messages were not sent.", skipped)
+
+def main():
+    parser = argparse.ArgumentParser(description='Check an HL7 corpus against the Medsynapse PACS conformance rules before sending')
+    parser.add_argument('--input', type=str, required=True, help='Corpus file to validate')
+    parser.add_argument('--format', type=str, default='auto', choices=CORPUS_FORMATS, help='Layout of the input file (default: detect)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Number of validation processes')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Messages per chunk sent to a worker')
+    parser.add_argument('--report', type=str, help='Write one JSON line per message with its issues to this file')
+    parser.add_argument('--output', type=str, help='Write the conformant messages to this corpus file')
+    parser.add_argument('--rejects', type=str, help='Write the non-conformant messages to this corpus file')
+    parser.add_argument('--output-format', type=str, default='blank-line', choices=[f for f in CORPUS_WRITERS if f != 'indexed'], help='Layout of --output and --rejects')
+    parser.add_argument('--quiet', action='store_true', help='Only print the summary')
+
+    args = parser.parse_args()
+    if args.workers < 1 or args.chunk_size < 1:
+        parser.error("--workers and --chunk-size must be at least 1")
+
+    report = open(args.report, 'w', encoding='utf-8', buffering=1 << 16) if args.report else None
+    output = open_corpus_writer(args.output, args.output_format, compression_for_path(args.output)) if args.output else None
+    rejects = open_corpus_writer(args.rejects, args.output_format, compression_for_path(args.rejects)) if args.rejects else None
+    total = 0
+    invalid = 0
+    rules = Counter()
+    try:
+        messages = iter_hl7_messages(args.input, args.format)
+        for index, (message, control_id, message_type, issues) in enumerate(
+                iter_validated(messages, args.workers, args.chunk_size), 1):
+            total += 1
+            if issues:
+                invalid += 1
+                rules.update(rule for rule, _ in issues)
+                if not args.quiet:
+                    print(f"Message {index} ({message_type} {control_id}): {format_issues(issues)}")
+                if rejects is not None:
+                    rejects.write(message)
+            elif output is not None:
+                output.write(message)
+            if report is not None:
+                entry = {'index': index, 'control_id': control_id, 'type': message_type, 'valid': not issues}
+                if issues:
+                    entry['issues'] = [{'rule': rule, 'detail': detail} for rule, detail in issues]
+                report.write(json.dumps(entry, separators=(',', ':')) + '\n')
+    except (OSError, ValueError) as e:
+        print(f"Error reading {args.input}: {e}")
+        sys.exit(2)
+    finally:
+        for f in (report, output, rejects):
+            if f is not None:
+                f.close()
+
+    print(f"\nValidated {total} messages: {total - invalid} conformant, {invalid} with issues.")
+    for rule, count in rules.most_common():
+        print(f"  {rule}: {count}")
+    if invalid:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""
+Watch-Folder Daemon
+
+Keeps one sender process running against a drop directory instead of starting a
+new process (interpreter, imports, TCP handshake) for every file. Each new file
+is streamed through a connection that stays open between files: a pipelined
+``MLLPConnection`` or a keep-alive ``requests.Session``.
+
+New files are detected with inotify (through ``ctypes``, no extra dependency)
+when it is available, and by polling the directory otherwise. With inotify a
+file is picked up once its writer closes it or it is renamed into the
+directory; when polling, once its size and mtime have been stable for one poll
+interval. Writers should create files under a dotted or ``.tmp`` name and
+rename them when complete.
+
+Finished files are moved to ``sent/``, or to ``failed/`` if any message was not
+accepted or the file could not be read, so a restarted daemon never sends a
+file twice.
+"""
+import os
+import time
+import errno
+import select
+import signal
+import struct
+import ctypes
+import ctypes.util
+
+from corpus import iter_hl7_messages
+from metrics import METRICS
+from send_log import log, summary
+from send_hl7 import (
+    DEFAULT_ACK_TIMEOUT, DEFAULT_WINDOW, DEFAULT_HTTP_BATCH, MLLPConnection, report_mllp_result,
+    send_http_message, send_http_messages
+)
+
+SENT_DIR = 'sent'
+FAILED_DIR = 'failed'
+DEFAULT_POLL_INTERVAL = 1.0  # seconds
+
+# inotify(7) event masks
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+def _is_candidate(name):
+    """True for file names that may be picked up (no temporary or hidden files)"""
+    return not name.startswith('.') and not name.endswith(('.tmp', '.part'))
+
+class FolderWatcher:
+    """Reports files that have been completely written to ``directory``
+
+    ``poll(timeout)`` returns the paths of new files, oldest first, or an empty
+    list after ``timeout`` seconds. Files already present when the watcher is
+    created are reported by the first poll.
+    """
+
+    def __init__(self, directory, poll_interval=DEFAULT_POLL_INTERVAL, use_inotify=True):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.fd = self._inotify(directory) if use_inotify else None
+        # Names already reported, and names waiting to settle -> (size, mtime_ns) at the last scan
+        self.seen = set()
+        self.settling = {}
+        self.backlog = self._scan(stable_only=False)
+
+    @staticmethod
+    def _inotify(directory):
+        """An inotify descriptor watching ``directory``, or None where unavailable"""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    @property
+    def mode(self):
+        return 'inotify' if self.fd is not None else 'polling'
+
+    def _scan(self, stable_only=True):
+        """Files in the directory not reported yet, oldest first
+
+        With ``stable_only`` a file is reported only once its size and mtime
+        have not changed since the previous scan.
+        """
+        ready = []
+        present = set()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.is_file() or not _is_candidate(entry.name):
+                    continue
+                present.add(entry.name)
+                if entry.name in self.seen:
+                    continue
+                stat = entry.stat()
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if stable_only and self.settling.get(entry.name) != signature:
+                    self.settling[entry.name] = signature
+                    continue
+                ready.append((stat.st_mtime_ns, entry.name))
+        # Forget files that have gone (moved away after sending)
+        self.seen &= present
+        self.settling = {name: sig for name, sig in self.settling.items() if name in present}
+        ready.sort()
+        self.seen.update(name for _, name in ready)
+        for _, name in ready:
+            self.settling.pop(name, None)
+        return [os.path.join(self.directory, name) for _, name in ready]
+
+    def _read_events(self):
+        """File names from pending inotify events; None if the queue overflowed"""
+        names = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return names
+            pos = 0
+            while pos < len(data):
+                _, mask, _, length = INOTIFY_EVENT.unpack_from(data, pos)
+                pos += INOTIFY_EVENT.size
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+                pos += length
+                if name and _is_candidate(name):
+                    names.append(name)
+
+    def poll(self, timeout):
+        """Paths of newly completed files, waiting up to ``timeout`` seconds for one"""
+        if self.backlog:
+            ready, self.backlog = self.backlog, []
+            return ready
+        if self.fd is None:
+            time.sleep(min(timeout, self.poll_interval))
+            return self._scan()
+        try:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+        except InterruptedError:
+            return []
+        if not readable:
+            return []
+        names = self._read_events()
+        if names is None:
+            # Events were lost; fall back to a full scan
+            return self._scan(stable_only=False)
+        ready = []
+        for name in dict.fromkeys(names):
+            path = os.path.join(self.directory, name)
+            if name not in self.seen and os.path.isfile(path):
+                self.seen.add(name)
+                ready.append(path)
+        return ready
+
+    def done(self, path):
+        """Forget a reported file once it has been moved away, so its name can be reused"""
+        self.seen.discard(os.path.basename(path))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class WatchFolderSender:
+    """Sends every file that appears in a watched directory over a persistent transport"""
+
+    def __init__(self, directory, host, port, fmt='auto', timeout=DEFAULT_ACK_TIMEOUT,
+                 window=DEFAULT_WINDOW, http=False, endpoint=None, api_key=None,
+                 http_batch=DEFAULT_HTTP_BATCH, http_format='json', compress=True):
+        self.directory = directory
+        self.fmt = fmt
+        self.http = http
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.http_batch = http_batch
+        self.http_format = http_format
+        self.compress = compress
+        self.connection = None
+        self.session = None
+        if http:
+            import requests
+            self.session = requests.Session()
+        else:
+            self.connection = MLLPConnection(host, port, timeout, window)
+        for name in (SENT_DIR, FAILED_DIR):
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+        self.files = 0
+        self.messages = 0
+        self.accepted = 0
+        self.file_counts = [0, 0]  # (accepted, total) of the file being sent
+        self.stopping = False
+
+    def send_file(self, path):
+        """Send every message in one file; returns ``(accepted, total)``
+
+        The counts so far are kept in :attr:`file_counts`, so a file that fails
+        partway through is still accounted for.
+        """
+        counts = self.file_counts = [0, 0]
+        if self.http and self.http_batch > 1:
+            counts[:] = send_http_messages(METRICS.timed(iter_hl7_messages(path, self.fmt), 'read'), self.endpoint,
+                                           self.api_key, self.http_batch, self.http_format, self.compress,
+                                           session=self.session)
+            return tuple(counts)
+        if self.http:
+            for message in METRICS.timed(iter_hl7_messages(path, self.fmt), 'read'):
+                counts[1] += 1
+                counts[0] += send_http_message(message, self.endpoint, self.api_key, self.session)
+            return tuple(counts)
+
+        connection = self.connection
+        try:
+            for message in METRICS.timed(iter_hl7_messages(path, self.fmt), 'read'):
+                counts[1] += 1
+                for result in connection.send(message):
+                    counts[0] += report_mllp_result(result, latency=connection.latency(result[0]))
+        finally:
+            # Settle the file before moving it (even if reading it failed, so its
+            # ACKs are not counted against the next file), but keep the connection open
+            for result in connection.flush():
+                counts[0] += report_mllp_result(result, latency=connection.latency(result[0]))
+        return tuple(counts)
+
+    def handle(self, path):
+        """Send a file and move it to ``sent/`` or ``failed/``"""
+        name = os.path.basename(path)
+        started = time.perf_counter()
+        try:
+            accepted, total = self.send_file(path)
+            error = None if accepted == total else f"{total - accepted} of {total} messages not accepted"
+        except (OSError, ValueError, EOFError) as e:
+            # EOFError: a truncated gzip file
+            accepted, total = self.file_counts
+            error = str(e)
+        elapsed = time.perf_counter() - started
+
+        self.files += 1
+        self.messages += total
+        self.accepted += accepted
+        target = os.path.join(self.directory, FAILED_DIR if error else SENT_DIR, name)
+        try:
+            os.replace(path, target)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                log.error("Could not move %s to %s: %s", path, target, e)
+        if error:
+            log.warning("%s: %s (%.1f ms), moved to %s/", name, error, elapsed * 1000, FAILED_DIR)
+        else:
+            summary.info("%s: %d messages sent in %.1f ms", name, total, elapsed * 1000)
+
+    def stop(self, signum=None, frame=None):
+        """Finish the current file, then leave :meth:`run`"""
+        self.stopping = True
+
+    def run(self, poll_interval=DEFAULT_POLL_INTERVAL, use_inotify=True):
+        """Watch the directory until SIGINT/SIGTERM"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        watcher = FolderWatcher(self.directory, poll_interval, use_inotify)
+        log.info("Watching %s for HL7 files (%s)...", self.directory, watcher.mode)
+        try:
+            while not self.stopping:
+                for path in watcher.poll(poll_interval):
+                    if self.stopping:
+                        break
+                    self.handle(path)
+                    watcher.done(path)
+        finally:
+            watcher.close()
+            if self.connection is not None:
+                self.connection.close()
+            if self.session is not None:
+                self.session.close()
+        summary.info("\nWatch stopped. %d files, successfully sent %d/%d messages.",
+                     self.files, self.accepted, self.messages)
@@ -48,6 +48,8 @@ const logger = winston.createLogger({
 // Middleware
 app.use(helmet()); // Security headers
 app.use(cors()); // Enable CORS
+// Batch bodies may be larger; gzip Content-Encoding is inflated by the parsers
+app.use('/api/hl7/batch', express.json({ limit: '50mb' }), express.text({ type: 'application/hl7-v2', limit: '50mb' }));
 app.use(express.json({ limit: '10mb' })); // Parse JSON request bodies with a larger limit
 app.use(express.urlencoded({ extended: true, limit: '10mb' })); // Parse URL-encoded request bodies
 app.use(morgan('combined', { stream: { write: message => logger.info(message.trim()) } })); // HTTP request logging
@@ -12,6 +12,55 @@ const hl7Parser = require('../utils/hl7Parser');
 const messages = [];
 let messageCounter = 0;
 
+const storageDir = path.join(__dirname, '../../storage');
+
+/**
+ * Parse, store and acknowledge one decoded HL7 message
+ * @param {string} decodedMessage - Raw HL7 message text
+ * @param {string} messageType - Message type supplied by the sender, if any
+ * @param {string} sendTime - Send time supplied by the sender, if any
+ * @returns {Object} { storedMessage, ackMessage } or { error }
+ */
+const storeMessage = (decodedMessage, messageType, sendTime) => {
+  // Parse the HL7 message
+  const parsedMessage = hl7Parser.parseHL7(decodedMessage);
+  
+  if (!parsedMessage) {
+    return { error: 'Failed to parse HL7 message' };
+  }
+  
+  // Store the message
+  const receivedTime = moment().format();
+  const messageId = ++messageCounter;
+  
+  const storedMessage = {
+    id: messageId,
+    messageType: parsedMessage.messageType || messageType || 'Unknown',
+    messageControlId: parsedMessage.messageControlId || 'Unknown',
+    sendTime: sendTime || receivedTime,
+    receivedTime,
+    message: decodedMessage,
+    parsedMessage
+  };
+  
+  messages.push(storedMessage);
+  
+  // Also save to a file for persistence
+  if (!fs.existsSync(storageDir)) {
+    fs.mkdirSync(storageDir, { recursive: true });
+  }
+  
+  // Save the raw message to a timestamped file
+  const timestamp = moment().format('YYYYMMDD_HHmmss');
+  const messageFilename = `${timestamp}_${messageId}_${storedMessage.messageType}.hl7`;
+  fs.writeFileSync(path.join(storageDir, messageFilename), decodedMessage);
+  
+  // Generate an acknowledgment
+  const ackMessage = hl7Parser.generateAcknowledgment(parsedMessage);
+  
+  return { storedMessage, ackMessage };
+};
+
 /**
  * Receive and process an HL7 message
  * @param {Object} req - Express request object
@@ -33,54 +82,83 @@ exports.receiveMessage = async (req, res) => {
       return res.status(400).json({ error: 'Invalid message encoding' });
     }
     
-    // Parse the HL7 message
-    const parsedMessage = hl7Parser.parseHL7(decodedMessage);
+    const { storedMessage, ackMessage, error } = storeMessage(decodedMessage, messageType, sendTime);
     
-    if (!parsedMessage) {
-      return res.status(400).json({ error: 'Failed to parse HL7 message' });
+    if (error) {
+      return res.status(400).json({ error });
     }
     
-    // Store the message
-    const receivedTime = moment().format();
-    const messageId = ++messageCounter;
+    // Log the message receipt
+    console.log(`Received HL7 message type ${storedMessage.messageType} with control ID ${storedMessage.messageControlId}`);
     
-    const storedMessage = {
-      id: messageId,
-      messageType: parsedMessage.messageType || messageType || 'Unknown',
-      messageControlId: parsedMessage.messageControlId || 'Unknown',
-      sendTime: sendTime || receivedTime,
-      receivedTime,
-      message: decodedMessage,
-      parsedMessage
-    };
+    return res.status(200).json({
+      message: 'Message received successfully',
+      messageId: storedMessage.id,
+      acknowledgment: ackMessage
+    });
+    
+  } catch (err) {
+    console.error('Error processing HL7 message:', err);
+    return res.status(500).json({ error: 'Internal server error' });
+  }
+};
+
+/**
+ * Receive a batch of HL7 messages in one request
+ *
+ * The body is either JSON ({ messages: [raw HL7 text, ...], sendTime }) or
+ * application/hl7-v2 text with the messages back to back. Neither is
+ * base64-encoded; gzip Content-Encoding is inflated by the body parsers.
+ * @param {Object} req - Express request object
+ * @param {Object} res - Express response object
+ */
+exports.receiveBatch = async (req, res) => {
+  try {
+    let batch;
+    let sendTime;
     
-    messages.push(storedMessage);
+    if (typeof req.body === 'string') {
+      // Every message starts with an MSH segment
+      batch = req.body.split(/[\r\n]+(?=MSH\|)/).filter(message => message.trim());
+    } else if (req.body && Array.isArray(req.body.messages)) {
+      batch = req.body.messages;
+      sendTime = req.body.sendTime;
+    }
     
-    // Also save to a file for persistence
-    const storageDir = path.join(__dirname, '../../storage');
-    if (!fs.existsSync(storageDir)) {
-      fs.mkdirSync(storageDir, { recursive: true });
+    if (!batch || batch.length === 0) {
+      return res.status(400).json({ error: 'No messages provided' });
     }
     
-    // Save the raw message to a timestamped file
-    const timestamp = moment().format('YYYYMMDD_HHmmss');
-    const messageFilename = `${timestamp}_${messageId}_${storedMessage.messageType}.hl7`;
-    fs.writeFileSync(path.join(storageDir, messageFilename), decodedMessage);
+    const results = batch.map((decodedMessage, index) => {
+      if (typeof decodedMessage !== 'string') {
+        return { index, error: 'Message is not a string' };
+      }
+      const { storedMessage, ackMessage, error } = storeMessage(decodedMessage, null, sendTime);
+      if (error) {
+        return { index, error };
+      }
+      return {
+        index,
+        messageId: storedMessage.id,
+        messageControlId: storedMessage.messageControlId,
+        acknowledgment: ackMessage
+      };
+    });
     
-    // Log the message receipt
-    console.log(`Received HL7 message type ${storedMessage.messageType} with control ID ${storedMessage.messageControlId}`);
+    const accepted = results.filter(result => !result.error).length;
     
-    // Generate an acknowledgment
-    const ackMessage = hl7Parser.generateAcknowledgment(parsedMessage);
+    // One log line per batch rather than per message
+    console.log(`Received HL7 batch of ${batch.length} messages (${accepted} accepted)`);
     
     return res.status(200).json({
-      message: 'Message received successfully',
-      messageId,
-      acknowledgment: ackMessage
+      message: 'Batch received successfully',
+      received: batch.length,
+      accepted,
+      results
     });
     
   } catch (err) {
-    console.error('Error processing HL7 message:', err);
+    console.error('Error processing HL7 batch:', err);
     return res.status(500).json({ error: 'Internal server error' });
   }
 };
@@ -14,6 +14,13 @@ const hl7Controller = require('../controllers/hl7Controller');
  */
 router.post('/', hl7Controller.receiveMessage);
 
+/**
+ * @route POST /api/hl7/batch
+ * @desc Receive a batch of HL7 messages (JSON array or application/hl7-v2 text, optionally gzip-compressed)
+ * @access Private
+ */
+router.post('/batch', hl7Controller.receiveBatch);
+
 /**
  * @route GET /api/hl7/messages
  * @desc Get all received messages